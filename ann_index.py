@@ -0,0 +1,439 @@
+# ann_index.py
+
+import json
+import os
+import threading
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from compact_vectors import VECTOR_DTYPE, VectorFile, compact_dot
+
+# Below this many live vectors an exact scan is as fast as probing lists,
+# so the index stays untrained (flat) until it grows past it.
+MIN_TRAIN_SIZE = int(os.environ.get("SORTER_ANN_MIN_TRAIN", 20000))
+# Lists probed per query; higher is slower but recalls more.
+DEFAULT_NPROBE = int(os.environ.get("SORTER_ANN_NPROBE", 32))
+# Retrain once the index has grown this many times past its last training size.
+RETRAIN_GROWTH = 4
+# Rows added since the last pack are scanned exactly; repack the lists once
+# that tail exceeds this fraction of the packed rows (or PACK_MIN_TAIL rows).
+PACK_TAIL_FRACTION = 0.1
+PACK_MIN_TAIL = 4096
+# Superseded rows and tombstones are dropped from the files once they
+# outnumber this fraction of the live rows (and COMPACT_MIN_DEAD rows).
+COMPACT_DEAD_FRACTION = 0.5
+COMPACT_MIN_DEAD = 1024
+MAX_LISTS = 4096
+KMEANS_SAMPLE_PER_LIST = 32
+KMEANS_ITERS = 10
+
+_TOMBSTONE = -1    # row records that its path was removed
+_UNASSIGNED = -2   # row added while the index had no centroids
+# Suffix of the files a compaction writes before swapping them in, and the
+# marker that exists while it swaps (files from two generations on disk).
+_COMPACT_SUFFIX = ".compact"
+_COMPACT_MARKER = "compacting"
+
+
+def _nearest(x: np.ndarray, centroids: np.ndarray, chunk: int = 65536) -> np.ndarray:
+    """Index of the highest-dot-product centroid for every row of x."""
+    out = np.empty(len(x), dtype=np.int32)
+    for i in range(0, len(x), chunk):
+        out[i : i + chunk] = np.argmax(x[i : i + chunk] @ centroids.T, axis=1)
+    return out
+
+
+def _nearest_stored(store: VectorFile, start: int, stop: int, centroids: np.ndarray) -> np.ndarray:
+    """_nearest for stored rows [start, stop), decoded a chunk at a time."""
+    parts = [_nearest(block, centroids) for block in store.iter_float(start, stop)]
+    return np.concatenate(parts) if parts else np.empty(0, dtype=np.int32)
+
+
+def _pack(assign: np.ndarray, live: np.ndarray, store: VectorFile, nlist: int):
+    """
+    Groups the live, assigned rows by list. Returns (rows, codes, scales,
+    bounds) where list l owns rows[bounds[l]:bounds[l + 1]], with its compact
+    vectors copied contiguously so a probe is one dense matrix-vector product.
+    """
+    rows = np.flatnonzero((assign >= 0) & live)
+    labels = assign[rows]
+    order = np.argsort(labels, kind="stable")
+    rows = rows[order]
+    bounds = np.searchsorted(labels[order], np.arange(nlist + 1))
+    codes, scales = store.take(rows)
+    return rows, codes, scales, bounds
+
+
+def train_centroids(x: np.ndarray, nlist: int, iters: int = KMEANS_ITERS, seed: int = 0) -> np.ndarray:
+    """Spherical k-means (cosine) over the rows of x; returns unit-norm centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), nlist, replace=False)].copy()
+    for _ in range(iters):
+        labels = _nearest(x, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, x)
+        counts = np.bincount(labels, minlength=nlist)
+        filled = counts > 0
+        # Empty clusters keep their previous centroid.
+        centroids[filled] = sums[filled]
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    """
+    Persistent inverted-file (IVF) index over unit-norm embeddings, in pure NumPy.
+
+    Rows are append-only: re-adding a path supersedes its previous row and
+    removing a path appends a tombstone, so every change is a cheap append
+    to the files in `directory`. Until MIN_TRAIN_SIZE vectors are present
+    queries are exact scans; after that the vectors are clustered with
+    spherical k-means and a query only scores the `nprobe` closest lists,
+    plus the short tail of rows added since the lists were last packed.
+    Training, repacking and compaction (rewriting the files without dead
+    rows once they pile up) run on a background thread.
+
+    Vectors live in a VectorFile (float32, float16 or int8, memory-mapped);
+    the dtype is fixed when the index is created and recorded in meta.json.
+    """
+
+    def __init__(self, directory: str, dim: int, dtype: str = VECTOR_DTYPE):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.dim = dim
+        self._lock = threading.RLock()
+        self._busy = False
+        self._n = 0
+        self._assign = np.empty(0, dtype=np.int32)
+        self._live = np.empty(0, dtype=bool)
+        self.paths: List[str] = []
+        self.latest = {}
+        self.centroids: Optional[np.ndarray] = None
+        self.trained_size = 0
+        self._packed_rows = np.empty(0, dtype=np.int64)
+        self._packed_codes = None
+        self._packed_scales = None
+        self._bounds = None
+        self._pack_n = 0
+        self._load(dtype)
+
+    # --- persistence -----------------------------------------------------
+
+    def _file(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self, dtype: str):
+        if os.path.exists(self._file(_COMPACT_MARKER)):
+            # Interrupted mid-swap: the files may not belong together. The
+            # index is derived from the embedding cache, so start over.
+            print(f"[ann] Index at {self.directory} was left mid-compaction; rebuilding it.")
+            for name in os.listdir(self.directory):
+                os.remove(self._file(name))
+        meta_path = self._file("meta.json")
+        if not os.path.exists(meta_path):
+            self.dtype = dtype
+            self._store = VectorFile(self.directory, self.dim, dtype)
+            self._write_meta()
+            return
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("dim") != self.dim:
+            raise ValueError(f"ANN index at {self.directory} has dim {meta.get('dim')}, expected {self.dim}")
+        self.trained_size = meta.get("trainedSize", 0)
+        # Indexes written before compact storage existed are float32.
+        self.dtype = meta.get("dtype", "float32")
+        self._store = VectorFile(self.directory, self.dim, self.dtype)
+        if self.dtype != dtype:
+            print(f"[ann] Index at {self.directory} stores {self.dtype}; keeping it (requested {dtype}).")
+
+        paths_file = self._file("paths.jsonl")
+        paths = []
+        if os.path.exists(paths_file):
+            with open(paths_file) as f:
+                paths = [json.loads(line) for line in f]
+        assign_file = self._file("assign.i32")
+        assign = np.fromfile(assign_file, dtype=np.int32) if os.path.exists(assign_file) else np.empty(0, np.int32)
+        # A crash mid-append can leave the files at different lengths.
+        n = min(len(paths), len(self._store), len(assign))
+        self._store.truncate(n)
+        self._replay(paths[:n], assign[:n])
+        if os.path.exists(self._file("centroids.npy")):
+            self.centroids = np.load(self._file("centroids.npy"))
+            self._set_pack(n, *_pack(self._assign[:n], self._live[:n], self._store, len(self.centroids)))
+
+    def _replay(self, paths: List[str], assign: np.ndarray):
+        """Rebuilds the row state from the files: each path's last row is live unless it is a tombstone."""
+        n = len(paths)
+        self._assign = np.empty(0, dtype=np.int32)
+        self._live = np.empty(0, dtype=bool)
+        self._reserve(n)
+        self._assign[:n] = assign
+        self.paths = list(paths)
+        self._n = n
+        self.latest = {}
+        for row, path in enumerate(self.paths):
+            old = self.latest.pop(path, None)
+            if old is not None:
+                self._live[old] = False
+            if self._assign[row] != _TOMBSTONE:
+                self.latest[path] = row
+                self._live[row] = True
+
+    def _write_meta(self):
+        with open(self._file("meta.json"), "w") as f:
+            json.dump({"dim": self.dim, "dtype": self.dtype, "trainedSize": self.trained_size}, f)
+
+    def _append_files(self, paths, vectors, assign):
+        with open(self._file("paths.jsonl"), "a") as f:
+            f.writelines(json.dumps(p) + "\n" for p in paths)
+        self._store.append(vectors)
+        with open(self._file("assign.i32"), "ab") as f:
+            f.write(np.ascontiguousarray(assign, dtype=np.int32).tobytes())
+
+    def _save_training(self):
+        np.save(self._file("centroids.npy"), self.centroids)
+        self._assign[: self._n].tofile(self._file("assign.i32"))
+        self._write_meta()
+
+    # --- mutation --------------------------------------------------------
+
+    def _reserve(self, n):
+        if n <= len(self._assign):
+            return
+        cap = max(n, 2 * len(self._assign), 1024)
+        for name, fill in (("_assign", _UNASSIGNED), ("_live", False)):
+            old = getattr(self, name)
+            new = np.full((cap,) + old.shape[1:], fill, dtype=old.dtype)
+            new[: len(old)] = old
+            setattr(self, name, new)
+
+    def _set_pack(self, pack_n, rows, codes, scales, bounds):
+        self._pack_n = pack_n
+        self._packed_rows, self._bounds = rows, bounds
+        self._packed_codes, self._packed_scales = codes, scales
+
+    def add(self, paths: List[str], vectors: np.ndarray) -> None:
+        """Adds or replaces the vectors for `paths` (rows must be unit-norm)."""
+        if not len(paths):
+            return
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(paths), self.dim)
+        with self._lock:
+            if self.centroids is not None:
+                assign = _nearest(vectors, self.centroids)
+            else:
+                assign = np.full(len(paths), _UNASSIGNED, dtype=np.int32)
+            start = self._n
+            self._reserve(start + len(paths))
+            self._assign[start : start + len(paths)] = assign
+            for i, path in enumerate(paths):
+                row = start + i
+                old = self.latest.get(path)
+                if old is not None:
+                    self._live[old] = False
+                self.latest[path] = row
+                self._live[row] = True
+            self.paths.extend(paths)
+            self._n += len(paths)
+            self._append_files(paths, vectors, assign)
+        self._maybe_train()
+
+    def remove(self, paths: Iterable[str]) -> None:
+        """Drops `paths` from query results."""
+        with self._lock:
+            gone = [p for p in paths if p in self.latest]
+            if not gone:
+                return
+            for p in gone:
+                self._live[self.latest.pop(p)] = False
+            start = self._n
+            self._reserve(start + len(gone))
+            self._assign[start : start + len(gone)] = _TOMBSTONE
+            self.paths.extend(gone)
+            self._n += len(gone)
+            self._append_files(gone, np.zeros((len(gone), self.dim), np.float32),
+                               np.full(len(gone), _TOMBSTONE, np.int32))
+        self._maybe_train()
+
+    def rename(self, pairs: List[Tuple[str, str]]) -> None:
+        """Moves the vectors of old paths to new ones (files renamed on disk)."""
+        with self._lock:
+            pairs = [(old, new) for old, new in pairs if old in self.latest]
+            if not pairs:
+                return
+            vectors = self._store.take_float(np.array([self.latest[old] for old, _ in pairs]))
+            self.remove([old for old, _ in pairs])
+            self.add([new for _, new in pairs], vectors)
+
+    def missing(self, paths: Iterable[str]) -> List[str]:
+        with self._lock:
+            return [p for p in paths if p not in self.latest]
+
+    def __len__(self):
+        return len(self.latest)
+
+    # --- training --------------------------------------------------------
+
+    def _maybe_train(self):
+        with self._lock:
+            if self._busy:
+                return
+            size = len(self.latest)
+            if self.centroids is None and size >= MIN_TRAIN_SIZE:
+                job = self.train
+            elif self.centroids is not None and size >= RETRAIN_GROWTH * self.trained_size:
+                job = self.train
+            elif self._n - size > max(COMPACT_MIN_DEAD, COMPACT_DEAD_FRACTION * size):
+                job = self.compact
+            elif self.centroids is None:
+                job = None
+            elif self._n - self._pack_n > max(PACK_MIN_TAIL, PACK_TAIL_FRACTION * len(self._packed_rows)):
+                job = self.repack
+            else:
+                job = None
+            if job is None:
+                return
+            self._busy = True
+
+        def run():
+            try:
+                job()
+            finally:
+                self._busy = False
+
+        threading.Thread(target=run, daemon=True, name="ann-train").start()
+
+    def repack(self) -> None:
+        """Folds the exactly-scanned tail into the packed lists."""
+        with self._lock:
+            n, centroids = self._n, self.centroids
+            assign, live = self._assign[:n].copy(), self._live[:n].copy()
+        if centroids is None:
+            return
+        packed = _pack(assign, live, self._store, len(centroids))
+        with self._lock:
+            if self.centroids is centroids:
+                self._set_pack(n, *packed)
+
+    def compact(self) -> None:
+        """
+        Rewrites the files with only the live rows, dropping tombstones and
+        superseded rows. Rows appended while the live ones are copied are
+        carried over as they are (the next compaction drops what died).
+        """
+        with self._lock:
+            n = self._n
+            keep = np.flatnonzero(self._live[:n])
+        # The bulk copy runs unlocked; rows < n are never rewritten.
+        self._store.export(keep, _COMPACT_SUFFIX)
+        with self._lock:
+            total = self._n
+            rows = np.concatenate([keep, np.arange(n, total)])
+            self._store.export(rows[len(keep) :], _COMPACT_SUFFIX, append=True)
+            paths = [self.paths[r] for r in rows]
+            assign = self._assign[rows]
+            with open(self._file("paths.jsonl" + _COMPACT_SUFFIX), "w") as f:
+                f.writelines(json.dumps(p) + "\n" for p in paths)
+            assign.tofile(self._file("assign.i32" + _COMPACT_SUFFIX))
+            open(self._file(_COMPACT_MARKER), "w").close()
+            os.replace(self._file("paths.jsonl" + _COMPACT_SUFFIX), self._file("paths.jsonl"))
+            os.replace(self._file("assign.i32" + _COMPACT_SUFFIX), self._file("assign.i32"))
+            self._store.replace_from(_COMPACT_SUFFIX)
+            os.remove(self._file(_COMPACT_MARKER))
+            # Searches already running keep the arrays and views they took.
+            self._replay(paths, assign)
+            if self.centroids is not None:
+                # Row numbers changed: scan everything exactly until repacked below.
+                codes, scales = self._store.view()
+                self._set_pack(0, np.empty(0, dtype=np.int64), codes[:0], None if scales is None else scales[:0],
+                               np.zeros(len(self.centroids) + 1, dtype=np.int64))
+        print(f"[ann] Compacted {total} rows to {len(rows)}.")
+        if self.centroids is not None:
+            self.repack()
+
+    def train(self, nlist: Optional[int] = None) -> None:
+        """(Re)clusters all live vectors and reassigns every row to a list."""
+        with self._lock:
+            n = self._n
+            live = self._live[:n].copy()
+            tomb = self._assign[:n] == _TOMBSTONE
+        # Rows < n are never rewritten, and the store serializes its own
+        # appends and views, so it can be read without the index lock.
+        live_rows = np.flatnonzero(live)
+        if len(live_rows) == 0:
+            return
+        nlist = nlist or int(np.clip(np.sqrt(len(live_rows)), 1, MAX_LISTS))
+        rng = np.random.default_rng(0)
+        sample = rng.choice(live_rows, min(len(live_rows), nlist * KMEANS_SAMPLE_PER_LIST), replace=False)
+        nlist = min(nlist, len(sample))
+        centroids = train_centroids(self._store.take_float(np.sort(sample)), nlist)
+        assign = _nearest_stored(self._store, 0, n, centroids)
+        assign[tomb] = _TOMBSTONE
+        packed = _pack(assign, live, self._store, nlist)
+
+        with self._lock:
+            # Rows appended while k-means ran stay in the exactly-scanned tail.
+            tail = _nearest_stored(self._store, n, self._n, centroids)
+            tail[self._assign[n : self._n] == _TOMBSTONE] = _TOMBSTONE
+            self._assign[:n] = assign
+            self._assign[n : self._n] = tail
+            self.centroids = centroids
+            self.trained_size = len(live_rows)
+            self._set_pack(n, *packed)
+            self._save_training()
+        print(f"[ann] Trained {nlist} lists over {len(live_rows)} vectors.")
+
+    # --- queries ---------------------------------------------------------
+
+    def search(self, query: np.ndarray, k: int = 50, nprobe: int = DEFAULT_NPROBE,
+               exact: bool = False) -> Tuple[List[str], np.ndarray, int]:
+        """
+        Returns (paths, scores, candidates) for the k rows with the highest
+        dot product with `query`; `candidates` is how many rows were scored.
+        """
+        query = np.asarray(query, dtype=np.float32).reshape(self.dim)
+        with self._lock:
+            n, pack_n = self._n, self._pack_n
+            live, paths = self._live[:n].copy(), self.paths
+            codes, scales = self._store.view()
+            centroids, bounds = self.centroids, self._bounds
+            packed_rows, packed_codes, packed_scales = self._packed_rows, self._packed_codes, self._packed_scales
+        if exact or centroids is None:
+            scores = compact_dot(codes[:n], None if scales is None else scales[:n], query)
+            scores[~live] = -np.inf
+            cand_rows = np.arange(n)
+            scored = int(live.sum())
+        else:
+            probe = np.argsort(-(centroids @ query))[:nprobe]
+            tail_scales = None if scales is None else scales[pack_n:n]
+            row_parts = [np.arange(pack_n, n)]
+            score_parts = [compact_dot(codes[pack_n:n], tail_scales, query)]
+            for l in probe:
+                a, b = bounds[l], bounds[l + 1]
+                row_parts.append(packed_rows[a:b])
+                score_parts.append(compact_dot(
+                    packed_codes[a:b], None if packed_scales is None else packed_scales[a:b], query
+                ))
+            cand_rows, scores = np.concatenate(row_parts), np.concatenate(score_parts)
+            keep = live[cand_rows]
+            cand_rows, scores = cand_rows[keep], scores[keep]
+            scored = len(cand_rows)
+        k = min(k, scored)
+        if k <= 0:
+            return [], np.empty(0, np.float32), scored
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [paths[cand_rows[i]] for i in top], scores[top], scored
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "vectors": len(self.latest),
+                "rows": self._n,
+                "lists": 0 if self.centroids is None else len(self.centroids),
+                "trainedSize": self.trained_size,
+                "tail": self._n - self._pack_n if self.centroids is not None else 0,
+                "dtype": self.dtype,
+                "vectorBytes": self._store.nbytes,
+                "training": self._busy,
+            }
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Recall-vs-latency benchmark for the IVF library index against exact scoring.
+
+By default it builds a throwaway index over synthetic clustered unit vectors
+(CLIP embeddings are strongly clustered, uniform noise is not); pass
+--index-dir to query an existing index under .cache/ann/ instead, with
+queries drawn from its own vectors.
+
+    python benchmarks/bench_ann.py --size 200000 --nprobe 4 8 16 32 64
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ann_index import IVFIndex  # noqa: E402
+
+
+def synthetic_vectors(n, dim, clusters, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    x = centers[rng.integers(0, clusters, n)] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--index-dir", help="existing index directory to benchmark")
+    ap.add_argument("--size", type=int, default=200000)
+    ap.add_argument("--dim", type=int, default=512)
+    ap.add_argument("--clusters", type=int, default=500)
+    ap.add_argument("--queries", type=int, default=100)
+    ap.add_argument("--k", type=int, default=50)
+    ap.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32, 64])
+    ap.add_argument("--dtype", default="float16", choices=["float32", "float16", "int8"],
+                    help="vector storage for a synthetic index")
+    args = ap.parse_args()
+
+    rng = np.random.default_rng(1)
+    if args.index_dir:
+        dims = np.load(os.path.join(args.index_dir, "centroids.npy")).shape[1] if os.path.exists(
+            os.path.join(args.index_dir, "centroids.npy")) else args.dim
+        index = IVFIndex(args.index_dir, dims)
+    else:
+        tmp = tempfile.mkdtemp(prefix="bench_ann_")
+        index = IVFIndex(tmp, args.dim, dtype=args.dtype)
+        x = synthetic_vectors(args.size, args.dim, args.clusters)
+        start = time.perf_counter()
+        for i in range(0, len(x), 50000):
+            index.add([f"img{j}" for j in range(i, min(i + 50000, len(x)))], x[i : i + 50000])
+        print(f"added {len(x)} vectors in {time.perf_counter() - start:.1f}s")
+    if index.centroids is None:
+        start = time.perf_counter()
+        index.train()
+        print(f"trained {len(index.centroids)} lists in {time.perf_counter() - start:.1f}s")
+
+    live = np.flatnonzero(index._live[: index._n])
+    qrows = rng.choice(live, args.queries, replace=False)
+    # Perturb stored vectors so queries are near, but not equal to, an item.
+    q = index._store.take_float(np.sort(qrows)) + 0.3 * rng.standard_normal((args.queries, index.dim)).astype(np.float32)
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+
+    truth, exact_t = [], []
+    for v in q:
+        start = time.perf_counter()
+        paths, _, _ = index.search(v, args.k, exact=True)
+        exact_t.append(time.perf_counter() - start)
+        truth.append(set(paths))
+    print(f"library {len(index)} vectors ({index.dtype}), {len(index.centroids)} lists, k={args.k}")
+    print(f"{'nprobe':>8} {'recall':>8} {'p50 ms':>8} {'p95 ms':>8} {'scored':>9}")
+    print(f"{'exact':>8} {1.0:8.3f} {1000 * np.median(exact_t):8.2f} "
+          f"{1000 * np.percentile(exact_t, 95):8.2f} {len(index):9d}")
+    for nprobe in args.nprobe:
+        times, recalls, scored = [], [], []
+        for v, t in zip(q, truth):
+            start = time.perf_counter()
+            paths, _, cand = index.search(v, args.k, nprobe=nprobe)
+            times.append(time.perf_counter() - start)
+            recalls.append(len(t & set(paths)) / len(t))
+            scored.append(cand)
+        print(f"{nprobe:8d} {np.mean(recalls):8.3f} {1000 * np.median(times):8.2f} "
+              f"{1000 * np.percentile(times, 95):8.2f} {int(np.mean(scored)):9d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Ranking fidelity, memory and scan speed of compact vector storage.
+
+Stores the same vectors as float32, float16 and int8 (see compact_vectors.py)
+and, for a batch of queries, compares each compact ranking with the float32
+one: overlap of the top-k, the largest score error, and how many of the
+float32 top-k moved out of their exact position.
+
+    python benchmarks/bench_compact.py --size 200000 --k 50
+    python benchmarks/bench_compact.py --index-dir .cache/ann/ViT-B-32_openai
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from compact_vectors import VectorFile  # noqa: E402
+from bench_ann import synthetic_vectors  # noqa: E402
+
+
+def load_index_vectors(directory):
+    import json
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+    store = VectorFile(directory, meta["dim"], meta.get("dtype", "float32"))
+    return np.concatenate(list(store.iter_float(0, len(store)))) if len(store) else np.empty((0, meta["dim"]))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--index-dir", help="take vectors from an existing ANN index")
+    ap.add_argument("--size", type=int, default=200000)
+    ap.add_argument("--dim", type=int, default=512)
+    ap.add_argument("--clusters", type=int, default=500)
+    ap.add_argument("--queries", type=int, default=50)
+    ap.add_argument("--k", type=int, default=50)
+    args = ap.parse_args()
+
+    if args.index_dir:
+        x = load_index_vectors(args.index_dir)
+        x = x[np.linalg.norm(x, axis=1) > 0]  # drop tombstone rows
+    else:
+        x = synthetic_vectors(args.size, args.dim, args.clusters)
+    rng = np.random.default_rng(1)
+    q = x[rng.choice(len(x), args.queries, replace=False)] + 0.3 * rng.standard_normal(
+        (args.queries, x.shape[1])).astype(np.float32)
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+
+    tmp = tempfile.mkdtemp(prefix="bench_compact_")
+    stores = {}
+    for dtype in ("float32", "float16", "int8"):
+        d = os.path.join(tmp, dtype)
+        os.makedirs(d)
+        stores[dtype] = VectorFile(d, x.shape[1], dtype)
+        stores[dtype].append(x)
+
+    exact = [stores["float32"].dot(v) for v in q]
+    exact_top = [np.argsort(-s)[: args.k] for s in exact]
+    print(f"{len(x)} vectors x {x.shape[1]} dims, {args.queries} queries, k={args.k}")
+    print(f"{'dtype':>8} {'MB':>8} {'scan ms':>8} {'overlap':>8} {'same pos':>8} {'max err':>9}")
+    for dtype, store in stores.items():
+        times, overlap, same, err = [], [], [], []
+        for v, s_ref, top in zip(q, exact, exact_top):
+            start = time.perf_counter()
+            s = store.dot(v)
+            times.append(time.perf_counter() - start)
+            mine = np.argsort(-s)[: args.k]
+            overlap.append(len(set(mine) & set(top)) / args.k)
+            same.append(np.mean(mine == top))
+            err.append(np.abs(s - s_ref).max())
+        print(f"{dtype:>8} {store.nbytes / 2**20:8.1f} {1000 * np.median(times):8.2f} "
+              f"{np.mean(overlap):8.3f} {np.mean(same):8.3f} {np.max(err):9.2e}")
+
+
+if __name__ == "__main__":
+    main()
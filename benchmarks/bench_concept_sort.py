@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Latency and agreement of the two /concept-sort modes.
+
+Posts the same folder and concept to a running unified server once with
+mode="embedding" (CLIP axis projection) and once with mode="llm" (BLIP-2
+captions ranked by the LLM, forwarded to embed_sorter_server.py; needs
+SORTER_LLM_SORTER_URL set on the server). Reports each mode's latency over
+--repeat runs (the first run is shown separately since it fills the caches)
+and the Spearman rho and Kendall tau between the two orders.
+
+    python benchmarks/bench_concept_sort.py /path/to/photos \\
+        --dimension brightness --start dark --end bright --limit 200
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from indexing import list_folder_images  # noqa: E402
+
+
+def post(url, payload):
+    req = urllib.request.Request(url, data=json.dumps(payload).encode(),
+                                 headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    with urllib.request.urlopen(req) as resp:
+        body = json.load(resp)
+    return body, time.perf_counter() - start
+
+
+def ranks(order, paths):
+    pos = {os.path.abspath(p): i for i, p in enumerate(order)}
+    return np.array([pos[os.path.abspath(p)] for p in paths], dtype=float)
+
+
+def spearman(a, b):
+    a, b = a - a.mean(), b - b.mean()
+    return float((a * b).sum() / np.sqrt((a * a).sum() * (b * b).sum()))
+
+
+def kendall(a, b):
+    sa = np.sign(a[:, None] - a[None, :])
+    sb = np.sign(b[:, None] - b[None, :])
+    n = len(a)
+    return float((sa * sb).sum() / (n * (n - 1))) if n > 1 else 1.0
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("folder")
+    ap.add_argument("--url", default="http://127.0.0.1:8000")
+    ap.add_argument("--dimension", default="brightness")
+    ap.add_argument("--start", default="dark")
+    ap.add_argument("--end", default="bright")
+    ap.add_argument("--limit", type=int, default=200)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--model", default=None)
+    ap.add_argument("--modes", nargs="+", default=["embedding", "llm"], choices=["embedding", "llm"])
+    args = ap.parse_args()
+
+    paths = [os.path.abspath(p) for p in list_folder_images(args.folder)[: args.limit]]
+    if not paths:
+        sys.exit(f"No images found in {args.folder}")
+    payload = {"imagePaths": paths, "dimension": args.dimension,
+               "orderStart": args.start, "orderEnd": args.end, "model": args.model}
+
+    orders = {}
+    print(f"{len(paths)} images, {args.dimension}: {args.start} -> {args.end}")
+    print(f"{'mode':>10} {'first s':>9} {'median s':>9} {'img/s':>8}")
+    for mode in args.modes:
+        times = []
+        try:
+            for _ in range(max(1, args.repeat)):
+                body, elapsed = post(f"{args.url.rstrip('/')}/concept-sort", dict(payload, mode=mode))
+                times.append(elapsed)
+        except urllib.error.HTTPError as e:
+            print(f"{mode:>10} failed: {e.code} {e.read().decode(errors='replace')}")
+            continue
+        orders[mode] = body["sortedPaths"]
+        warm = statistics.median(times[1:]) if len(times) > 1 else times[0]
+        print(f"{mode:>10} {times[0]:9.2f} {warm:9.3f} {len(paths) / warm:8.1f}")
+
+    if len(orders) == 2:
+        a, b = (ranks(orders[m], paths) for m in args.modes)
+        print(f"agreement: spearman {spearman(a, b):.3f}, kendall {kendall(a, b):.3f}")
+
+
+if __name__ == "__main__":
+    main()
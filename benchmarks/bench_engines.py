@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Throughput and ranking agreement of the CLIP inference engines.
+
+Embeds the same preprocessed images with every engine (eager, TorchScript,
+ONNX Runtime; each with and without dynamic int8 quantization) and reports
+images/second, the mean cosine between each engine's image embeddings and
+eager float32, and how well each engine's ranking for a set of prompts
+agrees with eager float32 (Spearman rho and top-k overlap).
+
+    python benchmarks/bench_engines.py /path/to/photos --limit 256 --threads 4
+"""
+import argparse
+import os
+import sys
+import time
+
+import open_clip
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from clip_engines import ENGINES, build_engine  # noqa: E402
+from image_pipeline import load_image  # noqa: E402
+from indexing import list_folder_images  # noqa: E402
+
+PROMPTS = ["a photo of a dog", "a sunset over the sea", "red to blue", "a crowded city street"]
+
+
+def spearman(a, b):
+    ra = torch.argsort(torch.argsort(a)).float()
+    rb = torch.argsort(torch.argsort(b)).float()
+    ra, rb = ra - ra.mean(), rb - rb.mean()
+    return float((ra * rb).sum() / (ra.norm() * rb.norm()))
+
+
+def embed(engine, images, batch_size):
+    start = time.perf_counter()
+    out = torch.cat([engine.encode_image(images[i : i + batch_size]) for i in range(0, len(images), batch_size)])
+    return out.float().cpu(), time.perf_counter() - start
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("folder")
+    ap.add_argument("--limit", type=int, default=256)
+    ap.add_argument("--batch-size", type=int, default=32)
+    ap.add_argument("--threads", type=int, default=0)
+    ap.add_argument("--k", type=int, default=20)
+    ap.add_argument("--engines", nargs="+", default=list(ENGINES), choices=ENGINES)
+    ap.add_argument("--model", default="ViT-B-32")
+    ap.add_argument("--pretrained", default="openai")
+    args = ap.parse_args()
+
+    paths = list_folder_images(args.folder)[: args.limit]
+    if not paths:
+        sys.exit(f"No images found in {args.folder}")
+    model, _, preprocess = open_clip.create_model_and_transforms(args.model, pretrained=args.pretrained)
+    model.eval()
+    tag = f"{args.model}/{args.pretrained}"
+    images = torch.stack([preprocess(load_image(p)) for p in paths])
+    tokens = open_clip.get_tokenizer(args.model)(PROMPTS)
+    device = torch.device("cpu")
+    k = min(args.k, len(paths))
+
+    results = []
+    for name in args.engines:
+        for quantize in (False, True):
+            try:
+                engine = build_engine(model, device, name, quantize, args.threads, model_tag=tag)
+            except Exception as e:
+                print(f"skipping {name}{' int8' if quantize else ''}: {e}")
+                continue
+            embed(engine, images[: args.batch_size], args.batch_size)  # warm-up
+            img, elapsed = embed(engine, images, args.batch_size)
+            txt = engine.encode_text(tokens).float().cpu()
+            results.append((name + (" int8" if quantize else ""), img, txt, len(paths) / elapsed))
+
+    ref_img, ref_txt = results[0][1], results[0][2]
+    ref_scores = ref_img @ ref_txt.T
+    print(f"{len(paths)} images, batch {args.batch_size}, threads {torch.get_num_threads()}, "
+          f"{len(PROMPTS)} prompts, k={k}; agreement is against {results[0][0]}")
+    print(f"{'engine':>18} {'img/s':>8} {'cosine':>8} {'rho':>8} {'top-k':>8}")
+    for label, img, txt, rate in results:
+        scores = img @ txt.T
+        cosine = float((img * ref_img).sum(-1).mean())
+        rho = sum(spearman(scores[:, j], ref_scores[:, j]) for j in range(len(PROMPTS))) / len(PROMPTS)
+        overlap = 0.0
+        for j in range(len(PROMPTS)):
+            mine = set(torch.topk(scores[:, j], k).indices.tolist())
+            ref = set(torch.topk(ref_scores[:, j], k).indices.tolist())
+            overlap += len(mine & ref) / k
+        print(f"{label:>18} {rate:8.1f} {cosine:8.5f} {rho:8.4f} {overlap / len(PROMPTS):8.3f}")
+
+
+if __name__ == "__main__":
+    main()
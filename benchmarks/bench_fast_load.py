@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Compares full-resolution decoding with the fast loader (JPEG draft mode,
+EXIF thumbnails, Image.reduce) in front of the CLIP transform.
+
+Reports load+preprocess throughput for both paths, end-to-end embedding
+throughput, and the cosine similarity between the two sets of embeddings.
+
+    python benchmarks/bench_fast_load.py /path/to/photos --limit 200
+"""
+import argparse
+import os
+import sys
+import time
+
+import open_clip
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from image_pipeline import load_image, load_image_fast, FAST_LOAD_MIN_SIDE  # noqa: E402
+from indexing import list_folder_images  # noqa: E402
+
+
+def time_preprocess(paths, loader, preprocess):
+    start = time.perf_counter()
+    tensors = [preprocess(loader(p)) for p in paths]
+    return torch.stack(tensors), time.perf_counter() - start
+
+
+def embed(model, batch, batch_size):
+    embs = []
+    with torch.no_grad():
+        for i in range(0, len(batch), batch_size):
+            e = model.encode_image(batch[i : i + batch_size])
+            embs.append(e / e.norm(dim=-1, keepdim=True))
+    return torch.cat(embs)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("folder")
+    ap.add_argument("--limit", type=int, default=200)
+    ap.add_argument("--min-side", type=int, default=FAST_LOAD_MIN_SIDE)
+    ap.add_argument("--batch-size", type=int, default=16)
+    ap.add_argument("--model", default="ViT-B-32")
+    ap.add_argument("--pretrained", default="openai")
+    args = ap.parse_args()
+
+    paths = list_folder_images(args.folder)[: args.limit]
+    if not paths:
+        sys.exit(f"No images found in {args.folder}")
+
+    model, _, preprocess = open_clip.create_model_and_transforms(args.model, pretrained=args.pretrained)
+    model.eval()
+
+    full_x, full_t = time_preprocess(paths, load_image, preprocess)
+    fast_x, fast_t = time_preprocess(paths, lambda p: load_image_fast(p, args.min_side), preprocess)
+
+    start = time.perf_counter()
+    full_e = embed(model, full_x, args.batch_size)
+    encode_t = time.perf_counter() - start
+    fast_e = embed(model, fast_x, args.batch_size)
+
+    cos = (full_e * fast_e).sum(dim=-1)
+    n = len(paths)
+    print(f"images:                 {n}  (min side {args.min_side})")
+    print(f"full decode+preprocess: {n / full_t:8.1f} img/s")
+    print(f"fast decode+preprocess: {n / fast_t:8.1f} img/s  ({full_t / fast_t:.2f}x)")
+    print(f"end-to-end full:        {n / (full_t + encode_t):8.1f} img/s")
+    print(f"end-to-end fast:        {n / (fast_t + encode_t):8.1f} img/s")
+    print(f"cosine(full, fast):     mean {cos.mean():.5f}  min {cos.min():.5f}")
+
+
+if __name__ == "__main__":
+    main()
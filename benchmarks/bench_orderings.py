@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Latency and quality of the prompt-free orderings in orderings.py.
+
+Runs every mode over synthetic clustered unit vectors (bursts of similar
+shots around random scene centres) at several library sizes and reports
+seconds per ordering and the mean cosine between neighbouring images in
+the result; higher means smoother "visual flow". Use --embeddings to load
+real vectors from a .npy file instead.
+
+    python benchmarks/bench_orderings.py --sizes 1000 10000 50000 --dim 512
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from orderings import ORDER_MODES, order_embeddings  # noqa: E402
+
+
+def synthetic(n, dim, burst, noise, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(max(1, n // burst), dim))
+    x = centres[rng.integers(0, len(centres), n)] + noise * rng.normal(size=(n, dim))
+    return (x / np.linalg.norm(x, axis=1, keepdims=True)).astype(np.float32)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 20000])
+    ap.add_argument("--dim", type=int, default=512)
+    ap.add_argument("--burst", type=int, default=20, help="images per synthetic scene")
+    ap.add_argument("--noise", type=float, default=0.3)
+    ap.add_argument("--embeddings", help=".npy of unit-norm rows; --sizes then takes prefixes")
+    ap.add_argument("--modes", nargs="+", default=list(ORDER_MODES), choices=ORDER_MODES)
+    args = ap.parse_args()
+
+    data = np.load(args.embeddings).astype(np.float32) if args.embeddings else None
+    print(f"{'n':>8} {'mode':>8} {'sec':>8} {'adj cos':>8}")
+    for n in args.sizes:
+        x = data[:n] if data is not None else synthetic(n, args.dim, args.burst, args.noise)
+        baseline = float((x[:-1] * x[1:]).sum(1).mean())
+        print(f"{len(x):8d} {'input':>8} {'':>8} {baseline:8.3f}")
+        for mode in args.modes:
+            start = time.perf_counter()
+            order = order_embeddings(x, mode)["order"]
+            elapsed = time.perf_counter() - start
+            adjacent = float((x[order[:-1]] * x[order[1:]]).sum(1).mean())
+            print(f"{len(x):8d} {mode:>8} {elapsed:8.3f} {adjacent:8.3f}")
+
+
+if __name__ == "__main__":
+    main()
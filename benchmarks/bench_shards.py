@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Scaling of multi-process image embedding (sharded_encoder.py) on CPU.
+
+Encodes the same images in-process (one process, all cores as intra-op
+threads, the path SORTER_EMBED_PROCESSES=0 takes) and then with 1..N worker
+processes of cores/N threads each. For every process count it reports
+images/second, speedup and parallel efficiency against one process, whether
+the embeddings match the in-process ones row for row (input order kept),
+and the workers' memory: proportional set size and how much of it is
+shared, clean pages (the memory-mapped weights).
+
+    python benchmarks/bench_shards.py --count 512 --processes 1 2 4 8
+    python benchmarks/bench_shards.py --folder /path/to/photos --model ViT-B-16/openai
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from clip_engines import build_engine  # noqa: E402
+from image_pipeline import iter_preprocessed_batches  # noqa: E402
+from indexing import list_folder_images  # noqa: E402
+from model_registry import DEFAULT_MODEL, load_clip_model, split_tag  # noqa: E402
+from sharded_encoder import ShardedImageEncoder  # noqa: E402
+from synthetic_images import make_dataset  # noqa: E402
+
+
+def smaps_mb(pid):
+    """(Pss, Shared_Clean) of a process in MB, from /proc (Linux only)."""
+    out = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("Pss", "Shared_Clean"):
+                    out[key] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return out.get("Pss", float("nan")), out.get("Shared_Clean", float("nan"))
+
+
+def in_process(tag, paths, batch_size, threads):
+    torch.set_num_threads(threads)
+    model, preprocess = load_clip_model(*split_tag(tag))
+    engine = build_engine(model.eval(), torch.device("cpu"), threads=threads, model_tag=tag)
+    start = time.perf_counter()
+    embs = torch.cat([engine.encode_image(t) for _, t in iter_preprocessed_batches(paths, preprocess, batch_size)])
+    return embs.float().numpy(), time.perf_counter() - start
+
+
+def sharded(tag, paths, batch_size, processes, cores, timeout):
+    pool = ShardedImageEncoder(tag, processes, threads=max(1, cores // processes), min_images=1)
+    try:
+        deadline = time.monotonic() + timeout
+        while pool.ready < processes:
+            if pool.broken or time.monotonic() > deadline:
+                raise SystemExit(f"workers did not start: {pool.broken or 'timeout'}")
+            time.sleep(0.1)
+        pool.encode(paths[: processes * batch_size], batch_size)  # warm-up
+        start = time.perf_counter()
+        embs = pool.encode(paths, batch_size)
+        elapsed = time.perf_counter() - start
+        memory = [smaps_mb(p.pid) for p in pool._procs]
+        return embs, elapsed, memory
+    finally:
+        pool.close()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--folder", help="images to encode (default: a synthetic folder)")
+    ap.add_argument("--count", type=int, default=512, help="synthetic images when no --folder")
+    ap.add_argument("--model", default=DEFAULT_MODEL)
+    ap.add_argument("--processes", type=int, nargs="+", help="default: 1, 2, 4 .. cores")
+    ap.add_argument("--cores", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--batch-size", type=int, default=16)
+    ap.add_argument("--timeout", type=float, default=300, help="seconds to wait for workers to load")
+    args = ap.parse_args()
+
+    if args.folder:
+        paths = list_folder_images(args.folder)
+    else:
+        folder = os.path.join(tempfile.gettempdir(), f"sorter-bench-shards-{args.count}")
+        paths = make_dataset(folder, args.count, resolution=(1024, 768))
+    counts = args.processes or sorted({2 ** k for k in range(args.cores.bit_length()) if 2 ** k <= args.cores}
+                                      | {args.cores})
+
+    reference, base_s = in_process(args.model, paths, args.batch_size, args.cores)
+    print(f"{len(paths)} images, {args.model}, {args.cores} cores, batch {args.batch_size}")
+    print(f"{'procs':>5} {'threads':>7} {'img/s':>8} {'speedup':>7} {'eff':>5} {'match':>5} "
+          f"{'pss_mb':>8} {'shared_mb':>9}")
+    print(f"{'in-proc':>5} {args.cores:>7} {len(paths) / base_s:>8.1f} {'':>7} {'':>5} {'':>5}")
+    one = None
+    for n in counts:
+        embs, elapsed, memory = sharded(args.model, paths, args.batch_size, n, args.cores, args.timeout)
+        rate = len(paths) / elapsed
+        one = one or (rate if n == 1 else None)
+        speedup = rate / one if one else float("nan")
+        # Same rows in the same order: each image's vector is nearest its own reference.
+        cos = (torch.from_numpy(embs) * torch.from_numpy(reference)).sum(dim=1)
+        match = embs.shape == reference.shape and bool((cos > 0.999).all())
+        pss = sum(m[0] for m in memory)
+        shared = sum(m[1] for m in memory)
+        print(f"{n:>5} {max(1, args.cores // n):>7} {rate:>8.1f} {speedup:>7.2f} {speedup / n:>5.2f} "
+              f"{str(match):>5} {pss:>8.0f} {shared:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+"""
+Reproducible benchmark suite for the sorting endpoints.
+
+Generates synthetic folders (synthetic_images.py; reused across runs) and
+measures, per folder size and target:
+
+    workloads  sort-by-clip, concept-sort (embedding axis), concept-sort-llm
+               (mode "llm" against a local stub of the BLIP-2/LLM server),
+               and in-process only the embed and sort helpers themselves
+    scenarios  cold        embedding cache invalidated before every run
+               warm        cache filled, one discarded warm-up run
+               concurrent  --concurrency clients at once, --repeat each
+    targets    inprocess   the app through TestClient (no sockets) plus the
+                           helper functions, in this process
+               http        uvicorn in a subprocess, over real HTTP
+
+Each result has latency percentiles, images/sec, requests/sec and the peak
+RSS of the process doing the work (reset per scenario where Linux allows).
+Results go to --output as JSON together with the git commit, versions and
+SORTER_* settings; --compare a previous file to flag p50 regressions (exit
+status 1 when any result is slower than --threshold times its old p50).
+
+Every run starts from an empty cache directory. Model weights are loaded as
+the server normally would (SORTER_MODELS, SORTER_DEFAULT_MODEL, ...).
+
+    python benchmarks/bench_suite.py --sizes 100 1000 --output bench.json
+    python benchmarks/bench_suite.py --sizes 1000 --targets http --compare bench.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from synthetic_images import FORMATS, make_dataset, parse_resolution  # noqa: E402
+
+WORKLOADS = ("sort-by-clip", "concept-sort", "concept-sort-llm", "embed-helper", "sort-helper")
+HELPER_WORKLOADS = ("embed-helper", "sort-helper")
+SCENARIOS = ("cold", "warm", "concurrent")
+PROMPTS = ["a red circle", "a blue square", "dark to bright", "a green background", "many shapes to few shapes",
+           "a yellow object", "warm colours to cool colours", "a purple rectangle"]
+READY_TIMEOUT = 600
+
+
+class StubLLMServer:
+    """Stands in for embed_sorter_server.py's /concept-sort: a fixed pseudo-random order after --llm-delay-ms."""
+
+    def __init__(self, delay_ms: float):
+        delay = delay_ms / 1000.0
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                time.sleep(delay)
+                order = sorted(body["imagePaths"], key=lambda p: hashlib.blake2b(p.encode()).digest())
+                out = json.dumps({"sortedPaths": order}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+
+
+def payload(workload, paths, i):
+    if workload == "sort-by-clip":
+        return "/sort-by-clip", {"imagePaths": paths, "prompt": PROMPTS[i % len(PROMPTS)]}
+    mode = "llm" if workload == "concept-sort-llm" else "embedding"
+    start, end = [("dark", "bright"), ("few shapes", "many shapes"), ("warm", "cool")][i % 3]
+    return "/concept-sort", {"imagePaths": paths, "dimension": "look", "orderStart": start,
+                             "orderEnd": end, "mode": mode}
+
+
+def read_peak_rss_mb(pid):
+    """VmHWM of `pid` (Linux), else this process's ru_maxrss; None when neither is available."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    if pid == os.getpid():
+        try:
+            import resource
+
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return round(peak / (2**20 if sys.platform == "darwin" else 1024), 1)
+        except ImportError:
+            pass
+    return None
+
+
+def reset_peak_rss(pid):
+    """Restarts VmHWM from the current RSS (Linux >= 4.0); elsewhere peaks accumulate over the run."""
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+class InProcessTarget:
+    name = "inprocess"
+
+    def __init__(self, cache_dir, llm_url):
+        os.environ["SORTER_CACHE_DIR"] = cache_dir
+        os.environ["SORTER_LLM_SORTER_URL"] = llm_url
+        import unified_sorter_server
+        from fastapi.testclient import TestClient
+
+        self.server = unified_sorter_server
+        self.client = TestClient(unified_sorter_server.app)
+        self.client.__enter__()
+        self.pid = os.getpid()
+        wait_ready(lambda: self.client.get("/ready").status_code == 200)
+
+    def call(self, workload, paths, i):
+        if workload == "embed-helper":
+            with self.server.MODELS.use() as clip:
+                self.server.get_image_embeddings(clip, paths)
+            return
+        if workload == "sort-helper":
+            self.server.clip_sort_paths(paths, PROMPTS[i % len(PROMPTS)])
+            return
+        path, body = payload(workload, paths, i)
+        r = self.client.post(path, json=body)
+        if r.status_code != 200:
+            raise RuntimeError(f"{path}: {r.status_code} {r.text[:200]}")
+
+    def close(self):
+        self.client.__exit__(None, None, None)
+
+
+class HttpTarget:
+    name = "http"
+
+    def __init__(self, cache_dir, llm_url):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        env = dict(os.environ, SORTER_CACHE_DIR=cache_dir, SORTER_LLM_SORTER_URL=llm_url)
+        self.log = open(os.path.join(cache_dir, "server.log"), "w")
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "unified_sorter_server:app", "--host", "127.0.0.1",
+             "--port", str(port), "--log-level", "warning"],
+            cwd=ROOT, env=env, stdout=self.log, stderr=subprocess.STDOUT,
+        )
+        self.pid = self.proc.pid
+
+        def ready():
+            if self.proc.poll() is not None:
+                with open(self.log.name) as f:
+                    tail = f.read()[-2000:]
+                raise RuntimeError(f"server exited ({self.proc.returncode}):\n{tail}")
+            try:
+                with urllib.request.urlopen(self.url + "/ready") as r:
+                    return r.status == 200
+            except OSError:
+                return False
+
+        wait_ready(ready)
+
+    def call(self, workload, paths, i):
+        path, body = payload(workload, paths, i)
+        req = urllib.request.Request(self.url + path, data=json.dumps(body).encode(),
+                                     headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(req) as r:
+                r.read()
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"{path}: {e.code} {e.read()[:200]!r}")
+
+    def close(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self.log.close()
+
+
+def wait_ready(check):
+    deadline = time.monotonic() + READY_TIMEOUT
+    while not check():
+        if time.monotonic() > deadline:
+            raise RuntimeError("server not ready in time")
+        time.sleep(0.2)
+
+
+def invalidate(paths):
+    """Moves every mtime a second forward so cached embeddings and hashes no longer match (a cold cache)."""
+    for p in paths:
+        st = os.stat(p)
+        os.utime(p, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+
+def summarize(latencies, wall, requests, images):
+    ms = np.array(latencies) * 1000
+    return {
+        "runs": len(latencies),
+        "latencyMs": {
+            "p50": round(float(np.percentile(ms, 50)), 3),
+            "p90": round(float(np.percentile(ms, 90)), 3),
+            "p99": round(float(np.percentile(ms, 99)), 3),
+            "mean": round(float(ms.mean()), 3),
+            "min": round(float(ms.min()), 3),
+            "max": round(float(ms.max()), 3),
+        },
+        "requestsPerSec": round(requests / wall, 3),
+        "imagesPerSec": round(requests * images / wall, 1),
+    }
+
+
+def run_scenario(target, workload, scenario, paths, args, counter):
+    def timed_call(i):
+        start = time.perf_counter()
+        target.call(workload, paths, i)
+        return time.perf_counter() - start
+
+    reset_peak_rss(target.pid)
+    latencies = []
+    wall_start = time.perf_counter()
+    if scenario == "cold":
+        wall = 0.0
+        for _ in range(args.cold_runs):
+            counter[0] += 1
+            invalidate(paths)
+            latencies.append(timed_call(counter[0]))
+            wall += latencies[-1]
+    elif scenario == "warm":
+        timed_call(0)
+        latencies = [timed_call(i) for i in range(args.repeat)]
+        wall = sum(latencies)
+    else:
+        lock = threading.Lock()
+        errors = []
+
+        def client(c):
+            for k in range(args.repeat):
+                try:
+                    t = timed_call(c * args.repeat + k)
+                except Exception as e:
+                    errors.append(e)
+                    return
+                with lock:
+                    latencies.append(t)
+
+        threads = [threading.Thread(target=client, args=(c,)) for c in range(args.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - wall_start
+        if errors:
+            raise errors[0]
+    result = summarize(latencies, wall, len(latencies), len(paths))
+    result["peakRssMB"] = read_peak_rss_mb(target.pid)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=ROOT, capture_output=True, text=True,
+                              timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def metadata(args):
+    import torch
+
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "env": {k: v for k, v in os.environ.items() if k.startswith("SORTER_")},
+        "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+    }
+
+
+def key(r):
+    return (r["target"], r["workload"], r["scenario"], r["images"])
+
+
+def compare(results, previous_path, threshold):
+    with open(previous_path) as f:
+        previous = {key(r): r for r in json.load(f)["results"]}
+    regressions = 0
+    print(f"\ncompared with {previous_path} (p50 ms):")
+    for r in results:
+        old = previous.get(key(r))
+        if old is None:
+            continue
+        a, b = old["latencyMs"]["p50"], r["latencyMs"]["p50"]
+        ratio = b / a if a else float("inf")
+        flag = "REGRESSION" if ratio > threshold else ""
+        regressions += bool(flag)
+        print(f"  {r['target']:>9} {r['workload']:>16} {r['scenario']:>10} {r['images']:>6}  "
+              f"{a:10.1f} -> {b:10.1f}  x{ratio:5.2f} {flag}")
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--sizes", type=int, nargs="+", default=[100, 1000])
+    ap.add_argument("--resolution", type=parse_resolution, default=(1024, 768), help="WxH of generated images")
+    ap.add_argument("--formats", nargs="+", default=["jpg"], choices=sorted(FORMATS))
+    ap.add_argument("--duplicates", type=float, default=0.0, help="fraction of byte-identical copies")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "sorter-bench-data"),
+                    help="where generated folders are kept between runs")
+    ap.add_argument("--targets", nargs="+", default=["inprocess", "http"], choices=["inprocess", "http"])
+    ap.add_argument("--workloads", nargs="+", default=list(WORKLOADS), choices=WORKLOADS)
+    ap.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=SCENARIOS)
+    ap.add_argument("--cold-runs", type=int, default=2)
+    ap.add_argument("--repeat", type=int, default=5, help="warm runs, and runs per concurrent client")
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--llm-delay-ms", type=float, default=50, help="stub LLM server response time")
+    ap.add_argument("--output", default="bench_results.json")
+    ap.add_argument("--compare", help="earlier --output file to compare p50 latencies against")
+    ap.add_argument("--threshold", type=float, default=1.2, help="p50 ratio counted as a regression")
+    args = ap.parse_args()
+
+    datasets = {}
+    for n in args.sizes:
+        folder = os.path.join(args.data_dir, f"{n}-{args.resolution[0]}x{args.resolution[1]}-"
+                                             f"{'+'.join(args.formats)}-d{args.duplicates}-s{args.seed}")
+        start = time.perf_counter()
+        datasets[n] = make_dataset(folder, n, args.resolution, args.formats, args.seed, duplicates=args.duplicates)
+        print(f"[bench] {n} images ready in {folder} ({time.perf_counter() - start:.1f}s)")
+
+    # Before the targets set SORTER_CACHE_DIR and friends for themselves.
+    meta = metadata(args)
+    stub = StubLLMServer(args.llm_delay_ms)
+    results, counter = [], [0]
+    try:
+        for target_name in args.targets:
+            cache_dir = tempfile.mkdtemp(prefix=f"sorter-bench-{target_name}-")
+            try:
+                start = time.perf_counter()
+                target = (InProcessTarget if target_name == "inprocess" else HttpTarget)(cache_dir, stub.url)
+                print(f"[bench] {target_name} target ready in {time.perf_counter() - start:.1f}s")
+                try:
+                    for n, paths in datasets.items():
+                        for workload in args.workloads:
+                            if workload in HELPER_WORKLOADS and target_name != "inprocess":
+                                continue
+                            for scenario in args.scenarios:
+                                r = run_scenario(target, workload, scenario, paths, args, counter)
+                                r.update(target=target_name, workload=workload, scenario=scenario, images=n)
+                                results.append(r)
+                                lat = r["latencyMs"]
+                                print(f"[bench] {target_name:>9} {workload:>16} {scenario:>10} {n:>6}  "
+                                      f"p50 {lat['p50']:9.1f} ms  p99 {lat['p99']:9.1f} ms  "
+                                      f"{r['imagesPerSec']:9.1f} img/s  peak {r['peakRssMB']} MB")
+                finally:
+                    target.close()
+            finally:
+                shutil.rmtree(cache_dir, ignore_errors=True)
+    finally:
+        stub.close()
+
+    with open(args.output, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=1)
+    print(f"[bench] {len(results)} results written to {args.output}")
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
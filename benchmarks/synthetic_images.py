@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Deterministic synthetic image folders for the benchmarks.
+
+Images come in "scenes" of --burst similar shots (same palette and layout,
+jittered), so CLIP embeddings have real structure to sort and cluster, and
+--duplicates of them are byte-identical copies for the dedupe paths. The
+same arguments always produce the same bytes; a manifest.json in the folder
+records them, so a folder that already matches is reused, not regenerated.
+
+    python benchmarks/synthetic_images.py /tmp/bench-1000 --count 1000 \\
+        --resolution 1024x768 --formats jpg png
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import PIL.Image
+import PIL.ImageDraw
+
+FORMATS = {"jpg": "JPEG", "png": "PNG", "webp": "WEBP", "bmp": "BMP"}
+# Fast encoder settings: the benchmark measures decoding, not our encoder.
+SAVE_OPTIONS = {"JPEG": {"quality": 90}, "PNG": {"compress_level": 1}, "WEBP": {"quality": 90, "method": 0}, "BMP": {}}
+MANIFEST = "manifest.json"
+
+
+def parse_resolution(text):
+    w, h = text.lower().split("x")
+    return int(w), int(h)
+
+
+def render(seed, index, size, burst):
+    """One image of scene index // burst: gradient background plus shapes, jittered per shot."""
+    scene = np.random.default_rng([seed, index // burst])
+    shot = np.random.default_rng([seed, index, 1])
+    w, h = size
+    palette = scene.integers(0, 256, size=(4, 3))
+    t = np.linspace(0, 1, w)[None, :, None] if scene.random() < 0.5 else np.linspace(0, 1, h)[:, None, None]
+    bg = palette[0] * (1 - t) + palette[1] * t
+    img = PIL.Image.fromarray(np.broadcast_to(bg, (h, w, 3)).astype(np.uint8))
+    draw = PIL.ImageDraw.Draw(img)
+    for k in range(int(scene.integers(2, 7))):
+        cx, cy = scene.random(2) + shot.normal(0, 0.02, 2)
+        r = (0.05 + 0.25 * scene.random()) * min(w, h)
+        box = [cx * w - r, cy * h - r, cx * w + r, cy * h + r]
+        colour = tuple(int(c) for c in np.clip(palette[2 + k % 2] + shot.normal(0, 8, 3), 0, 255))
+        (draw.ellipse if scene.random() < 0.5 else draw.rectangle)(box, fill=colour)
+    noise = shot.integers(-8, 9, (h, w, 1), dtype=np.int16)
+    return PIL.Image.fromarray(np.clip(np.asarray(img, dtype=np.int16) + noise, 0, 255).astype(np.uint8))
+
+
+def make_dataset(folder, count, resolution=(1024, 768), formats=("jpg",), seed=0, burst=8,
+                 duplicates=0.0, workers=None):
+    """
+    Fills `folder` with `count` images (format cycling through `formats`) and
+    returns their paths in name order. Reuses the folder when its manifest
+    matches these arguments.
+    """
+    params = {"count": count, "resolution": list(resolution), "formats": list(formats), "seed": seed,
+              "burst": burst, "duplicates": duplicates}
+    manifest_path = os.path.join(folder, MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["params"] == params and all(os.path.exists(os.path.join(folder, n)) for n in manifest["files"]):
+            return [os.path.join(folder, n) for n in manifest["files"]]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    names = [f"img_{i:06d}.{formats[i % len(formats)]}" for i in range(count)]
+    n_copies = min(max(0, count - 1), int(round(count * duplicates)))
+    originals = count - n_copies
+
+    def write(i):
+        path = os.path.join(folder, names[i])
+        fmt = FORMATS[os.path.splitext(path)[1][1:]]
+        render(seed, i, resolution, burst).save(path, fmt, **SAVE_OPTIONS[fmt])
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        list(pool.map(write, range(originals)))
+    rng = np.random.default_rng([seed, 2])
+    for i in range(originals, count):
+        # Copies keep the source's format, whatever name slot they fill.
+        src = names[int(rng.integers(0, originals))]
+        names[i] = f"img_{i:06d}{os.path.splitext(src)[1]}"
+        shutil.copyfile(os.path.join(folder, src), os.path.join(folder, names[i]))
+
+    with open(manifest_path, "w") as f:
+        json.dump({"params": params, "files": names}, f)
+    return [os.path.join(folder, n) for n in names]
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("folder")
+    ap.add_argument("--count", type=int, default=1000)
+    ap.add_argument("--resolution", type=parse_resolution, default=(1024, 768), help="WxH")
+    ap.add_argument("--formats", nargs="+", default=["jpg"], choices=sorted(FORMATS))
+    ap.add_argument("--burst", type=int, default=8, help="similar shots per scene")
+    ap.add_argument("--duplicates", type=float, default=0.0, help="fraction that are byte-identical copies")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+    if not 0 <= args.duplicates < 1:
+        sys.exit("--duplicates must be in [0, 1)")
+    paths = make_dataset(args.folder, args.count, args.resolution, args.formats, args.seed, args.burst,
+                         args.duplicates)
+    print(f"{len(paths)} images in {args.folder}")
+
+
+if __name__ == "__main__":
+    main()
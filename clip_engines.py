@@ -0,0 +1,307 @@
+# clip_engines.py
+
+import copy
+import hashlib
+import os
+import shutil
+import time
+from typing import Optional
+
+import numpy as np
+import torch
+
+from embedding_store import DEFAULT_CACHE_DIR
+
+# Which runtime executes the CLIP encoders:
+#   eager        - the open_clip modules as loaded (the default)
+#   torchscript  - traced, frozen and optimized for inference
+#   onnx         - exported to ONNX and run with onnxruntime (optional dependency)
+ENGINE = os.environ.get("SORTER_ENGINE", "eager")
+ENGINES = ("eager", "torchscript", "onnx")
+# Dynamic int8 quantization of the Linear layers (weights int8, activations
+# quantized per batch). Mostly pays off on CPU.
+QUANTIZE = os.environ.get("SORTER_QUANTIZE", "0").lower() in ("1", "true", "yes")
+# Intra-op threads for torch / onnxruntime; 0 keeps the library default.
+INTRA_OP_THREADS = int(os.environ.get("SORTER_INTRA_OP_THREADS", 0))
+
+# Exported encoders are cached here, one directory per model tag, engine
+# and artifact version (see engine_cache_dir).
+ENGINE_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, "engines")
+
+
+class _ImageEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, images):
+        emb = self.model.encode_image(images)
+        return emb / emb.norm(dim=-1, keepdim=True)
+
+
+class _TextEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, tokens):
+        emb = self.model.encode_text(tokens)
+        return emb / emb.norm(dim=-1, keepdim=True)
+
+
+def _example_inputs(model):
+    size = model.visual.image_size
+    h, w = size if isinstance(size, (tuple, list)) else (size, size)
+    return torch.zeros(1, 3, h, w), torch.zeros(1, model.context_length, dtype=torch.long)
+
+
+def weights_fingerprint(model, samples: int = 1024) -> str:
+    """
+    Short hash of the model's weights: every tensor's name, shape and dtype
+    plus an evenly strided sample of its values, so re-trained or swapped
+    weights get new engine artifacts without hashing every byte.
+    """
+    h = hashlib.blake2b(digest_size=8)
+    for name, t in list(model.named_parameters()) + list(model.named_buffers()):
+        flat = t.detach().reshape(-1)
+        step = max(1, flat.numel() // samples)
+        h.update(f"{name}{tuple(t.shape)}{t.dtype}".encode())
+        h.update(flat[::step].float().cpu().numpy().tobytes())
+    return h.hexdigest()
+
+
+def engine_cache_dir(model, engine: str, model_tag: Optional[str] = None) -> str:
+    """
+    Where `engine` artifacts for `model` live. Traced graphs and exported
+    ONNX files are only valid for the library versions and weights that
+    produced them, so those are part of the path.
+    """
+    import open_clip
+
+    versions = f"torch{torch.__version__}-open_clip{open_clip.__version__}"
+    if engine == "onnx":
+        import onnxruntime
+
+        versions += f"-ort{onnxruntime.__version__}"
+    return os.path.join(
+        ENGINE_CACHE_DIR, (model_tag or "unnamed").replace("/", "_"), engine,
+        f"{versions}-{weights_fingerprint(model)}".replace("+", "_"),
+    )
+
+
+def check_dynamic_batch(built, model) -> None:
+    """
+    Encoders are traced/exported at batch 1. Encodes a batch of two and
+    checks the shape and that its first row matches the same input encoded
+    alone; raises RuntimeError if the batch axis is not really dynamic.
+    int8 activations are quantized per batch, so those only need to agree
+    closely rather than exactly.
+    """
+    min_cos = 0.98 if built.quantized else 0.9999
+    example_image, example_text = _example_inputs(model)
+    generator = torch.Generator().manual_seed(0)
+    images = torch.randn((2,) + tuple(example_image.shape[1:]), generator=generator)
+    tokens = torch.randint(1, 100, (2,) + tuple(example_text.shape[1:]), generator=generator)
+    for name, encode, batch in (("image", built.encode_image, images), ("text", built.encode_text, tokens)):
+        pair, single = encode(batch).float().cpu(), encode(batch[:1]).float().cpu()
+        if pair.shape[0] != 2 or float(pair[0] @ single[0]) < min_cos:
+            raise RuntimeError(f"{built.name} {name} encoder does not handle a dynamic batch size")
+
+
+def state_nbytes(module) -> int:
+    """Bytes of every tensor in `module`'s state dict, packed int8 weights included."""
+    def size(value):
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(size(v) for v in value)
+        return 0
+    return sum(size(v) for v in module.state_dict().values())
+
+
+def quantize_dynamic(model):
+    """int8 dynamic quantization of every nn.Linear in `model` (CPU only)."""
+    qmodel = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    # open_clip derives its cast dtype from `mlp.c_fc.weight.dtype`, which is a
+    # method on quantized Linear layers; activations stay float32 anyway.
+    for module in qmodel.modules():
+        if hasattr(module, "get_weight_dtype"):
+            module.get_weight_dtype = lambda: torch.float32
+    return qmodel
+
+
+class EagerEngine:
+    """
+    Runs the open_clip model directly. Both encoders return unit-norm
+    embeddings. `nbytes` is the memory an engine holds on top of the loaded
+    model's own weights (the quantized copy here, the exported graphs or
+    sessions in the other engines).
+    """
+
+    name = "eager"
+
+    def __init__(self, model, device, quantize: bool = False):
+        self.device = device
+        self.quantized = quantize and device.type == "cpu"
+        self.nbytes = 0
+        if self.quantized:
+            model = quantize_dynamic(model)
+            self.nbytes = state_nbytes(model)
+        self.image = _ImageEncoder(model).eval()
+        self.text = _TextEncoder(model).eval()
+
+    def encode_image(self, images: torch.Tensor) -> torch.Tensor:
+        with torch.no_grad():
+            return self.image(images.to(self.device))
+
+    def encode_text(self, tokens: torch.Tensor) -> torch.Tensor:
+        with torch.no_grad():
+            return self.text(tokens.to(self.device))
+
+
+class TorchScriptEngine(EagerEngine):
+    """
+    Traces both encoders once, then freezes and optimizes them for inference.
+    Traced modules are saved under `cache_dir` and reused on later starts.
+    """
+
+    name = "torchscript"
+
+    def __init__(self, model, device, quantize: bool = False, cache_dir: Optional[str] = None):
+        super().__init__(model, device, quantize)
+        suffix = ".int8" if self.quantized else ""
+        example_image, example_text = _example_inputs(model)
+        # Frozen graphs carry their own copy of the weights as constants.
+        self.nbytes = self.nbytes or state_nbytes(model)
+        self.image = self._load_or_trace(self.image, example_image, cache_dir, f"image{suffix}.pt")
+        self.text = self._load_or_trace(self.text, example_text, cache_dir, f"text{suffix}.pt")
+
+    def _load_or_trace(self, module, example, cache_dir, filename):
+        # The frozen graph is what gets saved: graphs rewritten by
+        # optimize_for_inference do not always load back, so that pass runs
+        # again after every load.
+        path = os.path.join(cache_dir, filename) if cache_dir else None
+        frozen = None
+        if path and os.path.exists(path):
+            try:
+                frozen = torch.jit.load(path, map_location=self.device)
+            except Exception as e:
+                print(f"[engine] WARNING: {path} unreadable ({e}); tracing again.")
+        if frozen is None:
+            with torch.no_grad():
+                traced = torch.jit.trace(module, example.to(self.device), check_trace=False)
+                frozen = torch.jit.freeze(traced.eval())
+            if path:
+                os.makedirs(cache_dir, exist_ok=True)
+                torch.jit.save(frozen, path)
+        return torch.jit.optimize_for_inference(frozen)
+
+
+class OnnxEngine:
+    """
+    Exports both encoders to ONNX (with a dynamic batch axis) and runs them
+    with onnxruntime. With `quantize`, the exported graphs are rewritten by
+    onnxruntime's dynamic int8 quantizer instead of torch's.
+    """
+
+    name = "onnx"
+
+    def __init__(self, model, device, quantize: bool = False, cache_dir: Optional[str] = None,
+                 threads: int = 0):
+        import onnxruntime as ort
+
+        self.device = device
+        self.quantized = quantize
+        cache_dir = cache_dir or os.path.join(ENGINE_CACHE_DIR, "unnamed")
+        os.makedirs(cache_dir, exist_ok=True)
+        example_image, example_text = _example_inputs(model)
+        if next(model.parameters()).device.type != "cpu":
+            model = copy.deepcopy(model).cpu()  # export on CPU without moving the live model
+        image_path = self._export(_ImageEncoder(model).eval(), example_image, cache_dir, "image")
+        text_path = self._export(_TextEncoder(model).eval(), example_text, cache_dir, "text")
+
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            opts.intra_op_num_threads = threads
+        providers = ["CPUExecutionProvider"]
+        if device.type == "cuda" and "CUDAExecutionProvider" in ort.get_available_providers():
+            providers.insert(0, "CUDAExecutionProvider")
+        self._image = ort.InferenceSession(image_path, opts, providers=providers)
+        self._text = ort.InferenceSession(text_path, opts, providers=providers)
+        # The sessions hold the exported initializers, about the files' size.
+        self.nbytes = os.path.getsize(image_path) + os.path.getsize(text_path)
+
+    def _export(self, module, example, cache_dir, stem):
+        path = os.path.join(cache_dir, f"{stem}.onnx")
+        if not os.path.exists(path):
+            # The fused attention fast path has no ONNX symbolic; export the plain ops.
+            fastpath = torch.backends.mha.get_fastpath_enabled()
+            torch.backends.mha.set_fastpath_enabled(False)
+            try:
+                with torch.no_grad():
+                    torch.onnx.export(
+                        module, (example,), path,
+                        input_names=["input"], output_names=["embedding"],
+                        dynamic_axes={"input": {0: "batch"}, "embedding": {0: "batch"}},
+                        opset_version=17, dynamo=False,
+                    )
+            finally:
+                torch.backends.mha.set_fastpath_enabled(fastpath)
+        if not self.quantized:
+            return path
+        qpath = os.path.join(cache_dir, f"{stem}.int8.onnx")
+        if not os.path.exists(qpath):
+            from onnxruntime.quantization import QuantType
+            from onnxruntime.quantization import quantize_dynamic as ort_quantize_dynamic
+            ort_quantize_dynamic(path, qpath, weight_type=QuantType.QInt8)
+        return qpath
+
+    def _run(self, session, x: torch.Tensor) -> torch.Tensor:
+        out = session.run(None, {"input": x.cpu().numpy()})[0]
+        return torch.from_numpy(np.ascontiguousarray(out)).to(self.device)
+
+    def encode_image(self, images: torch.Tensor) -> torch.Tensor:
+        return self._run(self._image, images.float())
+
+    def encode_text(self, tokens: torch.Tensor) -> torch.Tensor:
+        return self._run(self._text, tokens.long())
+
+
+def _build_exported(model, device, engine: str, quantize: bool, threads: int, cache_dir: str):
+    if engine == "onnx":
+        return OnnxEngine(model, device, quantize, cache_dir, threads)
+    return TorchScriptEngine(model, device, quantize, cache_dir)
+
+
+def build_engine(model, device, engine: str = ENGINE, quantize: bool = QUANTIZE,
+                 threads: int = INTRA_OP_THREADS, model_tag: Optional[str] = None):
+    """
+    Wraps a loaded open_clip model in the requested engine. Exported
+    artifacts are cached per `model_tag`, library versions and weights
+    under ENGINE_CACHE_DIR, and checked for a dynamic batch axis on load.
+    """
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine {engine!r}; use one of {', '.join(ENGINES)}")
+    if threads:
+        torch.set_num_threads(threads)
+    start = time.perf_counter()
+    if engine == "eager":
+        built = EagerEngine(model, device, quantize)
+    else:
+        cache_dir = engine_cache_dir(model, engine, model_tag)
+        cached = os.path.isdir(cache_dir)
+        built = _build_exported(model, device, engine, quantize, threads, cache_dir)
+        try:
+            check_dynamic_batch(built, model)
+        except RuntimeError as e:
+            if not cached:
+                raise
+            # A cached artifact that fails the check is rebuilt once.
+            print(f"[engine] WARNING: cached {engine} artifacts failed a check ({e}); rebuilding.")
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            built = _build_exported(model, device, engine, quantize, threads, cache_dir)
+            check_dynamic_batch(built, model)
+    print(f"[engine] {engine}{' int8' if built.quantized else ''} ready in {time.perf_counter() - start:.1f}s")
+    return built
+
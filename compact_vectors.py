@@ -0,0 +1,177 @@
+# compact_vectors.py
+
+import os
+import threading
+from typing import Optional, Tuple
+
+import numpy as np
+
+# On-disk element type for library vectors: float32 (exact), float16 (half
+# the size, near-lossless for unit vectors) or int8 (a quarter of the size,
+# one float32 scale per vector).
+VECTOR_DTYPE = os.environ.get("SORTER_VECTOR_DTYPE", "float16")
+
+_NUMPY_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+_SUFFIXES = {"float32": "f32", "float16": "f16", "int8": "i8"}
+
+# Rows converted to float32 at a time while scoring. Small enough that the
+# converted block stays in cache for the matrix-vector product (and bounds
+# the temporary memory a scan of a large mmap needs).
+SCORE_CHUNK = 8192
+
+
+def encode(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Returns (codes, scales) for float32 rows; scales is None unless dtype is int8."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if dtype == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    return vectors.astype(_NUMPY_DTYPES[dtype]), None
+
+
+def decode(codes: np.ndarray, scales: Optional[np.ndarray]) -> np.ndarray:
+    out = codes.astype(np.float32)
+    if scales is not None:
+        out *= scales[:, None]
+    return out
+
+
+def compact_dot(codes: np.ndarray, scales: Optional[np.ndarray], query: np.ndarray) -> np.ndarray:
+    """
+    Scores every row of `codes` (float32, float16 or int8, possibly an mmap)
+    against a float32 query, a chunk at a time, without materializing the
+    whole matrix as float32.
+    """
+    out = np.empty(len(codes), dtype=np.float32)
+    for i in range(0, len(codes), SCORE_CHUNK):
+        block = codes[i : i + SCORE_CHUNK]
+        if block.dtype != np.float32:
+            block = block.astype(np.float32)
+        out[i : i + SCORE_CHUNK] = block @ query
+    if scales is not None:
+        out *= scales
+    return out
+
+
+class VectorFile:
+    """
+    Append-only [n, dim] matrix stored contiguously in one file (plus a
+    float32 scale file for int8), read back through np.memmap so scoring
+    runs against the page cache instead of a copy in Python memory.
+
+    append/truncate/view are serialized by the file's own lock, so a view
+    taken while another thread appends always covers exactly the rows it
+    claims; readers (training, repacking) need not hold the caller's lock.
+    """
+
+    def __init__(self, directory: str, dim: int, dtype: str = VECTOR_DTYPE):
+        if dtype not in _NUMPY_DTYPES:
+            raise ValueError(f"Unsupported vector dtype {dtype!r}; use one of {sorted(_NUMPY_DTYPES)}")
+        self.dim = dim
+        self.dtype = dtype
+        self.path = os.path.join(directory, f"vectors.{_SUFFIXES[dtype]}")
+        self.scale_path = os.path.join(directory, "scales.f32") if dtype == "int8" else None
+        self._np_dtype = _NUMPY_DTYPES[dtype]
+        self._row_bytes = dim * np.dtype(self._np_dtype).itemsize
+        self._codes = None
+        self._scales = None
+        self._mapped = 0
+        self._lock = threading.Lock()
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        self._n = size // self._row_bytes
+        if self.scale_path is not None:
+            scale_rows = os.path.getsize(self.scale_path) // 4 if os.path.exists(self.scale_path) else 0
+            self._n = min(self._n, scale_rows)
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def nbytes(self) -> int:
+        return self._n * (self._row_bytes + (4 if self.scale_path else 0))
+
+    def truncate(self, n: int) -> None:
+        """Drops rows >= n (e.g. a half-written append after a crash)."""
+        with self._lock:
+            if n >= self._n:
+                return
+            self._codes = self._scales = None
+            self._mapped = 0
+            with open(self.path, "r+b") as f:
+                f.truncate(n * self._row_bytes)
+            if self.scale_path is not None:
+                with open(self.scale_path, "r+b") as f:
+                    f.truncate(n * 4)
+            self._n = n
+
+    def append(self, vectors: np.ndarray) -> None:
+        codes, scales = encode(np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim), self.dtype)
+        with self._lock:
+            with open(self.path, "ab") as f:
+                f.write(np.ascontiguousarray(codes).tobytes())
+            if scales is not None:
+                with open(self.scale_path, "ab") as f:
+                    f.write(scales.tobytes())
+            self._n += len(codes)
+
+    def view(self):
+        """(codes, scales) memmaps covering all rows appended so far."""
+        with self._lock:
+            n = self._n
+            if self._mapped != n or self._codes is None:
+                if n == 0:
+                    self._codes = np.empty((0, self.dim), dtype=self._np_dtype)
+                    self._scales = np.empty(0, dtype=np.float32) if self.scale_path else None
+                else:
+                    self._codes = np.memmap(self.path, dtype=self._np_dtype, mode="r", shape=(n, self.dim))
+                    if self.scale_path is not None:
+                        self._scales = np.memmap(self.scale_path, dtype=np.float32, mode="r", shape=(n,))
+                self._mapped = n
+            return self._codes, self._scales
+
+    def export(self, rows: np.ndarray, suffix: str, append: bool = False) -> None:
+        """
+        Writes the stored (codes, scales) of `rows`, in that order, to this
+        file's paths plus `suffix`; replace_from(suffix) then swaps them in.
+        """
+        codes, scales = self.view()
+        mode = "ab" if append else "wb"
+        with open(self.path + suffix, mode) as f:
+            for i in range(0, len(rows), SCORE_CHUNK):
+                f.write(np.ascontiguousarray(codes[rows[i : i + SCORE_CHUNK]]).tobytes())
+        if self.scale_path is not None:
+            with open(self.scale_path + suffix, mode) as f:
+                f.write(np.asarray(scales[rows], dtype=np.float32).tobytes())
+
+    def replace_from(self, suffix: str) -> None:
+        """Replaces the files with the ones export() wrote. Views taken earlier keep the old rows."""
+        with self._lock:
+            os.replace(self.path + suffix, self.path)
+            if self.scale_path is not None:
+                os.replace(self.scale_path + suffix, self.scale_path)
+            self._codes = self._scales = None
+            self._mapped = 0
+            self._n = os.path.getsize(self.path) // self._row_bytes
+
+    def take(self, rows: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """Copies the compact (codes, scales) of `rows` into memory."""
+        codes, scales = self.view()
+        return codes[rows], None if scales is None else np.asarray(scales[rows])
+
+    def take_float(self, rows: np.ndarray) -> np.ndarray:
+        return decode(*self.take(rows))
+
+    def iter_float(self, start: int, stop: int, chunk: int = SCORE_CHUNK):
+        """Yields float32 blocks of rows [start, stop)."""
+        codes, scales = self.view()
+        for i in range(start, stop, chunk):
+            j = min(stop, i + chunk)
+            yield decode(codes[i:j], None if scales is None else scales[i:j])
+
+    def dot(self, query: np.ndarray, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+        """Scores rows [start, stop) against `query` straight from the mmap."""
+        codes, scales = self.view()
+        stop = len(codes) if stop is None else stop
+        return compact_dot(codes[start:stop], None if scales is None else scales[start:stop], query)
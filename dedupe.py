@@ -0,0 +1,257 @@
+# dedupe.py
+
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import PIL.Image
+
+from ann_index import KMEANS_SAMPLE_PER_LIST, train_centroids
+from embedding_store import file_fingerprint
+from image_pipeline import DECODE_WORKERS, default_loader
+
+# Two images are near-duplicates when their embeddings' cosine reaches
+# DUP_COSINE (burst shots), or when their perceptual hashes differ in at most
+# PHASH_MAX_DISTANCE bits (re-exports, resizes) and the cosine still reaches
+# PHASH_COSINE, since a flat or dark frame's hash says little about content.
+DUP_COSINE = float(os.environ.get("SORTER_DUP_COSINE", 0.95))
+PHASH_MAX_DISTANCE = int(os.environ.get("SORTER_PHASH_DISTANCE", 4))
+PHASH_COSINE = 0.85
+
+# Embeddings are compared all-pairs up to this many images; above it, only
+# within k-means blocks, each image joining its BLOCK_PROBES nearest blocks.
+EXACT_COMPARE_MAX = 4096
+BLOCK_PROBES = 2
+# Rows of the similarity matrix computed at a time in the all-pairs pass.
+COMPARE_CHUNK = 1024
+# Images sharing one perceptual-hash band are compared with at most this
+# many neighbours in that band (huge buckets are flat frames, which the
+# embedding pass handles anyway).
+MAX_BUCKET_SPAN = 64
+
+_READ_CHUNK = 1 << 20
+
+
+def content_digest(path: str) -> str:
+    """BLAKE2b digest of the file's bytes; equal digests mean byte-identical copies."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_READ_CHUNK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def image_dhash(img: PIL.Image.Image) -> int:
+    """
+    64-bit difference hash (dHash) as a signed int: one bit per horizontally
+    adjacent pair of a 9x8 grayscale thumbnail. Survives re-encoding and
+    resizing, so it can be taken from an already downscaled decode.
+    """
+    small = img.convert("L").resize((9, 8), PIL.Image.BILINEAR)
+    px = np.asarray(small, dtype=np.int16)
+    bits = (px[:, 1:] > px[:, :-1]).reshape(-1)
+    return int(np.packbits(bits).view(">i8")[0])
+
+
+def perceptual_hash(path: str) -> Optional[int]:
+    """
+    image_dhash of the file at `path`, decoded by the encoder's loader so it
+    equals the hash taken from an encode; None if it cannot be decoded.
+    """
+    try:
+        return image_dhash(default_loader()(path))
+    except Exception:
+        return None
+
+
+def _hash_file(path: str, known=(None, None), fp=None):
+    """
+    (fingerprint taken before reading, digest, phash), or None if unreadable.
+    Parts already in `known` (digest, phash) are not computed again.
+    """
+    fp = fp or file_fingerprint(path)
+    if fp is None:
+        return None
+    digest, phash = known
+    try:
+        return fp, digest or content_digest(path), phash if phash is not None else perceptual_hash(path)
+    except OSError:
+        return None
+
+
+def file_hashes(paths: List[str], store=None, workers: int = DECODE_WORKERS,
+                known: Optional[Dict[str, Tuple[Optional[str], Optional[int]]]] = None,
+                fingerprints: Optional[dict] = None) -> Dict[str, Tuple[str, Optional[int]]]:
+    """
+    Returns {path: (digest, phash)} for every readable path, reusing `store`
+    (a HashStore) and hashing the rest on a thread pool. `known` holds
+    (digest, phash) parts the caller already has, e.g. dHashes taken from the
+    encoder's decode (None for a part still to compute); `fingerprints` are
+    file_fingerprints taken before those reads, recorded instead of new ones.
+    """
+    unique = list(dict.fromkeys(paths))
+    hashes = store.get_many(unique) if store is not None else {}
+    missing = [p for p in unique if p not in hashes]
+    if missing:
+        known, fingerprints = known or {}, fingerprints or {}
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="hash") as pool:
+            results = pool.map(lambda p: _hash_file(p, known.get(p, (None, None)), fingerprints.get(p)), missing)
+            fresh = {p: h for p, h in zip(missing, results) if h is not None}
+        if store is not None:
+            store.put_many([(p, d, ph) for p, (_, d, ph) in fresh.items()],
+                           {p: fp for p, (fp, _, _) in fresh.items()})
+        hashes.update({p: (d, ph) for p, (_, d, ph) in fresh.items()})
+    return hashes
+
+
+def file_digests(paths: List[str], store=None, workers: int = DECODE_WORKERS) -> Dict[str, str]:
+    """
+    {path: content digest} for every readable path, from `store` or by
+    reading the bytes; unlike file_hashes nothing is decoded or recorded.
+    """
+    unique = list(dict.fromkeys(paths))
+    digests = {p: d for p, (d, _) in (store.get_many(unique) if store is not None else {}).items()}
+    missing = [p for p in unique if p not in digests]
+
+    def digest(p):
+        try:
+            return content_digest(p)
+        except OSError:
+            return None
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="hash") as pool:
+            digests.update({p: d for p, d in zip(missing, pool.map(digest, missing)) if d is not None})
+    return digests
+
+
+def split_exact_copies(paths: List[str], digests: Dict[str, str]):
+    """
+    Returns (representatives, copies): the first path of every distinct
+    content digest (and every path without one), and {representative:
+    [its byte-identical copies]}.
+    """
+    first, reps, copies = {}, [], {}
+    for p in paths:
+        d = digests.get(p)
+        if d is None:
+            reps.append(p)
+        elif d in first:
+            copies.setdefault(first[d], []).append(p)
+        else:
+            first[d] = p
+            reps.append(p)
+    return reps, copies
+
+
+def _phash_pairs(phashes: np.ndarray, valid: np.ndarray, max_distance: int) -> np.ndarray:
+    """
+    Candidate pairs within `max_distance` bits, by banding: split the 64 bits
+    into max_distance + 1 bands; any pair that close agrees on at least one
+    whole band (pigeonhole), so only same-band-value rows are compared.
+    """
+    bands = max_distance + 1
+    edges = np.linspace(0, 64, bands + 1).astype(int)
+    rows = np.flatnonzero(valid)
+    h = phashes[rows].view(np.uint64)
+    pairs = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        keys = (h >> np.uint64(lo)) & np.uint64((1 << (hi - lo)) - 1)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        for d in range(1, min(MAX_BUCKET_SPAN, len(order))):
+            same = np.flatnonzero(sorted_keys[:-d] == sorted_keys[d:])
+            if not len(same):
+                break
+            pairs.append(np.stack([rows[order[same]], rows[order[same + d]]], axis=1))
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    pairs = np.unique(pairs, axis=0)
+    dist = np.bitwise_count((phashes[pairs[:, 0]] ^ phashes[pairs[:, 1]]).view(np.uint64))
+    return pairs[dist <= max_distance]
+
+
+def _cosine_pairs(x: np.ndarray, threshold: float) -> np.ndarray:
+    """Pairs i < j with x[i] . x[j] >= threshold; all-pairs when small, blocked by k-means otherwise."""
+    n = len(x)
+    pairs = []
+    if n <= EXACT_COMPARE_MAX:
+        for i in range(0, n, COMPARE_CHUNK):
+            sims = x[i : i + COMPARE_CHUNK] @ x.T
+            a, b = np.nonzero(sims >= threshold)
+            a += i
+            keep = a < b
+            pairs.append(np.stack([a[keep], b[keep]], axis=1))
+    else:
+        k = max(2, int(np.sqrt(n)))
+        rng = np.random.default_rng(0)
+        centroids = train_centroids(x[rng.choice(n, min(n, k * KMEANS_SAMPLE_PER_LIST), replace=False)], k)
+        near = np.empty((n, BLOCK_PROBES), dtype=np.int64)
+        for i in range(0, n, COMPARE_CHUNK):
+            near[i : i + COMPARE_CHUNK] = np.argpartition(
+                -(x[i : i + COMPARE_CHUNK] @ centroids.T), BLOCK_PROBES - 1, axis=1
+            )[:, :BLOCK_PROBES]
+        for c in range(k):
+            members = np.flatnonzero((near == c).any(axis=1))
+            if len(members) < 2:
+                continue
+            sub = x[members]
+            a, b = np.nonzero(np.triu(sub @ sub.T >= threshold, k=1))
+            pairs.append(np.stack([members[a], members[b]], axis=1))
+    if not pairs:
+        return np.empty((0, 2), dtype=np.int64)
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def duplicate_groups(paths: List[str], hashes: Dict[str, Tuple[str, Optional[int]]],
+                     embeddings: Optional[np.ndarray] = None) -> List[Tuple[List[int], bool]]:
+    """
+    Groups byte-identical copies and near-duplicates of `paths` (unique).
+    `embeddings` (unit-norm, one row per path) enables the cosine tests.
+    Returns [(indices in input order, exact)] for every group of two or
+    more, where `exact` means all members are byte-identical.
+    """
+    n = len(paths)
+    parent = np.arange(n)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(pairs):
+        for a, b in pairs.tolist():
+            ra, rb = find(a), find(b)
+            if ra != rb:
+                parent[max(ra, rb)] = min(ra, rb)
+
+    digests = [hashes[p][0] if p in hashes else None for p in paths]
+    by_digest = {}
+    for i, d in enumerate(digests):
+        if d is not None:
+            by_digest.setdefault(d, []).append(i)
+    union(np.array([(g[0], j) for g in by_digest.values() for j in g[1:]], dtype=np.int64).reshape(-1, 2))
+
+    phashes = np.array([(hashes.get(p) or (None, None))[1] or 0 for p in paths], dtype=np.int64)
+    valid = np.array([(hashes.get(p) or (None, None))[1] is not None for p in paths])
+    candidates = _phash_pairs(phashes, valid, PHASH_MAX_DISTANCE)
+    if embeddings is not None:
+        x = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if len(candidates):
+            cos = (x[candidates[:, 0]] * x[candidates[:, 1]]).sum(axis=1)
+            candidates = candidates[cos >= PHASH_COSINE]
+        union(_cosine_pairs(x, DUP_COSINE))
+    union(candidates)
+
+    groups = {}
+    for i in range(n):
+        groups.setdefault(find(i), []).append(i)
+    return [
+        (members, len({digests[i] for i in members}) == 1 and digests[members[0]] is not None)
+        for members in groups.values()
+        if len(members) > 1
+    ]
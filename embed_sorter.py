@@ -9,6 +9,8 @@ from pydantic import BaseModel
 from typing import List
 from PIL import Image
 
+from model_registry import DEFAULT_MODEL, load_clip_model, split_tag
+
 # ---------- 1) Define request/response schemas ----------
 
 class SortRequest(BaseModel):
@@ -23,17 +25,9 @@ class SortResponse(BaseModel):
 
 app = FastAPI(title="EmbedSorterService")
 
-# ---------- 3) Your load_clip_model() exactly as you have it ----------
+# ---------- 3) Model: the shared loader, same default as the main server ----------
 
-def load_clip_model():
-    # You can switch to a different CLIP variant if you want.
-    # Here we pick ViT-B-32 with the OpenAI weights.
-    model_name, pretrained = "ViT-B-32", "openai"
-    model, _, preprocess = open_clip.create_model_and_transforms(
-        model_name, pretrained=pretrained
-    )
-    model.eval()
-    return model, preprocess
+CLIP_MODEL_NAME, CLIP_PRETRAINED = split_tag(DEFAULT_MODEL)
 
 # Global placeholders for model + preprocess + device
 CLIP_MODEL = None
@@ -46,14 +40,14 @@ DEVICE = None
 async def startup_event():
     global CLIP_MODEL, PREPROCESSOR, DEVICE
     DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    CLIP_MODEL, _, PREPROCESSOR = load_clip_model()
-    CLIP_MODEL.to(DEVICE)
+    CLIP_MODEL, PREPROCESSOR = load_clip_model(CLIP_MODEL_NAME, CLIP_PRETRAINED)
+    CLIP_MODEL.to(DEVICE).eval()
     print(f"[server] Loaded CLIP model on {DEVICE}")
 
 # ---------- 5) Embedding helpers ----------
 
 def get_text_embedding(model, text, device):
-    tokenizer = open_clip.get_tokenizer("ViT-B-32")
+    tokenizer = open_clip.get_tokenizer(CLIP_MODEL_NAME)
     text_tokens = tokenizer(text).to(device)
     with torch.no_grad():
         text_emb = model.encode_text(text_tokens)
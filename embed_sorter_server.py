@@ -6,14 +6,21 @@ import torch
 import open_clip
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-from typing import List
-from PIL import Image
+from typing import List, Optional
 
 # 1) Add LLM + VLM imports
 from transformers import Blip2Processor, Blip2ForConditionalGeneration
 from llama_cpp import Llama
 from contextlib import asynccontextmanager
 
+from embedding_store import CaptionStore, file_fingerprints
+from image_pipeline import load_image
+from tag_ranking import ContextTooSmall, rank_tags
+
+VLM_MODEL_ID = "Salesforce/blip2-opt-2.7b"
+# Images captioned per BLIP-2 generate() call.
+CAPTION_BATCH_SIZE = int(os.environ.get("SORTER_CAPTION_BATCH", 8))
+
 # ---------- Request/Response Schemas ----------
 
 class ConceptSortRequest(BaseModel):
@@ -22,8 +29,20 @@ class ConceptSortRequest(BaseModel):
     orderStart: str
     orderEnd: str
 
+class LlmStats(BaseModel):
+    calls: int
+    promptTokens: int
+    completionTokens: int
+    latencyMs: float
+    uniqueTags: int
+    chunks: int
+    fuzzyMatched: int
+    reconciled: int
+    missing: int
+
 class ConceptSortResponse(BaseModel):
     sortedPaths: List[str]
+    llm: Optional[LlmStats] = None
 
 # ---------- Lifespan for startup/shutdown ----------
 
@@ -32,11 +51,16 @@ async def lifespan(app: FastAPI):
     # --- Startup code ---
     print("[lifespan] Loading models...")
 
+    # Choose device
+    app.state.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
     # Load VLM
-    app.state.vlm_processor = Blip2Processor.from_pretrained("Salesforce/blip2-opt-2.7b")
+    app.state.vlm_processor = Blip2Processor.from_pretrained(VLM_MODEL_ID)
     app.state.vlm = Blip2ForConditionalGeneration.from_pretrained(
-        "Salesforce/blip2-opt-2.7b"
-    ).to("cuda")
+        VLM_MODEL_ID
+    ).to(app.state.device)
+    # Captions survive restarts, so repeat sorts of a folder skip the VLM.
+    app.state.captions = CaptionStore()
 
     # Load LLM
     app.state.llm = Llama(
@@ -46,8 +70,6 @@ async def lifespan(app: FastAPI):
         n_threads=4
     )
 
-    # Choose device
-    app.state.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print("[lifespan] Models loaded and ready.")
 
     yield
@@ -63,34 +85,45 @@ app = FastAPI(lifespan=lifespan, title="EmbedSorterService")
 
 # ---------- Helper functions using app.state ----------
 
-def generate_tags(image_paths: List[str]) -> List[str]:
-    tags = []
+def generate_tags(image_paths: List[str], batch_size: int = CAPTION_BATCH_SIZE) -> List[str]:
+    """
+    Returns one caption per path. Cached captions are reused; the rest are
+    generated `batch_size` images per generate() call and cached.
+    """
+    captions = app.state.captions.get_many(image_paths, VLM_MODEL_ID)
+    missing = [p for p in dict.fromkeys(image_paths) if p not in captions]
+    if missing:
+        print(f"[captions] {len(captions)} cached, generating {len(missing)}")
+
     vlm = app.state.vlm
     processor = app.state.vlm_processor
     device = app.state.device
-
-    for p in image_paths:
-        img = Image.open(p).convert("RGB")
-        inputs = processor(images=img, return_tensors="pt").to(device)
-        prompt = "Describe the main subject of this image in one to three words."
-        outputs = vlm.generate(**inputs, max_new_tokens=10, do_sample=False)
-        tag = processor.decode(outputs[0], skip_special_tokens=True).strip()
-        tags.append(tag)
-    return tags
-
-def sort_tags_by_dimension(tags: List[str], dimension: str, start: str, end: str) -> List[str]:
-    llm = app.state.llm
-    items = ", ".join(tags)
-    llm_prompt = f"""
-You are a sorting expert.
-Sort the following items based on the dimension of {dimension}.
-List them from {start} to {end}.
-Respond ONLY with the sorted, comma-separated list.
-Items: {items}
-"""
-    resp = llm(prompt=llm_prompt, max_tokens=256, stop=["\\n"])
-    sorted_tags = [t.strip() for t in resp["choices"][0]["text"].split(",")]
-    return sorted_tags
+    for i in range(0, len(missing), max(1, batch_size)):
+        batch = missing[i : i + batch_size]
+        fingerprints = file_fingerprints(batch)  # before the files are read
+        imgs = [load_image(p) for p in batch]
+        inputs = processor(images=imgs, return_tensors="pt").to(device, vlm.dtype)
+        with torch.no_grad():
+            outputs = vlm.generate(**inputs, max_new_tokens=10, do_sample=False)
+        # Sequences that finish early are padded; skip_special_tokens drops the padding.
+        fresh = [t.strip() for t in processor.batch_decode(outputs, skip_special_tokens=True)]
+        app.state.captions.put_many(list(zip(batch, fresh)), VLM_MODEL_ID, fingerprints)
+        captions.update(zip(batch, fresh))
+    return [captions[p] for p in image_paths]
+
+def sort_tags_by_dimension(tags: List[str], dimension: str, start: str, end: str):
+    """
+    Orders the unique tags from `start` to `end` along `dimension`, in
+    context-sized chunks when needed. Returns (sorted unique tags, RankStats).
+    """
+    try:
+        sorted_tags, stats = rank_tags(app.state.llm, tags, dimension, start, end)
+    except ContextTooSmall as e:
+        # A limit of the loaded model (n_ctx), not of the request.
+        raise HTTPException(503, str(e))
+    print(f"[llm] {stats.unique_tags} tags in {stats.calls} calls, "
+          f"{stats.prompt_tokens}+{stats.completion_tokens} tokens, {1000 * stats.latency:.0f} ms")
+    return sorted_tags, stats
 
 # ---------- Endpoint ----------
 
@@ -100,7 +133,7 @@ async def concept_sort(req: ConceptSortRequest):
         raise HTTPException(400, "No imagePaths provided")
 
     tags = generate_tags(req.imagePaths)
-    sorted_tags = sort_tags_by_dimension(tags, req.dimension, req.orderStart, req.orderEnd)
+    sorted_tags, stats = sort_tags_by_dimension(tags, req.dimension, req.orderStart, req.orderEnd)
 
     tag_to_paths = {}
     for path, tag in zip(req.imagePaths, tags):
@@ -110,7 +143,8 @@ async def concept_sort(req: ConceptSortRequest):
     for tag in sorted_tags:
         sorted_paths.extend(tag_to_paths.get(tag, []))
 
-    return ConceptSortResponse(sortedPaths=sorted_paths)
+    # Every unique tag is in sorted_tags, so every input path comes back.
+    return ConceptSortResponse(sortedPaths=sorted_paths, llm=LlmStats(**stats.to_dict()))
 
 # ---------- Run with Uvicorn ----------
 
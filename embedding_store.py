@@ -0,0 +1,348 @@
+# embedding_store.py
+
+import os
+import sqlite3
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Where the on-disk caches live. Override with SORTER_CACHE_DIR.
+DEFAULT_CACHE_DIR = os.environ.get(
+    "SORTER_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"),
+)
+
+# Number of prompt embeddings kept in memory per process.
+TEXT_CACHE_SIZE = int(os.environ.get("SORTER_TEXT_CACHE_SIZE", 256))
+
+# Keep IN (...) lists well below SQLite's host-parameter limit.
+_QUERY_CHUNK = 500
+# Temporary path prefix while rows are re-keyed (absolute paths never start with it).
+_PARKED = "renaming:"
+
+
+def file_fingerprint(path: str) -> Optional[Tuple[str, int, int]]:
+    """
+    Returns (absolute path, size in bytes, mtime in ns) for `path`,
+    or None if the file cannot be stat'd.
+    """
+    abs_path = os.path.abspath(path)
+    try:
+        st = os.stat(abs_path)
+    except OSError:
+        return None
+    return abs_path, st.st_size, st.st_mtime_ns
+
+
+def file_fingerprints(paths: Iterable[str]) -> Dict[str, Tuple[str, int, int]]:
+    """
+    {input path: file_fingerprint} for every path that can be stat'd. Take
+    it before reading the files and hand it to put_many, so a file edited
+    while it was being processed is stored with its old stamp (and misses
+    next time) instead of being recorded as fresh.
+    """
+    out = {}
+    for p in paths:
+        fp = file_fingerprint(p)
+        if fp is not None:
+            out[p] = fp
+    return out
+
+
+def _rename_rows(conn: sqlite3.Connection, table: str, pairs: List[Tuple[str, str]]) -> None:
+    """
+    Re-keys rows from old to new path. Rows are parked under a key no real
+    path has first, so pairs may permute paths among themselves (a <-> b).
+    A pair whose old path has no rows leaves the new path's rows alone, so
+    applying the same renames twice is harmless.
+    """
+    moved = []
+    for old, new in pairs:
+        old, new = os.path.abspath(old), os.path.abspath(new)
+        if conn.execute(f"UPDATE {table} SET path = ? WHERE path = ?", (_PARKED + new, old)).rowcount:
+            moved.append(new)
+    conn.executemany(f"DELETE FROM {table} WHERE path = ?", [(new,) for new in moved])
+    conn.executemany(f"UPDATE {table} SET path = ? WHERE path = ?", [(new, _PARKED + new) for new in moved])
+
+
+class FingerprintedStore:
+    """
+    A per-file cache in one SQLite file (WAL). Rows are keyed on absolute
+    path (and model tag, if `per_model`) and remember the file size and
+    mtime they were computed from, so a file that changed on disk is
+    reported as a miss. Subclasses name the table, its value columns and
+    its schema, and convert values in and out.
+    """
+
+    default_name = ""
+    table = ""
+    columns: Tuple[str, ...] = ()
+    per_model = True
+    schema = ""
+
+    def __init__(self, db_path: Optional[str] = None):
+        if db_path is None:
+            db_path = os.path.join(DEFAULT_CACHE_DIR, self.default_name)
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(self.schema)
+        self._conn.commit()
+
+    def _get_rows(self, paths: Iterable[str], model_tag: Optional[str] = None) -> Dict[str, tuple]:
+        """{input path: value columns} for rows whose size and mtime still match the file."""
+        wanted = {}
+        for p, fp in file_fingerprints(paths).items():
+            wanted.setdefault(fp[0], []).append((p, fp[1], fp[2]))
+
+        hits = {}
+        abs_paths = list(wanted)
+        where = "model = ? AND " if self.per_model else ""
+        select = f"SELECT path, size, mtime_ns, {', '.join(self.columns)} FROM {self.table} WHERE {where}"
+        with self._lock:
+            for i in range(0, len(abs_paths), _QUERY_CHUNK):
+                chunk = abs_paths[i : i + _QUERY_CHUNK]
+                marks = ",".join("?" * len(chunk))
+                args = [model_tag, *chunk] if self.per_model else chunk
+                for abs_path, size, mtime_ns, *values in self._conn.execute(f"{select}path IN ({marks})", args):
+                    for p, cur_size, cur_mtime in wanted[abs_path]:
+                        if size == cur_size and mtime_ns == cur_mtime:
+                            hits[p] = tuple(values)
+        return hits
+
+    def _put_rows(self, items: List[Tuple[str, tuple]], model_tag: Optional[str] = None,
+                  fingerprints: Optional[Dict[str, Tuple[str, int, int]]] = None) -> None:
+        """
+        Stores (path, value columns) pairs, stamped with the fingerprint
+        taken before the file was read (from `fingerprints`), or with the
+        file's current size/mtime when there is none.
+        """
+        rows = []
+        for p, values in items:
+            fp = fingerprints.get(p) if fingerprints else None
+            fp = fp or file_fingerprint(p)
+            if fp is None:
+                continue
+            key = (fp[0], model_tag) if self.per_model else (fp[0],)
+            rows.append((*key, fp[1], fp[2], *values))
+        if not rows:
+            return
+        names = ["path", "model"] if self.per_model else ["path"]
+        names += ["size", "mtime_ns", *self.columns]
+        with self._lock:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table} ({', '.join(names)}) VALUES ({','.join('?' * len(names))})",
+                rows,
+            )
+            self._conn.commit()
+
+    def delete(self, paths: Iterable[str], model_tag: Optional[str] = None) -> None:
+        """Drops rows for `paths` (for one model, or for all models)."""
+        abs_paths = [(os.path.abspath(p),) for p in paths]
+        with self._lock:
+            if model_tag is None or not self.per_model:
+                self._conn.executemany(f"DELETE FROM {self.table} WHERE path = ?", abs_paths)
+            else:
+                self._conn.executemany(
+                    f"DELETE FROM {self.table} WHERE path = ? AND model = ?",
+                    [(p, model_tag) for (p,) in abs_paths],
+                )
+            self._conn.commit()
+
+    def rename_many(self, pairs: List[Tuple[str, str]]) -> None:
+        """Moves every row from old to new path (a rename keeps size and mtime valid)."""
+        with self._lock:
+            _rename_rows(self._conn, self.table, pairs)
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class EmbeddingStore(FingerprintedStore):
+    """
+    Persistent image-embedding cache, one float32 vector per (absolute path,
+    model tag); a file that changed on disk gets re-embedded on the next put.
+    """
+
+    default_name = "embeddings.sqlite"
+    table = "embeddings"
+    columns = ("dim", "vector")
+    schema = """
+        CREATE TABLE IF NOT EXISTS embeddings (
+            path     TEXT    NOT NULL,
+            model    TEXT    NOT NULL,
+            size     INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            dim      INTEGER NOT NULL,
+            vector   BLOB    NOT NULL,
+            PRIMARY KEY (path, model)
+        )
+    """
+
+    def get_many(self, paths: Iterable[str], model_tag: str) -> Dict[str, np.ndarray]:
+        """
+        Looks up cached vectors for `paths`. Returns {input path: float32 vector}
+        for entries whose size and mtime still match the file on disk.
+        """
+        return {p: np.frombuffer(blob, dtype=np.float32) for p, (_, blob) in self._get_rows(paths, model_tag).items()}
+
+    def put_many(self, items: List[Tuple[str, np.ndarray]], model_tag: str,
+                 fingerprints: Optional[Dict[str, Tuple[str, int, int]]] = None) -> None:
+        """Stores (path, vector) pairs; see FingerprintedStore._put_rows for `fingerprints`."""
+        rows = []
+        for p, vec in items:
+            vec = np.ascontiguousarray(vec, dtype=np.float32).reshape(-1)
+            rows.append((p, (vec.shape[0], vec.tobytes())))
+        self._put_rows(rows, model_tag, fingerprints)
+
+    def iter_model(self, model_tag: str, chunk_size: int = 10000) -> Iterator[Tuple[List[str], np.ndarray]]:
+        """Yields (paths, [n, dim] float32 array) chunks of every vector stored for `model_tag`."""
+        last = ""
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT path, vector FROM embeddings WHERE model = ? AND path > ? "
+                    "ORDER BY path LIMIT ?",
+                    (model_tag, last, chunk_size),
+                ).fetchall()
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield [r[0] for r in rows], np.stack([np.frombuffer(r[1], dtype=np.float32) for r in rows])
+
+    def folder_snapshot(self, folder: str, model_tag: str) -> Dict[str, Tuple[int, int]]:
+        """{path: (size, mtime_ns)} as recorded for the files directly inside `folder`."""
+        folder = os.path.abspath(folder)
+        prefix = os.path.join(folder, "")
+        escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT path, size, mtime_ns FROM embeddings WHERE model = ? AND path LIKE ? ESCAPE '\\'",
+                (model_tag, escaped + "%"),
+            ).fetchall()
+        return {p: (size, mtime_ns) for p, size, mtime_ns in rows if os.path.dirname(p) == folder}
+
+    def count(self, model_tag: Optional[str] = None) -> int:
+        with self._lock:
+            if model_tag is None:
+                row = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            else:
+                row = self._conn.execute(
+                    "SELECT COUNT(*) FROM embeddings WHERE model = ?", (model_tag,)
+                ).fetchone()
+        return row[0]
+
+
+class CaptionStore(FingerprintedStore):
+    """Persistent cache of generated image captions per (absolute path, captioning model)."""
+
+    default_name = "captions.sqlite"
+    table = "captions"
+    columns = ("caption",)
+    schema = """
+        CREATE TABLE IF NOT EXISTS captions (
+            path     TEXT    NOT NULL,
+            model    TEXT    NOT NULL,
+            size     INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            caption  TEXT    NOT NULL,
+            PRIMARY KEY (path, model)
+        )
+    """
+
+    def get_many(self, paths: Iterable[str], model_tag: str) -> Dict[str, str]:
+        """Returns {input path: caption} for entries still matching the file on disk."""
+        return {p: caption for p, (caption,) in self._get_rows(paths, model_tag).items()}
+
+    def put_many(self, items: List[Tuple[str, str]], model_tag: str,
+                 fingerprints: Optional[Dict[str, Tuple[str, int, int]]] = None) -> None:
+        """Stores (path, caption) pairs; see FingerprintedStore._put_rows for `fingerprints`."""
+        self._put_rows([(p, (caption,)) for p, caption in items], model_tag, fingerprints)
+
+
+class HashStore(FingerprintedStore):
+    """Persistent cache of per-file content digests and perceptual hashes, keyed on absolute path."""
+
+    default_name = "hashes.sqlite"
+    table = "hashes"
+    columns = ("digest", "phash")
+    per_model = False
+    schema = """
+        CREATE TABLE IF NOT EXISTS hashes (
+            path     TEXT    PRIMARY KEY,
+            size     INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            digest   TEXT    NOT NULL,
+            phash    INTEGER
+        )
+    """
+
+    def get_many(self, paths: Iterable[str]) -> Dict[str, Tuple[str, Optional[int]]]:
+        """Returns {input path: (digest, phash or None)} for entries still matching the file on disk."""
+        return self._get_rows(paths)
+
+    def put_many(self, items: List[Tuple[str, str, Optional[int]]],
+                 fingerprints: Optional[Dict[str, Tuple[str, int, int]]] = None) -> None:
+        """Stores (path, digest, phash) triples; see FingerprintedStore._put_rows for `fingerprints`."""
+        self._put_rows([(p, (digest, phash)) for p, digest, phash in items], None, fingerprints)
+
+    def recorded_digests(self, paths: Iterable[str]) -> Dict[str, str]:
+        """{path: digest} as last recorded, without checking the files (which may be gone)."""
+        abs_paths = {os.path.abspath(p): p for p in paths}
+        out = {}
+        keys = list(abs_paths)
+        with self._lock:
+            for i in range(0, len(keys), _QUERY_CHUNK):
+                chunk = keys[i : i + _QUERY_CHUNK]
+                marks = ",".join("?" * len(chunk))
+                for abs_path, digest in self._conn.execute(
+                    f"SELECT path, digest FROM hashes WHERE path IN ({marks})", chunk
+                ):
+                    out[abs_paths[abs_path]] = digest
+        return out
+
+
+class TextEmbeddingCache:
+    """Thread-safe LRU of normalized prompt embeddings keyed by (model tag, prompt)."""
+
+    def __init__(self, max_size: int = TEXT_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[Tuple[str, str], Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, model_tag: str, prompt: str):
+        key = (model_tag, prompt)
+        with self._lock:
+            emb = self._items.get(key)
+            if emb is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return emb
+
+    def put(self, model_tag: str, prompt: str, emb) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[(model_tag, prompt)] = emb
+            self._items.move_to_end((model_tag, prompt))
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._items),
+                "maxSize": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,317 @@
+# folder_watcher.py
+
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from dedupe import content_digest
+from indexing import IMAGE_EXTENSIONS
+
+# Changes are applied once a folder has been quiet this long, so a burst of
+# events (a copy of 500 files, an editor's save-rename dance) is one batch.
+DEBOUNCE_SEC = float(os.environ.get("SORTER_WATCH_DEBOUNCE", 0.5))
+# Rescan interval for the polling backend (used where inotify is unavailable).
+POLL_INTERVAL = float(os.environ.get("SORTER_WATCH_POLL", 2.0))
+# "inotify", "poll", or "auto" (inotify on Linux, polling elsewhere).
+WATCH_BACKEND = os.environ.get("SORTER_WATCH_BACKEND", "auto")
+
+# {absolute path: (size, mtime_ns)} for the images directly inside a folder.
+Snapshot = Dict[str, Tuple[int, int]]
+
+
+def scan_folder(folder: str) -> Snapshot:
+    """Snapshot of the images directly inside `folder` (same filter as list_folder_images)."""
+    out = {}
+    with os.scandir(folder) as it:
+        for entry in it:
+            if os.path.splitext(entry.name)[1].lower() not in IMAGE_EXTENSIONS:
+                continue
+            try:
+                if entry.is_file():
+                    st = entry.stat()
+                    out[os.path.abspath(entry.path)] = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                continue
+    return out
+
+
+class FolderChanges:
+    """What changed in the watched folders between two snapshots."""
+
+    def __init__(self):
+        self.added: List[str] = []
+        self.modified: List[str] = []
+        self.removed: List[str] = []
+        self.renamed: List[Tuple[str, str]] = []
+
+    def __bool__(self):
+        return bool(self.added or self.modified or self.removed or self.renamed)
+
+    def to_dict(self) -> dict:
+        return {
+            "added": len(self.added),
+            "modified": len(self.modified),
+            "removed": len(self.removed),
+            "renamed": len(self.renamed),
+        }
+
+
+def diff_snapshots(previous: Snapshot, current: Snapshot,
+                   recorded_digests: Optional[Callable[[List[str]], Dict[str, str]]] = None) -> FolderChanges:
+    """
+    Compares two snapshots. A removed and an added file with the same size
+    and mtime (which a rename or move keeps) are a rename when their content
+    fingerprints agree: the digest on record for the old path against a
+    fresh digest of the new one. Without a recorded digest, a size/mtime
+    match that is unique on both sides counts as a rename.
+    """
+    changes = FolderChanges()
+    removed = [p for p in previous if p not in current]
+    added = [p for p in current if p not in previous]
+    changes.modified = [p for p in current if p in previous and previous[p] != current[p]]
+
+    by_key = {}
+    for p in removed:
+        by_key.setdefault(previous[p], []).append(p)
+    candidates = [p for p in added if current[p] in by_key]
+    recorded = recorded_digests([q for p in candidates for q in by_key[current[p]]]) if (
+        candidates and recorded_digests) else {}
+    added_keys = {}
+    for p in candidates:
+        added_keys.setdefault(current[p], []).append(p)
+
+    matched = set()
+    for new in candidates:
+        olds = [o for o in by_key[current[new]] if o not in matched]
+        if not olds:
+            continue
+        if any(o in recorded for o in olds):
+            try:
+                digest = content_digest(new)
+            except OSError:
+                continue
+            old = next((o for o in olds if recorded.get(o) == digest), None)
+        elif len(olds) == 1 and len(added_keys[current[new]]) == 1:
+            old = olds[0]
+        else:
+            old = None
+        if old is not None:
+            matched.update((old, new))
+            changes.renamed.append((old, new))
+    changes.added = [p for p in added if p not in matched]
+    changes.removed = [p for p in removed if p not in matched]
+    return changes
+
+
+class _Inotify:
+    """Minimal inotify binding (ctypes, Linux only): which watched directories saw events."""
+
+    _MASK = (0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800)  # modify/attrib/close_write/moves/create/delete/self
+    _HEADER = struct.Struct("iIII")
+    _Q_OVERFLOW = 0x4000
+    # Returned by read() when the kernel queue overflowed and events were lost.
+    OVERFLOW = -1
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add(self, folder: str) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(folder), self._MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {folder}")
+        return wd
+
+    def remove(self, wd: int):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout: float) -> List[int]:
+        """
+        Watch descriptors with events, waiting up to `timeout` seconds;
+        OVERFLOW among them means some events were dropped.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buf = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        wds, pos = [], 0
+        while pos + self._HEADER.size <= len(buf):
+            wd, mask, _, name_len = self._HEADER.unpack_from(buf, pos)
+            wds.append(self.OVERFLOW if mask & self._Q_OVERFLOW else wd)
+            pos += self._HEADER.size + name_len
+        return wds
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FolderWatcher:
+    """
+    Watches folders (not recursively, like list_folder_images) on a
+    background thread and reports what changed in them.
+
+    Each folder keeps a snapshot. Events (inotify) or periodic rescans
+    (polling) mark folders dirty; once DEBOUNCE_SEC passes without new
+    events, every dirty folder is rescanned and diffed together, so a move
+    between two watched folders is seen as a rename, and
+    `on_change(changes)` gets one FolderChanges for the batch.
+
+    `watch(folder, baseline)` takes the snapshot the caller last knew (e.g.
+    what the embedding cache holds), so changes made while nothing was
+    watching are reported on the first scan.
+    """
+
+    def __init__(self, on_change: Callable[[FolderChanges], None],
+                 recorded_digests: Optional[Callable[[List[str]], Dict[str, str]]] = None,
+                 backend: str = WATCH_BACKEND, state_path: Optional[str] = None):
+        self.on_change = on_change
+        self.recorded_digests = recorded_digests
+        self.state_path = state_path
+        self.backend = "poll"
+        self._inotify = None
+        if backend in ("auto", "inotify") and sys.platform.startswith("linux"):
+            try:
+                self._inotify = _Inotify()
+                self.backend = "inotify"
+            except OSError as e:
+                print(f"[watch] WARNING: inotify unavailable ({e}); polling every {POLL_INTERVAL}s.")
+        self._snapshots: Dict[str, Snapshot] = {}
+        self._wds: Dict[int, str] = {}
+        self._dirty: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.totals = FolderChanges().to_dict()
+        self.scans = 0
+        self._thread = threading.Thread(target=self._run, name="folder-watcher", daemon=True)
+        self._thread.start()
+
+    def watch(self, folder: str, baseline: Optional[Snapshot] = None) -> None:
+        folder = os.path.abspath(folder)
+        with self._lock:
+            if folder in self._snapshots:
+                return
+            self._snapshots[folder] = dict(baseline or {})
+            if self._inotify is not None:
+                try:
+                    self._wds[self._inotify.add(folder)] = folder
+                except OSError as e:
+                    print(f"[watch] WARNING: cannot watch {folder}: {e}")
+                    del self._snapshots[folder]
+                    return
+            self._dirty[folder] = 0.0  # first scan right away
+        self._save()
+        print(f"[watch] Watching {folder} ({self.backend}).")
+
+    def unwatch(self, folder: str) -> bool:
+        folder = os.path.abspath(folder)
+        with self._lock:
+            if self._snapshots.pop(folder, None) is None:
+                return False
+            self._dirty.pop(folder, None)
+            for wd, f in list(self._wds.items()):
+                if f == folder:
+                    self._inotify.remove(wd)
+                    del self._wds[wd]
+        self._save()
+        return True
+
+    def folders(self) -> List[str]:
+        with self._lock:
+            return list(self._snapshots)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=2)
+        if self._inotify is not None:
+            self._inotify.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": self.backend,
+                "folders": list(self._snapshots),
+                "files": sum(len(s) for s in self._snapshots.values()),
+                "scans": self.scans,
+                "changes": dict(self.totals),
+            }
+
+    def _save(self):
+        if not self.state_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            with open(self.state_path, "w") as f:
+                json.dump(self.folders(), f)
+        except OSError as e:
+            print(f"[watch] WARNING: could not save {self.state_path}: {e}")
+
+    def _run(self):
+        next_poll = time.monotonic() + POLL_INTERVAL
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if self._inotify is not None:
+                wds = self._inotify.read(DEBOUNCE_SEC / 2)
+                now = time.monotonic()
+                with self._lock:
+                    if _Inotify.OVERFLOW in wds:
+                        # Events were lost; only a rescan of every folder is safe.
+                        print("[watch] WARNING: inotify queue overflowed; rescanning all watched folders.")
+                        wds = list(self._wds)
+                    for wd in wds:
+                        if wd in self._wds:
+                            self._dirty[self._wds[wd]] = now
+            else:
+                self._stop.wait(DEBOUNCE_SEC / 2)
+                now = time.monotonic()
+                if now >= next_poll:
+                    next_poll = now + POLL_INTERVAL
+                    with self._lock:
+                        for folder in self._snapshots:
+                            self._dirty.setdefault(folder, 0.0)
+            with self._lock:
+                quiet = [f for f, t in self._dirty.items() if now - t >= DEBOUNCE_SEC]
+                for f in quiet:
+                    del self._dirty[f]
+            if quiet:
+                try:
+                    self._reconcile(quiet)
+                except Exception as e:
+                    print(f"[watch] WARNING: rescan failed: {e}")
+
+    def _reconcile(self, folders: List[str]):
+        previous, current, scanned = {}, {}, {}
+        for folder in folders:
+            with self._lock:
+                old = self._snapshots.get(folder)
+            if old is None:
+                continue  # unwatched meanwhile
+            try:
+                new = scan_folder(folder)
+            except OSError:
+                new = {}  # folder deleted or unreadable: everything in it is gone
+            previous.update(old)
+            current.update(new)
+            scanned[folder] = new
+        self.scans += 1
+        changes = diff_snapshots(previous, current, self.recorded_digests)
+        with self._lock:
+            for folder, new in scanned.items():
+                if folder in self._snapshots:
+                    self._snapshots[folder] = new
+        if changes:
+            for name, count in changes.to_dict().items():
+                self.totals[name] += count
+            print(f"[watch] {changes.to_dict()} in {len(scanned)} folder(s).")
+            self.on_change(changes)
@@ -1,7 +1,10 @@
+import json
 import subprocess
 import sys
 import os
 import time
+import urllib.error
+import urllib.request
 
 # --- Configuration ---
 PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -9,6 +12,8 @@ VENV_DIR = os.path.join(PROJECT_DIR, ".venv311")
 NODE_MODULES_DIR = os.path.join(PROJECT_DIR, "node_modules")
 REQUIREMENTS_FILE = os.path.join(PROJECT_DIR, "requirements.txt")
 PYTHON_SERVER_SCRIPT = os.path.join(PROJECT_DIR, "unified_sorter_server.py")
+SERVER_READY_URL = "http://127.0.0.1:8000/ready"
+SERVER_READY_TIMEOUT = 300  # seconds; the very first start also downloads model weights
 
 # --- Platform-specific Executable Names ---
 if sys.platform == "win32":
@@ -109,6 +114,28 @@ def check_and_install_npm_deps():
         print("Please ensure Node.js and npm are installed and in your PATH.")
         return False
 
+def wait_for_server(proc, timeout=SERVER_READY_TIMEOUT):
+    """
+    Polls the server's /ready endpoint until it reports ready, the server
+    process exits, or `timeout` seconds pass. Returns the /ready body, or None.
+    """
+    start = time.time()
+    while time.time() - start < timeout:
+        if proc.poll() is not None:
+            print(f"   Python server exited with code {proc.returncode}.")
+            return None
+        try:
+            with urllib.request.urlopen(SERVER_READY_URL, timeout=2) as resp:
+                return json.load(resp)
+        except urllib.error.HTTPError as e:
+            if e.code != 503:  # 503 = up, but models still loading
+                print(f"   Unexpected /ready response: {e.code}")
+        except (urllib.error.URLError, OSError):
+            pass  # not listening yet
+        time.sleep(0.25)
+    print(f"   Server not ready after {timeout}s.")
+    return None
+
 # --- Main Execution ---
 
 if __name__ == "__main__":
@@ -126,10 +153,17 @@ if __name__ == "__main__":
         print_header("Starting Development Servers...")
 
         print(f"-> Launching Python server...")
+        launched = time.time()
         python_proc = subprocess.Popen(python_server_cmd, cwd=PROJECT_DIR)
 
-        print("   (Waiting 8 seconds for server to spin up...)")
-        time.sleep(8)
+        print("   (Waiting for the server to report ready...)")
+        status = wait_for_server(python_proc)
+        if status is None and python_proc.poll() is not None:
+            sys.exit(1)
+        if status is not None:
+            print(f"   Server ready in {time.time() - launched:.1f}s "
+                  f"(CLIP {'loaded' if status.get('clip') else 'unavailable'}; "
+                  f"stages: {status.get('timings')})")
 
         print(f"-> Launching Electron app...")
         electron_proc = subprocess.Popen(electron_app_cmd, cwd=PROJECT_DIR, shell=(sys.platform == "win32"))
@@ -0,0 +1,164 @@
+# image_pipeline.py
+
+import io
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import PIL.ExifTags
+import PIL.Image
+import torch
+
+from metrics import timed
+
+# Decode/preprocess threads and how many batches to prepare ahead of the one
+# the model is encoding. PIL releases the GIL while decoding and resizing, so
+# threads scale with cores without the pickling cost of a process pool.
+DECODE_WORKERS = int(os.environ.get("SORTER_DECODE_WORKERS", min(8, os.cpu_count() or 1)))
+PREFETCH_BATCHES = int(os.environ.get("SORTER_PREFETCH_BATCHES", 2))
+
+# The fast loader never hands CLIP less than this many pixels on the short
+# side. CLIP itself needs 224; the headroom keeps the final bicubic resize in
+# the open_clip transform doing real antialiasing. Set SORTER_FAST_LOAD=0 to
+# always decode at full resolution.
+FAST_LOAD = os.environ.get("SORTER_FAST_LOAD", "1") != "0"
+FAST_LOAD_MIN_SIDE = int(os.environ.get("SORTER_FAST_LOAD_MIN_SIDE", 448))
+
+_EXIF_THUMB_OFFSET, _EXIF_THUMB_LENGTH = 0x0201, 0x0202
+
+# Decode pools live for the whole process (one per thread count), so calls
+# do not pay thread start-up and concurrent callers share the same threads.
+_DECODE_POOLS = {}
+_DECODE_POOLS_LOCK = threading.Lock()
+
+
+def decode_pool(workers: int = DECODE_WORKERS) -> ThreadPoolExecutor:
+    workers = max(1, workers)
+    with _DECODE_POOLS_LOCK:
+        pool = _DECODE_POOLS.get(workers)
+        if pool is None:
+            pool = _DECODE_POOLS[workers] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decode")
+        return pool
+
+
+def load_image(path: str) -> PIL.Image.Image:
+    """Opens `path` and returns it as an RGB PIL image."""
+    with timed("open"):
+        img = PIL.Image.open(path)
+    with img, timed("decode"):
+        return img.convert("RGB")
+
+
+def _exif_thumbnail(img: PIL.Image.Image, min_side: int) -> Optional[PIL.Image.Image]:
+    """Returns the embedded EXIF JPEG thumbnail if its short side is >= min_side."""
+    raw = img.info.get("exif")
+    if not raw:
+        return None
+    try:
+        ifd1 = img.getexif().get_ifd(PIL.ExifTags.IFD.IFD1)
+        offset, length = ifd1.get(_EXIF_THUMB_OFFSET), ifd1.get(_EXIF_THUMB_LENGTH)
+        if not offset or not length:
+            return None
+        # Offsets are relative to the TIFF header, which follows "Exif\0\0".
+        start = 6 + offset if raw.startswith(b"Exif") else offset
+        thumb = PIL.Image.open(io.BytesIO(raw[start : start + length]))
+        if min(thumb.size) < min_side:
+            return None
+        # Some cameras letterbox the thumbnail; only trust same-aspect ones.
+        (w, h), (tw, th) = img.size, thumb.size
+        if abs(w / h - tw / th) > 0.02 * (w / h):
+            return None
+        return thumb.convert("RGB")
+    except Exception:
+        return None
+
+
+def load_image_fast(path: str, min_side: int = FAST_LOAD_MIN_SIDE) -> PIL.Image.Image:
+    """
+    Like load_image, but avoids decoding more pixels than CLIP can use.
+
+    JPEGs use a large-enough embedded EXIF thumbnail when there is one, and
+    otherwise decode in draft mode (libjpeg DCT scaling to 1/2, 1/4 or 1/8).
+    Other formats are decoded fully and then shrunk with Image.reduce, which
+    is much cheaper than the bicubic resize in the CLIP transform.
+    The short side of the result is always >= min_side (or the original size).
+    """
+    with timed("open"):
+        img = PIL.Image.open(path)
+    with img, timed("decode"):
+        if img.format == "JPEG":
+            thumb = _exif_thumbnail(img, min_side)
+            if thumb is not None:
+                return thumb
+            img.draft("RGB", (min_side, min_side))
+        img = img.convert("RGB")
+        factor = min(img.size) // min_side
+        if factor >= 2:
+            img = img.reduce(factor)
+        return img
+
+
+def default_loader() -> Callable[[str], PIL.Image.Image]:
+    return load_image_fast if FAST_LOAD else load_image
+
+
+def vector_tag(model_tag: str) -> str:
+    """
+    Key for cached image vectors of `model_tag`. The fast loader feeds CLIP
+    different pixels than a full decode, so the loader mode (and its
+    minimum side) is part of the key: flipping SORTER_FAST_LOAD never mixes
+    vectors from both loaders in one cache or index.
+    """
+    return f"{model_tag}@{f'fast{FAST_LOAD_MIN_SIDE}' if FAST_LOAD else 'full'}"
+
+
+def iter_preprocessed_batches(
+    paths: List[str],
+    preprocess: Callable,
+    batch_size: int = 16,
+    workers: int = DECODE_WORKERS,
+    prefetch: int = PREFETCH_BATCHES,
+    loader: Optional[Callable[[str], PIL.Image.Image]] = None,
+    on_decoded: Optional[Callable[[str, PIL.Image.Image], None]] = None,
+) -> Iterator[Tuple[List[str], torch.Tensor]]:
+    """
+    Yields (batch_paths, batch_tensor) in input order.
+
+    Images are decoded and preprocessed on a thread pool; while the caller
+    encodes batch N, batches N+1 .. N+prefetch are already being prepared.
+    Decode errors are raised when their batch is reached. `loader` defaults
+    to load_image_fast unless SORTER_FAST_LOAD=0. `on_decoded(path, image)`
+    runs on the decode thread for every loaded image, before preprocessing.
+    """
+    loader = loader or default_loader()
+    batches = (paths[i : i + batch_size] for i in range(0, len(paths), batch_size))
+
+    def prepare(p):
+        img = loader(p)
+        if on_decoded is not None:
+            on_decoded(p, img)
+        with timed("preprocess"):
+            return preprocess(img)
+
+    pool = decode_pool(workers)
+    pending = deque()
+
+    def submit_next():
+        batch = next(batches, None)
+        if batch is not None:
+            pending.append((batch, [pool.submit(prepare, p) for p in batch]))
+
+    try:
+        for _ in range(max(0, prefetch) + 1):
+            submit_next()
+        while pending:
+            batch, futures = pending.popleft()
+            submit_next()
+            yield batch, torch.stack([f.result() for f in futures])
+    finally:
+        # The pool is shared: cancel only this call's queued decodes.
+        for _, futures in pending:
+            for f in futures:
+                f.cancel()
@@ -0,0 +1,180 @@
+# indexing.py
+
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+# Same extension filter the Electron "open-folder" handler uses.
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".webp")
+
+# How many finished jobs to remember for GET /index/{id}.
+MAX_FINISHED_JOBS = 32
+
+# Paths handed to embed_fn per call. Spans much larger than one model batch
+# keep the decode pipeline (and the embedding processes, if any) busy
+# across batches; progress and cancellation are checked per span.
+INDEX_SPAN = int(os.environ.get("SORTER_INDEX_SPAN", 256))
+
+
+def list_folder_images(folder: str) -> List[str]:
+    """Returns the absolute paths of the images directly inside `folder`."""
+    return [
+        os.path.join(folder, name)
+        for name in sorted(os.listdir(folder))
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+    ]
+
+
+class IndexJob:
+    """Progress record for one background pre-embedding run."""
+
+    def __init__(self, paths: List[str], folder: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.folder = folder
+        self.paths = list(dict.fromkeys(paths))
+        self.total = len(self.paths)
+        self.done = 0          # paths that have a vector (cached or freshly encoded)
+        self.cached = 0        # of which were already in the cache
+        self.failed = 0        # paths that could not be decoded/encoded
+        self.position = 0      # paths[position:] have not been embedded yet (includes the span in progress)
+        self.status = "queued"  # queued | running | done | error | cancelled
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.cancelled = threading.Event()
+        self.finished_event = threading.Event()
+
+    def to_dict(self) -> dict:
+        end = self.finished or time.time()
+        return {
+            "jobId": self.id,
+            "folderPath": self.folder,
+            "status": self.status,
+            "total": self.total,
+            "done": self.done,
+            "cached": self.cached,
+            "failed": self.failed,
+            "error": self.error,
+            "elapsedSec": round(end - self.created, 3),
+        }
+
+
+class Indexer:
+    """
+    Runs IndexJobs on a background thread, one span of paths at a time.
+
+    `missing_fn(paths)` returns the subset of paths that still need a vector;
+    `embed_fn(paths, job_size)` encodes them and writes them to the embedding
+    cache, where `job_size` is the job's path count (so the encoder can size
+    its work to the job, not the span).
+    The cache is re-checked before every span, so anything a sort request
+    embedded in the meantime is skipped rather than encoded twice.
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable[[List[str], int], object],
+        missing_fn: Callable[[List[str]], List[str]],
+        batch_size: int = 16,
+        span: int = INDEX_SPAN,
+    ):
+        self.embed_fn = embed_fn
+        self.missing_fn = missing_fn
+        self.batch_size = batch_size
+        self.span = max(span, batch_size)
+        self._jobs: "OrderedDict[str, IndexJob]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, paths: List[str], folder: Optional[str] = None, skip_queued: bool = False) -> IndexJob:
+        """
+        Starts indexing `paths`, or returns the job already running for
+        `folder`. With `skip_queued`, paths an active job has not finished
+        (including the span it is encoding) are left to that job. A file
+        edited while its span encodes is still re-read later: its cache
+        row carries the fingerprint from before the read.
+        """
+        with self._lock:
+            if folder is not None:
+                for job in self._jobs.values():
+                    if job.folder == folder and job.status in ("queued", "running"):
+                        return job
+            if skip_queued:
+                queued = {
+                    p for j in self._jobs.values() if j.status in ("queued", "running")
+                    for p in j.paths[j.position :]
+                }
+                paths = [p for p in paths if p not in queued]
+            job = IndexJob(paths, folder)
+            self._jobs[job.id] = job
+            self._prune()
+        threading.Thread(target=self._run, args=(job,), daemon=True).start()
+        return job
+
+    def get(self, job_id: str) -> Optional[IndexJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        if job is None:
+            return False
+        job.cancelled.set()
+        return True
+
+    def active_jobs(self) -> List[IndexJob]:
+        with self._lock:
+            return [j for j in self._jobs.values() if j.status in ("queued", "running")]
+
+    def _prune(self):
+        finished = [j for j in self._jobs.values() if j.status not in ("queued", "running")]
+        for job in finished[: max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job.id]
+
+    def _run(self, job: IndexJob):
+        job.status = "running"
+        try:
+            for i in range(0, job.total, self.span):
+                if job.cancelled.is_set():
+                    job.status = "cancelled"
+                    return
+                span = job.paths[i : i + self.span]
+                todo = self.missing_fn(span)
+                job.cached += len(span) - len(todo)
+                if todo:
+                    self._embed_span(job, todo)
+                # Only now: until the span is written, skip_queued leaves it to this job.
+                job.position = i + len(span)
+                job.done = i + len(span) - job.failed
+            job.status = "done"
+        except Exception as e:
+            job.status = "error"
+            job.error = str(e)
+            print(f"[index] Job {job.id} failed: {e}")
+        finally:
+            job.finished = time.time()
+            job.finished_event.set()
+
+    def _embed_span(self, job: IndexJob, paths: List[str]):
+        try:
+            self.embed_fn(paths, job.total)
+        except Exception:
+            # One unreadable file fails the whole span; retry it batch by
+            # batch, and a failing batch file by file, so the rest still
+            # gets indexed.
+            for i in range(0, len(paths), self.batch_size):
+                batch = paths[i : i + self.batch_size]
+                if len(batch) > 1:
+                    try:
+                        self.embed_fn(batch, job.total)
+                        continue
+                    except Exception:
+                        pass
+                for p in batch:
+                    try:
+                        self.embed_fn([p], job.total)
+                    except Exception as e:
+                        job.failed += 1
+                        print(f"[index] Skipping {p}: {e}")
@@ -0,0 +1,211 @@
+# inference.py
+
+import asyncio
+import functools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+import torch
+
+from metrics import METRICS_ENABLED, observe_stage, sync_cuda
+
+# Request handlers run on this many threads; requests beyond MAX_PENDING are
+# rejected instead of piling up behind a long sort. The model itself is only
+# driven by the MicroBatcher threads, so several handlers can be in flight
+# without oversubscribing torch's intra-op parallelism.
+INFERENCE_WORKERS = int(os.environ.get("SORTER_INFERENCE_WORKERS", 4))
+MAX_PENDING = int(os.environ.get("SORTER_MAX_PENDING", 8))
+# Of those threads, at most this many run background work (index spans) at
+# once; the rest stay free for requests. Capped at workers - 1.
+BACKGROUND_WORKERS = int(os.environ.get("SORTER_BACKGROUND_WORKERS", max(1, INFERENCE_WORKERS // 4)))
+
+# Cross-request batching: a batch is launched once it holds MAX_BATCH items
+# or its oldest item has waited MAX_WAIT_MS, whichever comes first.
+MAX_IMAGE_BATCH = int(os.environ.get("SORTER_MAX_IMAGE_BATCH", 32))
+MAX_TEXT_BATCH = int(os.environ.get("SORTER_MAX_TEXT_BATCH", 64))
+MAX_WAIT_MS = float(os.environ.get("SORTER_MAX_WAIT_MS", 10))
+
+_CLOSE = object()
+
+
+class InferenceQueueFull(Exception):
+    pass
+
+
+class InferenceExecutor:
+    """
+    Dedicated thread pool for blocking model/file work.
+
+    `run()` is awaited from request handlers and counts against the
+    admission limit; `call()` is the blocking form used by background
+    threads (e.g. the indexer). It is never rejected but waits until fewer
+    than `background` calls are in the pool, so background work never holds
+    more than that many workers and requests always find one free.
+    """
+
+    def __init__(self, workers: int = INFERENCE_WORKERS, max_pending: int = MAX_PENDING,
+                 background: int = BACKGROUND_WORKERS):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.background = max(1, min(background, workers - 1))
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inference")
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._background_slots = threading.BoundedSemaphore(self.background)
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def submit(self, fn: Callable, *args, **kwargs) -> asyncio.Future:
+        """
+        Schedules `fn` and returns an awaitable future. Admission is checked
+        immediately, so InferenceQueueFull is raised before anything runs.
+        Must be called from the event loop.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise InferenceQueueFull(
+                    f"{self._pending} inference jobs pending (limit {self.max_pending})."
+                )
+            self._pending += 1
+        # The slot is freed when the job itself ends, in the worker thread:
+        # a client disconnect cancels the awaiting future while the job is
+        # still running, and it must keep counting until it stops.
+        job = self._pool.submit(self._run_job, functools.partial(fn, *args, **kwargs))
+        job.add_done_callback(self._release_if_cancelled)
+        return asyncio.wrap_future(job)
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        return await self.submit(fn, *args, **kwargs)
+
+    def _run_job(self, call: Callable):
+        try:
+            return call()
+        finally:
+            self._release()
+
+    def _release_if_cancelled(self, job: Future):
+        # Cancelled before a worker picked it up: _run_job never ran.
+        if job.cancelled():
+            self._release()
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+    def call(self, fn: Callable, *args, **kwargs):
+        with self._background_slots:
+            return self._pool.submit(fn, *args, **kwargs).result()
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "pending": self._pending, "maxPending": self.max_pending,
+                "backgroundWorkers": self.background}
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class MicroBatcher:
+    """
+    Merges tensors submitted from many threads into batches for one model call.
+
+    Callers `submit()` an [n, ...] tensor and get a Future for the matching
+    [n, ...] slice of `fn`'s output. A single worker thread concatenates
+    pending submissions until `max_batch` rows are queued or the oldest has
+    waited `max_wait_ms`, then runs `fn` once and splits the result. A single
+    submission larger than `max_batch` runs on its own.
+    """
+
+    def __init__(self, fn: Callable, max_batch: int, max_wait_ms: float = MAX_WAIT_MS, name: str = "batcher",
+                 stage: Optional[str] = None):
+        self.fn = fn
+        # Metrics stage for the model call ("<stage>") and each submission's wait ("<stage>_wait").
+        self.stage = stage
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._requests = 0
+        self._wait_total = 0.0
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, items: torch.Tensor) -> Future:
+        fut = Future()
+        self._queue.put((items, fut, time.perf_counter()))
+        return fut
+
+    def __call__(self, items: torch.Tensor) -> torch.Tensor:
+        return self.submit(items).result()
+
+    def stats(self) -> dict:
+        with self._lock:
+            batches = self._batches
+            return {
+                "batches": batches,
+                "items": self._items,
+                "requests": self._requests,
+                "maxBatch": self.max_batch,
+                "meanBatchSize": round(self._items / batches, 2) if batches else 0.0,
+                "fillRate": round(self._items / (batches * self.max_batch), 4) if batches else 0.0,
+                "meanQueueWaitMs": round(1000 * self._wait_total / self._requests, 3) if self._requests else 0.0,
+            }
+
+    def close(self):
+        self._queue.put(_CLOSE)
+
+    def _loop(self):
+        carry = None
+        while True:
+            first = carry if carry is not None else self._queue.get()
+            carry = None
+            if first is _CLOSE:
+                return
+            group, size = [first], len(first[0])
+            deadline = first[2] + self.max_wait
+            while size < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    nxt = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if nxt is _CLOSE or size + len(nxt[0]) > self.max_batch:
+                    carry = nxt
+                    break
+                group.append(nxt)
+                size += len(nxt[0])
+            self._run(group, size)
+
+    def _run(self, group, size):
+        started = time.perf_counter()
+        try:
+            batch = group[0][0] if len(group) == 1 else torch.cat([g[0] for g in group])
+            out = self.fn(batch)
+            if self.stage:
+                if METRICS_ENABLED:
+                    sync_cuda(getattr(out, "device", None))
+                observe_stage(self.stage, time.perf_counter() - started)
+                for g in group:
+                    observe_stage(self.stage + "_wait", started - g[2])
+            offset = 0
+            for items, fut, _ in group:
+                fut.set_result(out[offset : offset + len(items)])
+                offset += len(items)
+        except Exception as e:
+            for _, fut, _ in group:
+                if not fut.done():
+                    fut.set_exception(e)
+        with self._lock:
+            self._batches += 1
+            self._items += size
+            self._requests += len(group)
+            self._wait_total += sum(started - g[2] for g in group)
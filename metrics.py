@@ -0,0 +1,316 @@
+# metrics.py
+
+import bisect
+import contextvars
+import cProfile
+import os
+import threading
+import time
+import uuid
+from contextlib import nullcontext
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from embedding_store import DEFAULT_CACHE_DIR
+
+# Stage and request timers. Off (SORTER_METRICS=0) they are a shared no-op
+# context manager; counters and gauges stay on, they cost one add per batch.
+METRICS_ENABLED = os.environ.get("SORTER_METRICS", "1") != "0"
+# Requests sent with this header ("cprofile" or "torch") run their inference
+# job under a profiler; the trace is written to PROFILE_DIR and its path
+# returned in the same header of the response (streamed responses, whose
+# headers go out before the trace exists, only log it). SORTER_PROFILING=0
+# ignores it.
+PROFILE_HEADER = "x-sorter-profile"
+PROFILING_ENABLED = os.environ.get("SORTER_PROFILING", "1") != "0"
+PROFILE_MODES = ("cprofile", "torch")
+PROFILE_DIR = os.path.join(DEFAULT_CACHE_DIR, "profiles")
+
+# Histogram upper bounds in seconds: sub-millisecond per-image stages up to
+# whole-folder requests.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic count per label set."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *labels: str):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, labels, "", value) for labels, value in self._values.items()]
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label set, in the Prometheus layout."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        # label set -> [per-bucket counts (+Inf last), sum]
+        self._series: Dict[Labels, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][slot] += 1
+            series[1] += value
+
+    def samples(self):
+        out = []
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        for labels, counts, total in series:
+            running = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                running += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                out.append((self.name + "_bucket", labels, f'le="{le}"', running))
+            out.append((self.name + "_sum", labels, "", total))
+            out.append((self.name + "_count", labels, "", running))
+        return out
+
+
+class Gauge:
+    """Read at scrape time from `fn`: a number, or {label values: number}."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn: Callable, labels: Sequence[str] = (), kind: str = "gauge"):
+        self.name, self.help, self.labels, self.fn, self.kind = name, help, tuple(labels), fn, kind
+
+    def samples(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        if value is None:
+            return []
+        if isinstance(value, dict):
+            return [(self.name, labels, "", v) for labels, v in value.items()]
+        return [(self.name, (), "", value)]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, fn: Callable, labels: Sequence[str] = (), kind: str = "gauge") -> Gauge:
+        """`kind="counter"` for totals kept elsewhere (e.g. a stats() dict) and read on scrape."""
+        return self._register(Gauge(name, help, fn, labels, kind))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Prometheus text exposition format (0.0.4)."""
+        lines = []
+        for m in self._metrics:
+            samples = m.samples()
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for name, labels, extra, value in samples:
+                lines.append(f"{name}{_label_text(m.labels, labels, extra)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.histogram(
+    "sorter_stage_seconds", "Time spent in one pipeline stage (per image for open/decode/preprocess).", ("stage",)
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    "sorter_request_seconds", "HTTP request latency, streamed responses until their last byte.", ("route", "status")
+)
+IMAGES = REGISTRY.counter(
+    "sorter_images_total", "Images embedded, by source: cache hit, model encode, or copy of an encoded file.",
+    ("source",),
+)
+
+_NULL_TIMER = nullcontext()
+
+
+def sync_cuda(device) -> None:
+    """Waits for the kernels queued on `device` if it is a CUDA device, so a timer covers them."""
+    if getattr(device, "type", None) == "cuda":
+        import torch
+
+        torch.cuda.synchronize(device)
+
+
+class _StageTimer:
+    __slots__ = ("stage", "device", "start")
+
+    def __init__(self, stage: str, device=None):
+        self.stage = stage
+        self.device = device
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        sync_cuda(self.device)
+        STAGE_SECONDS.observe(time.perf_counter() - self.start, self.stage)
+        return False
+
+
+def timed(stage: str, device=None):
+    """
+    `with timed("decode"): ...` records the block in sorter_stage_seconds.
+    CUDA kernels run asynchronously; pass the `device` a block launches work
+    on and the timer waits for it before stopping (only with metrics on).
+    """
+    return _StageTimer(stage, device) if METRICS_ENABLED else _NULL_TIMER
+
+
+def observe_stage(stage: str, seconds: float):
+    if METRICS_ENABLED:
+        STAGE_SECONDS.observe(seconds, stage)
+
+
+class RequestProfile:
+    """A profiling request: its mode and where the trace goes."""
+
+    def __init__(self, mode: str, profile_dir: str, route: str):
+        self.mode = mode
+        slug = route.strip("/").replace("/", "-") or "root"
+        ext = "prof" if mode == "cprofile" else "json"
+        self.path = os.path.join(profile_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{slug}-{uuid.uuid4().hex[:8]}.{ext}")
+        self.written = False  # set once the trace is on disk
+
+
+# Set for the duration of a request that asked to be profiled.
+CURRENT_PROFILE: contextvars.ContextVar[Optional[RequestProfile]] = contextvars.ContextVar(
+    "sorter_profile", default=None
+)
+# torch.profiler is process-wide, so only one torch trace runs at a time.
+_TORCH_PROFILE_LOCK = threading.Lock()
+
+
+def profiled(fn: Callable, profile: Optional[RequestProfile]) -> Callable:
+    """
+    Wraps `fn` to run under `profile`'s profiler in whichever thread calls
+    it. cProfile sees that thread only (time inside the batcher shows up as
+    waiting on its future); the torch trace covers model ops on every thread.
+    """
+    if profile is None:
+        return fn
+
+    def run(*args, **kwargs):
+        os.makedirs(os.path.dirname(profile.path), exist_ok=True)
+        if profile.mode == "cprofile":
+            prof = cProfile.Profile()
+            try:
+                return prof.runcall(fn, *args, **kwargs)
+            finally:
+                prof.dump_stats(profile.path)
+                profile.written = True
+                print(f"[metrics] cProfile trace: {profile.path}")
+        if not _TORCH_PROFILE_LOCK.acquire(blocking=False):
+            print("[metrics] WARNING: a torch trace is already running; request not profiled.")
+            return fn(*args, **kwargs)
+        try:
+            import torch.profiler
+
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            with torch.profiler.profile(activities=activities) as prof:
+                result = fn(*args, **kwargs)
+            prof.export_chrome_trace(profile.path)
+            profile.written = True
+            print(f"[metrics] torch trace: {profile.path}")
+            return result
+        finally:
+            _TORCH_PROFILE_LOCK.release()
+
+    return run
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware: times every HTTP request into sorter_request_seconds
+    (labelled by route template, so /index/{job_id} is one series) and
+    starts a RequestProfile when the PROFILE_HEADER asks for one. With
+    metrics off and no profile header it only forwards the call.
+    """
+
+    def __init__(self, app, profile_dir: str = PROFILE_DIR):
+        self.app = app
+        self.profile_dir = profile_dir
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        profile = None
+        if PROFILING_ENABLED:
+            for key, value in scope["headers"]:
+                if key == PROFILE_HEADER.encode():
+                    mode = value.decode().strip().lower()
+                    if mode in PROFILE_MODES:
+                        profile = RequestProfile(mode, self.profile_dir, scope["path"])
+                    break
+        if not METRICS_ENABLED and profile is None:
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                # Streamed responses start before their trace is written;
+                # those traces are only logged.
+                if profile is not None and profile.written:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (PROFILE_HEADER.encode(), profile.path.encode())
+                    ]
+            await send(message)
+
+        token = CURRENT_PROFILE.set(profile)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            CURRENT_PROFILE.reset(token)
+            if METRICS_ENABLED:
+                route = scope.get("route")
+                REQUEST_SECONDS.observe(time.perf_counter() - start,
+                                        getattr(route, "path", "unmatched"), str(status[0]))
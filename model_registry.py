@@ -0,0 +1,282 @@
+# model_registry.py
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+import torch
+
+from clip_engines import ENGINE, build_engine
+from embedding_store import DEFAULT_CACHE_DIR
+from inference import MicroBatcher, MAX_IMAGE_BATCH, MAX_TEXT_BATCH
+from sharded_encoder import EMBED_PROCESSES, ShardedImageEncoder
+
+# Models are named by "<open_clip architecture>/<pretrained tag>". The default
+# serves every request without a `model` and backs the library index; the
+# others are loaded on first use, e.g. a small model for previews and a
+# larger one for the final ordering.
+DEFAULT_MODEL = os.environ.get("SORTER_DEFAULT_MODEL", "ViT-B-32/openai")
+AVAILABLE_MODELS = list(dict.fromkeys(
+    [DEFAULT_MODEL]
+    + [t.strip() for t in os.environ.get("SORTER_MODELS", "ViT-B-16/openai,ViT-L-14/openai").split(",") if t.strip()]
+))
+# Resident models are evicted (least recently used, idle, never the default)
+# once their weights add up to more than this.
+MODEL_MEMORY_BUDGET_MB = int(os.environ.get("SORTER_MODEL_MEMORY_MB", 3072))
+
+# Building a model through open_clip (random init, then reading the
+# checkpoint) is most of a cold start. The first load serializes the built
+# model here; later loads torch.load it, memory-mapped unless disabled.
+MODEL_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, "models")
+MODEL_CACHE = os.environ.get("SORTER_MODEL_CACHE", "1") != "0"
+MMAP_WEIGHTS = os.environ.get("SORTER_MMAP_WEIGHTS", "1") != "0"
+
+
+def split_tag(tag: str) -> Tuple[str, str]:
+    name, _, pretrained = tag.partition("/")
+    return name, pretrained
+
+
+def model_cache_path(name: str, pretrained: str) -> str:
+    import open_clip
+
+    return os.path.join(
+        MODEL_CACHE_DIR,
+        f"{name}_{pretrained}-open_clip{open_clip.__version__}-torch{torch.__version__}.pt",
+    )
+
+
+def load_clip_model(name: str, pretrained: str):
+    """
+    Loads a CLIP variant and its preprocess transforms.
+    Returns (model, preprocess).
+    """
+    import open_clip
+
+    cache_path = model_cache_path(name, pretrained)
+    if MODEL_CACHE and os.path.exists(cache_path):
+        try:
+            # Our own artifact, so unpickling the full module is safe.
+            return torch.load(cache_path, mmap=MMAP_WEIGHTS, weights_only=False)
+        except Exception as e:
+            print(f"[models] WARNING: cached {name}/{pretrained} unreadable ({e}); rebuilding.")
+
+    model, _, preprocess = open_clip.create_model_and_transforms(name, pretrained=pretrained)
+    if MODEL_CACHE:
+        try:
+            os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+            tmp_path = cache_path + ".tmp"
+            torch.save((model, preprocess), tmp_path)
+            os.replace(tmp_path, cache_path)
+        except Exception as e:
+            print(f"[models] WARNING: could not cache {name}/{pretrained}: {e}")
+    return model, preprocess
+
+
+def model_nbytes(model: torch.nn.Module) -> int:
+    """Bytes held by the model's parameters and buffers."""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class LoadedModel:
+    """
+    One resident open_clip variant: the model, its engine, preprocess
+    transforms, tokenizer, and a pair of batchers of its own (batches never
+    mix models). `shards`, when set, encodes large image lists in worker
+    processes (see sharded_encoder.py).
+    """
+
+    def __init__(self, tag: str, model, preprocess, engine, tokenizer,
+                 shards: Optional[ShardedImageEncoder] = None):
+        self.tag = tag
+        self.model = model
+        self.preprocess = preprocess
+        self.engine = engine
+        self.tokenizer = tokenizer
+        self.dim = model.visual.output_dim
+        # Shard workers map the cached weights (shared pages) but each holds a
+        # private copy of what the engine builds (quantized or traced weights),
+        # and of the weights too when they are not loaded from a mapped cache.
+        self.nbytes = model_nbytes(model) + engine.nbytes
+        if shards is not None:
+            worker = engine.nbytes + (0 if MODEL_CACHE and MMAP_WEIGHTS else model_nbytes(model))
+            self.nbytes += shards.processes * worker
+        self.image_batcher = MicroBatcher(engine.encode_image, MAX_IMAGE_BATCH, name=f"image-batcher[{tag}]",
+                                          stage="encode_image")
+        self.text_batcher = MicroBatcher(engine.encode_text, MAX_TEXT_BATCH, name=f"text-batcher[{tag}]",
+                                         stage="encode_text")
+        self.shards = shards
+        self.users = 0
+        self.last_used = time.monotonic()
+
+    def close(self):
+        self.image_batcher.close()
+        self.text_batcher.close()
+        if self.shards is not None:
+            self.shards.close()
+
+    def stats(self) -> dict:
+        return {
+            "engine": self.engine.name,
+            "quantized": self.engine.quantized,
+            "dim": self.dim,
+            "memoryMB": round(self.nbytes / 2**20, 1),
+            "users": self.users,
+            "idleSec": round(time.monotonic() - self.last_used, 1) if not self.users else 0.0,
+            "batching": {"image": self.image_batcher.stats(), "text": self.text_batcher.stats()},
+            "shards": self.shards.stats() if self.shards is not None else None,
+        }
+
+
+class ModelRegistry:
+    """
+    Keeps several CLIP variants resident within a memory budget.
+
+    `use(tag)` loads a model on first request (concurrent requests for the
+    same model share one load) and pins it while the caller holds it. Before
+    a load, idle models are evicted least recently used first until the
+    resident models plus an estimate of the incoming one fit
+    MODEL_MEMORY_BUDGET_MB, and again after each load or release with its
+    measured size. The default model is never evicted.
+    """
+
+    def __init__(self, device, default: str = DEFAULT_MODEL, available: Optional[List[str]] = None,
+                 budget_mb: int = MODEL_MEMORY_BUDGET_MB):
+        self.device = device
+        self.default = default
+        self.available = list(available or AVAILABLE_MODELS)
+        self.budget = budget_mb * 2**20
+        self.evictions = 0
+        # Measured size of every model loaded so far, for later estimates.
+        self._sizes = {}
+        self._models: "OrderedDict[str, LoadedModel]" = OrderedDict()
+        self._load_locks = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, tag: Optional[str]) -> str:
+        """Maps a request's `model` (None = default) to a known tag; KeyError otherwise."""
+        tag = tag or self.default
+        if tag not in self.available:
+            raise KeyError(tag)
+        return tag
+
+    def get(self, tag: Optional[str] = None) -> Optional[LoadedModel]:
+        """The resident model for `tag`, or None; does not load or pin it."""
+        with self._lock:
+            return self._models.get(tag or self.default)
+
+    def preload(self, tag: Optional[str] = None) -> LoadedModel:
+        """Loads `tag` (default: the default model) without pinning it."""
+        with self.use(tag) as lm:
+            return lm
+
+    @contextmanager
+    def use(self, tag: Optional[str] = None) -> Iterator[LoadedModel]:
+        lm = self._acquire(self.resolve(tag))
+        try:
+            yield lm
+        finally:
+            with self._lock:
+                lm.users -= 1
+                lm.last_used = time.monotonic()
+                evicted = self._evict()
+            self._close(evicted)
+
+    def _acquire(self, tag: str) -> LoadedModel:
+        with self._lock:
+            lm = self._pin(tag)
+            if lm is not None:
+                return lm
+            load_lock = self._load_locks.setdefault(tag, threading.Lock())
+        with load_lock:
+            with self._lock:
+                lm = self._pin(tag)
+                if lm is not None:
+                    return lm
+                # Make room first, so peak memory stays near the budget.
+                evicted = self._evict(incoming=self.estimate_nbytes(tag))
+            self._close(evicted)
+            lm = self._load(tag)
+            with self._lock:
+                self._sizes[tag] = lm.nbytes
+                self._models[tag] = lm
+                lm.users += 1
+                evicted = self._evict()
+            self._close(evicted)
+            return lm
+
+    def _pin(self, tag: str) -> Optional[LoadedModel]:
+        lm = self._models.get(tag)
+        if lm is not None:
+            lm.users += 1
+            self._models.move_to_end(tag)
+        return lm
+
+    def _load(self, tag: str) -> LoadedModel:
+        import open_clip
+
+        start = time.perf_counter()
+        name, pretrained = split_tag(tag)
+        model, preprocess = load_clip_model(name, pretrained)
+        model = model.to(self.device).eval()
+        try:
+            engine = build_engine(model, self.device, model_tag=tag)
+        except Exception as e:
+            print(f"[models] WARNING: {ENGINE} engine unavailable for {tag} ({e}); using eager.")
+            engine = build_engine(model, self.device, engine="eager", quantize=False)
+        # Workers load the model from the cache file written above.
+        shards = ShardedImageEncoder(tag) if EMBED_PROCESSES > 1 and self.device.type == "cpu" else None
+        lm = LoadedModel(tag, model, preprocess, engine, open_clip.get_tokenizer(name), shards)
+        print(f"[models] Loaded {tag} ({lm.nbytes / 2**20:.0f} MB) in {time.perf_counter() - start:.1f}s.")
+        return lm
+
+    def estimate_nbytes(self, tag: str) -> int:
+        """Expected size of `tag` once loaded: as last measured, else its cached weights file (0 if unknown)."""
+        if tag in self._sizes:
+            return self._sizes[tag]
+        try:
+            return os.path.getsize(model_cache_path(*split_tag(tag)))
+        except OSError:
+            return 0
+
+    def _evict(self, incoming: int = 0) -> List[LoadedModel]:
+        """
+        Drops idle non-default models, oldest first, until they plus
+        `incoming` bytes fit the budget. Caller holds _lock, and closes the
+        returned models once it has released it (stopping shard workers
+        takes seconds).
+        """
+        total = sum(m.nbytes for m in self._models.values()) + incoming
+        evicted = []
+        for tag in list(self._models):
+            if total <= self.budget:
+                break
+            lm = self._models[tag]
+            if tag == self.default or lm.users:
+                continue
+            del self._models[tag]
+            evicted.append(lm)
+            total -= lm.nbytes
+            self.evictions += 1
+            print(f"[models] Evicted {tag} to stay within {self.budget // 2**20} MB.")
+        return evicted
+
+    @staticmethod
+    def _close(models: List[LoadedModel]):
+        for lm in models:
+            lm.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "default": self.default,
+                "available": self.available,
+                "budgetMB": self.budget // 2**20,
+                "residentMB": round(sum(m.nbytes for m in self._models.values()) / 2**20, 1),
+                "evictions": self.evictions,
+                "loaded": {tag: lm.stats() for tag, lm in self._models.items()},
+            }
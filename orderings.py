@@ -0,0 +1,191 @@
+# orderings.py
+
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+from ann_index import KMEANS_SAMPLE_PER_LIST, _nearest, train_centroids
+
+# Orderings that need no prompt, computed from the image embeddings alone.
+#   chain:   greedy nearest-neighbour tour ("visual flow"), each image next to its most similar unvisited one
+#   cluster: spherical k-means groups (near-duplicates together), groups chained, each group chained inside
+#   pca:     position along the first principal component
+#   grid:    rows of a 2D principal-component layout, for grid views
+ORDER_MODES = ("chain", "cluster", "pca", "grid")
+
+# Candidate neighbours precomputed per image for the chain. The walk only
+# falls back to scanning every unvisited image when all of them are taken.
+CHAIN_NEIGHBORS = int(os.environ.get("SORTER_CHAIN_NEIGHBORS", 16))
+# Above this many images the chain is built per cluster (clusters chained,
+# each chained inside), which keeps it sub-quadratic.
+CHAIN_EXACT_MAX = 2048
+# Rows of the similarity matrix computed at a time while finding neighbours.
+NEIGHBOR_BLOCK = 2048
+CLUSTER_ITERS = 20
+
+
+def principal_axes(x: np.ndarray, dims: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns (coords, axes): the rows of x projected onto their top `dims`
+    principal components. Each axis is signed so its largest loading is
+    positive, which keeps the layout stable between calls.
+    """
+    centered = x - x.mean(axis=0)
+    # d x d covariance, so the cost is linear in the number of images.
+    _, vecs = np.linalg.eigh(centered.T @ centered)
+    axes = vecs[:, ::-1][:, :dims].T.copy()
+    signs = np.sign(axes[np.arange(dims), np.abs(axes).argmax(axis=1)])
+    axes *= np.where(signs == 0, 1, signs)[:, None]
+    return centered @ axes.T, axes
+
+
+def nearest_neighbors(x: np.ndarray, k: int) -> np.ndarray:
+    """The k most similar other rows of x for every row, most similar first."""
+    n = len(x)
+    k = min(k, n - 1)
+    out = np.empty((n, k), dtype=np.int64)
+    for i in range(0, n, NEIGHBOR_BLOCK):
+        sims = x[i : i + NEIGHBOR_BLOCK] @ x.T
+        rows = np.arange(len(sims))
+        sims[rows, rows + i] = -np.inf
+        part = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(sims, part, axis=1), axis=1)
+        out[i : i + NEIGHBOR_BLOCK] = np.take_along_axis(part, order, axis=1)
+    return out
+
+
+def chain_order(x: np.ndarray, start: Optional[int] = None) -> np.ndarray:
+    """
+    Greedy nearest-neighbour tour over the rows of x, starting at `start`
+    (default: one end of the first principal component). Large inputs are
+    chained cluster by cluster.
+    """
+    n = len(x)
+    if n <= 2:
+        return np.arange(n)
+    if start is None:
+        start = int(principal_axes(x, 1)[0][:, 0].argmin())
+    if n > CHAIN_EXACT_MAX:
+        return cluster_order(x, start=start)[0]
+    return greedy_chain(x, start)
+
+
+def greedy_chain(x: np.ndarray, start: int) -> np.ndarray:
+    """
+    Exact greedy tour: each step takes the most similar unvisited row among
+    the precomputed neighbours, or scans the remaining rows when none of
+    those is left. Quadratic in len(x).
+    """
+    n = len(x)
+    neighbors = nearest_neighbors(x, CHAIN_NEIGHBORS)
+    visited = np.zeros(n, dtype=bool)
+    remaining = np.ones(n, dtype=bool)
+    order = np.empty(n, dtype=np.int64)
+    cur = start
+    for step in range(n):
+        order[step] = cur
+        visited[cur] = True
+        remaining[cur] = False
+        if step == n - 1:
+            break
+        free = neighbors[cur][~visited[neighbors[cur]]]
+        if len(free):
+            cur = int(free[0])
+        else:
+            left = np.flatnonzero(remaining)
+            cur = int(left[np.argmax(x[left] @ x[cur])])
+    return order
+
+
+def cluster_order(x: np.ndarray, clusters: Optional[int] = None,
+                  start: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Groups the rows of x with spherical k-means and returns (order, labels):
+    the clusters follow a chain over their centroids and each cluster is
+    chained internally, so near-duplicates end up side by side. Labels are
+    numbered in the order the clusters appear. `start`, if given, is the
+    first row of the order.
+    """
+    n = len(x)
+    k = min(clusters or max(1, int(round(np.sqrt(n / 2)))), n)
+    if k > 1:
+        # Like the IVF index: train on a sample, then assign every row.
+        rng = np.random.default_rng(0)
+        sample = x[rng.choice(n, min(n, k * KMEANS_SAMPLE_PER_LIST), replace=False)]
+        centroids = train_centroids(sample, k, iters=CLUSTER_ITERS)
+        labels = _nearest(x, centroids)
+    if k <= 1 or np.bincount(labels).max() == n:
+        # One group (or identical rows k-means cannot split): chain it directly.
+        labels = np.zeros(n, dtype=np.int64)
+        if n <= 2:
+            return np.arange(n), labels
+        if start is None:
+            start = int(principal_axes(x, 1)[0][:, 0].argmin())
+        return greedy_chain(x, start), labels
+
+    first_cluster = labels[start] if start is not None else None
+    order, out_labels = [], []
+    for c in chain_order(centroids, first_cluster):
+        members = np.flatnonzero(labels == c)
+        if not len(members):
+            continue
+        sub = x[members]
+        # Enter each cluster at the member closest to where the last one ended
+        # (the first at `start`, or at its least typical member).
+        if order:
+            entry = int(np.argmax(sub @ x[order[-1][-1]]))
+        elif start is not None:
+            entry = int(np.flatnonzero(members == start)[0])
+        else:
+            entry = int(np.argmin(sub @ centroids[c]))
+        order.append(members[chain_order(sub, entry)])
+        out_labels.append(np.full(len(members), len(out_labels)))
+    return np.concatenate(order), np.concatenate(out_labels)
+
+
+def pca_order(x: np.ndarray) -> np.ndarray:
+    return np.argsort(principal_axes(x, 1)[0][:, 0], kind="stable")
+
+
+def grid_order(x: np.ndarray, columns: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    Lays the rows of x out on a grid `columns` wide (default: square) from
+    their 2D principal-component coordinates: rows of the grid are bands of
+    the second component, each read along the first. Returns (order,
+    coords, columns) with coords in order, scaled to [0, 1].
+    """
+    n = len(x)
+    columns = max(1, columns or int(np.ceil(np.sqrt(n))))
+    coords, _ = principal_axes(x, 2) if n > 1 else (np.zeros((n, 2)), None)
+    if coords.shape[1] < 2:
+        coords = np.pad(coords, ((0, 0), (0, 2 - coords.shape[1])))
+    by_y = np.argsort(coords[:, 1], kind="stable")
+    order = np.concatenate([
+        band[np.argsort(coords[band, 0], kind="stable")]
+        for band in np.split(by_y, range(columns, n, columns))
+    ]) if n else by_y
+    span = coords.max(axis=0) - coords.min(axis=0) if n else np.ones(2)
+    scaled = (coords - coords.min(axis=0)) / np.where(span > 0, span, 1)
+    return order, scaled[order], columns
+
+
+def order_embeddings(x: np.ndarray, mode: str, clusters: Optional[int] = None,
+                     columns: Optional[int] = None) -> dict:
+    """
+    Runs one of ORDER_MODES over unit-norm rows. Returns {"order": indices,
+    plus "labels" (cluster) or "coords" and "columns" (grid)}.
+    """
+    x = np.ascontiguousarray(x, dtype=np.float32)
+    if mode == "chain":
+        return {"order": chain_order(x)}
+    if mode == "cluster":
+        order, labels = cluster_order(x, clusters)
+        return {"order": order, "labels": labels}
+    if mode == "pca":
+        return {"order": pca_order(x)}
+    if mode == "grid":
+        order, coords, columns = grid_order(x, columns)
+        return {"order": order, "coords": coords, "columns": columns}
+    raise ValueError(f"Unknown ordering mode {mode!r}; use one of {', '.join(ORDER_MODES)}.")
+
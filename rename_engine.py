@@ -0,0 +1,325 @@
+# rename_engine.py
+
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from typing import Callable, List, Optional, Tuple
+
+from embedding_store import DEFAULT_CACHE_DIR
+
+JOURNAL_DIR = os.path.join(DEFAULT_CACHE_DIR, "renames")
+# Finished journals kept for undo; older ones are deleted.
+MAX_JOURNALS = 50
+# Longest name kept after the order prefix (extension not counted).
+MAX_NAME_LEN = 100
+
+_PREFIX_RE = re.compile(r"^\d+_")
+
+Move = Tuple[str, str]
+
+
+class RenameConflict(ValueError):
+    """The planned renames cannot be applied; nothing was touched."""
+
+    def __init__(self, message: str, conflicts: List[str]):
+        super().__init__(f"{message}: {', '.join(conflicts[:5])}{' ...' if len(conflicts) > 5 else ''}")
+        self.conflicts = conflicts
+
+
+def strip_order_prefix(name: str) -> str:
+    """'03_myimage.png' -> 'myimage.png'."""
+    return _PREFIX_RE.sub("", name, count=1)
+
+
+def ordered_targets(sorted_paths: List[str], max_name_len: int = MAX_NAME_LEN) -> List[str]:
+    """
+    New path for every file: its position as a zero-padded prefix (wide
+    enough for the whole list, so names still sort correctly past 99 files),
+    then its name without any previous prefix, truncated to max_name_len.
+    """
+    width = max(2, len(str(len(sorted_paths))))
+    out = []
+    for i, path in enumerate(sorted_paths):
+        folder, base = os.path.split(path)
+        stem, ext = os.path.splitext(strip_order_prefix(base))
+        out.append(os.path.join(folder, f"{i + 1:0{width}d}_{stem[:max_name_len]}{ext}"))
+    return out
+
+
+def plan_steps(moves: List[Move], temp_name: Callable[[str, int], str]) -> List[Move]:
+    """
+    Orders `moves` (old -> new, a permutation over sources and free targets)
+    into single renames that never overwrite a file: a move runs once its
+    target is free, which frees its source for the move into it; each
+    remaining cycle is opened by parking one file under a temp name.
+    """
+    key = os.path.normcase
+    by_source = {key(o): (o, n) for o, n in moves}
+    by_target = {key(n): (o, n) for o, n in moves}
+    steps, done = [], set()
+
+    def unwind(freed: str):
+        # Runs the chain of moves waiting on `freed`, each freeing the next.
+        while key(freed) in by_target:
+            o, n = by_target[key(freed)]
+            if key(o) in done:
+                return
+            steps.append((o, n))
+            done.add(key(o))
+            freed = o
+
+    for o, n in moves:
+        if key(o) not in done and key(n) not in by_source:
+            steps.append((o, n))
+            done.add(key(o))
+            unwind(o)
+    for k, (o, n) in enumerate(moves):
+        if key(o) in done:
+            continue
+        tmp = temp_name(o, k)
+        steps.append((o, tmp))
+        done.add(key(o))
+        unwind(o)
+        steps.append((tmp, n))
+    return steps
+
+
+def check_moves(moves: List[Move]):
+    """Raises RenameConflict unless every source exists and every target is unique and free (or moving away)."""
+    key = os.path.normcase
+    sources = {key(o) for o, _ in moves}
+    missing = [o for o, _ in moves if not os.path.lexists(o)]
+    if missing:
+        raise RenameConflict("Source files missing", missing)
+    seen, dupes = set(), []
+    for _, n in moves:
+        if key(n) in seen:
+            dupes.append(n)
+        seen.add(key(n))
+    if dupes:
+        raise RenameConflict("Several files would get the same name", dupes)
+    taken = [n for o, n in moves if key(n) not in sources and os.path.lexists(n)]
+    if taken:
+        raise RenameConflict("Target names already taken", taken)
+
+
+class RenameJournal:
+    """
+    One batch of renames on disk: `<id>.json` holds the plan (written and
+    fsynced before any rename), `<id>.log` gets one line per applied step
+    and then "complete", "rolledback" or "undone <undo id>".
+    """
+
+    def __init__(self, journal_dir: str, moves: List[Move], steps: List[Move],
+                 kind: str = "rename", undoes: Optional[str] = None, jid: Optional[str] = None,
+                 created: Optional[float] = None):
+        self.id = jid or time.strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8]
+        self.dir = journal_dir
+        self.moves = moves
+        self.steps = steps
+        self.kind = kind
+        self.undoes = undoes
+        self.created = created or time.time()
+        self.applied = 0
+        self.state = "pending"  # pending | complete | rolledback
+        self.undone_by = None
+
+    @property
+    def plan_path(self):
+        return os.path.join(self.dir, f"{self.id}.json")
+
+    @property
+    def log_path(self):
+        return os.path.join(self.dir, f"{self.id}.log")
+
+    def save(self):
+        os.makedirs(self.dir, exist_ok=True)
+        tmp = self.plan_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            # json.dumps, not json.dump: the one-shot C encoder is much faster on 50k-step plans.
+            f.write(json.dumps({"id": self.id, "kind": self.kind, "undoes": self.undoes, "created": self.created,
+                                "moves": self.moves, "steps": self.steps}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.plan_path)
+
+    @classmethod
+    def load(cls, journal_dir: str, jid: str) -> "RenameJournal":
+        with open(os.path.join(journal_dir, f"{jid}.json"), encoding="utf-8") as f:
+            plan = json.load(f)
+        j = cls(journal_dir, [tuple(m) for m in plan["moves"]], [tuple(s) for s in plan["steps"]],
+                plan["kind"], plan.get("undoes"), plan["id"], plan["created"])
+        try:
+            with open(j.log_path, encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line.isdigit():
+                        j.applied = int(line) + 1
+                    elif line in ("complete", "rolledback"):
+                        j.state = line
+                    elif line.startswith("undone "):
+                        j.undone_by = line.split(" ", 1)[1]
+        except FileNotFoundError:
+            pass
+        return j
+
+    def to_dict(self) -> dict:
+        return {
+            "journalId": self.id,
+            "kind": self.kind,
+            "undoes": self.undoes,
+            "state": self.state,
+            "undoneBy": self.undone_by,
+            "files": len(self.moves),
+            "steps": len(self.steps),
+            "applied": self.applied,
+            "created": self.created,
+        }
+
+
+class RenameEngine:
+    """
+    Applies whole rename batches: plan, check, journal, then rename.
+
+    Nothing is renamed unless the entire batch checks out. A failure part
+    way through rolls the applied steps back, and journals left unfinished
+    by a crash are rolled back by recover(), so a folder is never left half
+    renamed. undo() replays a finished journal's steps backwards as a new
+    journal. `on_renamed(moves)` is told every net old -> new path change
+    (e.g. to move cached embeddings along).
+    """
+
+    def __init__(self, journal_dir: str = JOURNAL_DIR,
+                 on_renamed: Optional[Callable[[List[Move]], None]] = None):
+        self.journal_dir = journal_dir
+        self.on_renamed = on_renamed
+        self._lock = threading.Lock()
+
+    def rename_sorted(self, sorted_paths: List[str], max_name_len: int = MAX_NAME_LEN,
+                      dry_run: bool = False) -> Tuple[RenameJournal, List[str]]:
+        """Prefixes `sorted_paths` with their order. Returns (journal, new path per input path)."""
+        paths = [os.path.abspath(p) for p in sorted_paths]
+        if len({os.path.normcase(p) for p in paths}) != len(paths):
+            raise RenameConflict("Duplicate paths", [p for p in paths if paths.count(p) > 1][:5])
+        targets = ordered_targets(paths, max_name_len)
+        moves = [(o, n) for o, n in zip(paths, targets) if o != n]
+        return self.apply(moves, dry_run=dry_run), targets
+
+    def apply(self, moves: List[Move], kind: str = "rename", undoes: Optional[str] = None,
+              dry_run: bool = False) -> RenameJournal:
+        with self._lock:
+            check_moves(moves)
+            journal = RenameJournal(self.journal_dir, moves, [], kind, undoes)
+            journal.steps = plan_steps(
+                moves, lambda p, k: os.path.join(os.path.dirname(p), f".sorter-tmp-{journal.id}-{k}")
+            )
+            if dry_run or not moves:
+                return journal
+            journal.save()
+            self._run(journal)
+            self._prune()
+        if self.on_renamed and moves:
+            self.on_renamed(moves)
+        return journal
+
+    def undo(self, journal_id: Optional[str] = None) -> RenameJournal:
+        """Reverses a finished rename journal (default: the latest one not undone yet)."""
+        with self._lock:
+            if journal_id is None:
+                candidates = [j for j in self._journals() if j.kind == "rename" and j.state == "complete"
+                              and not j.undone_by]
+                if not candidates:
+                    raise KeyError("nothing to undo")
+                journal = candidates[-1]
+            else:
+                journal = RenameJournal.load(self.journal_dir, journal_id)
+            if journal.state != "complete" or journal.undone_by:
+                state = f"undone by {journal.undone_by}" if journal.undone_by else journal.state
+                raise RenameConflict("Journal cannot be undone", [f"{journal.id} ({state})"])
+            moves = [(n, o) for o, n in journal.moves]
+            check_moves(moves)
+            undo = RenameJournal(self.journal_dir, moves, [(d, s) for s, d in reversed(journal.steps)],
+                                 "undo", journal.id)
+            undo.save()
+            self._run(undo)
+            with open(journal.log_path, "a", encoding="utf-8") as log:
+                log.write(f"undone {undo.id}\n")
+            journal.undone_by = undo.id
+        if self.on_renamed and moves:
+            self.on_renamed(moves)
+        return undo
+
+    def recover(self) -> List[RenameJournal]:
+        """Rolls back journals a crash left unfinished; returns them."""
+        recovered = []
+        with self._lock:
+            for journal in self._journals():
+                if journal.state == "pending":
+                    print(f"[rename] Rolling back unfinished journal {journal.id} "
+                          f"({journal.applied}/{len(journal.steps)} steps applied).")
+                    self._rollback(journal)
+                    recovered.append(journal)
+        return recovered
+
+    def journals(self) -> List[dict]:
+        with self._lock:
+            return [j.to_dict() for j in self._journals()]
+
+    def _journals(self) -> List[RenameJournal]:
+        try:
+            names = os.listdir(self.journal_dir)
+        except FileNotFoundError:
+            return []
+        out = []
+        for name in sorted(names):
+            if name.endswith(".json"):
+                try:
+                    out.append(RenameJournal.load(self.journal_dir, name[: -len(".json")]))
+                except (OSError, ValueError, KeyError) as e:
+                    print(f"[rename] WARNING: unreadable journal {name}: {e}")
+        return sorted(out, key=lambda j: j.created)
+
+    def _run(self, journal: RenameJournal):
+        # Line-buffered: each applied step reaches the log before the next rename.
+        with open(journal.log_path, "a", encoding="utf-8", buffering=1) as log:
+            try:
+                for i in range(journal.applied, len(journal.steps)):
+                    src, dst = journal.steps[i]
+                    os.rename(src, dst)
+                    log.write(f"{i}\n")
+                    journal.applied = i + 1
+            except OSError as e:
+                log.flush()
+                print(f"[rename] Step {journal.applied} of {journal.id} failed ({e}); rolling back.")
+                self._rollback(journal)
+                raise RenameConflict("Rename failed and was rolled back", [str(e)])
+            log.write("complete\n")
+            log.flush()
+            os.fsync(log.fileno())
+        journal.state = "complete"
+
+    def _rollback(self, journal: RenameJournal):
+        applied = journal.applied
+        # A crash between a rename and its log line leaves one unlogged step.
+        if applied < len(journal.steps):
+            src, dst = journal.steps[applied]
+            if not os.path.lexists(src) and os.path.lexists(dst):
+                applied += 1
+        for src, dst in reversed(journal.steps[:applied]):
+            os.rename(dst, src)
+        with open(journal.log_path, "a", encoding="utf-8") as log:
+            log.write("rolledback\n")
+        journal.state = "rolledback"
+        journal.applied = 0
+
+    def _prune(self):
+        finished = [j for j in self._journals() if j.state != "pending"]
+        for journal in finished[: max(0, len(finished) - MAX_JOURNALS)]:
+            for path in (journal.plan_path, journal.log_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,221 @@
+# sharded_encoder.py
+
+import itertools
+import math
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+from clip_engines import INTRA_OP_THREADS, build_engine
+from image_pipeline import iter_preprocessed_batches
+from metrics import observe_stage
+
+# On CPU one process encoding a folder leaves most of a many-core machine
+# idle: intra-op threading scales poorly for ViT-B at small batches. With
+# SORTER_EMBED_PROCESSES > 1, large image encodes are split into chunks and
+# spread over that many worker processes, each with its own model and
+# SORTER_INTRA_OP_THREADS (default: cores / processes) threads. Workers load
+# the model from the memory-mapped model cache, so the weights are read-only
+# page-cache pages shared by every process (not with --quantize or the
+# torchscript engine, which rewrite them).
+EMBED_PROCESSES = int(os.environ.get("SORTER_EMBED_PROCESSES", 0))
+# Jobs of fewer images than this stay in-process (micro-batched). A job is a
+# request's uncached images or an index job's paths, so the small
+# chunks that streaming sorts and index spans encode at a time still shard.
+SHARD_MIN_IMAGES = int(os.environ.get("SORTER_SHARD_MIN_IMAGES", 64))
+# Decode threads per worker; each worker decodes its own chunk.
+SHARD_DECODE_WORKERS = int(os.environ.get("SORTER_SHARD_DECODE_WORKERS", 1))
+
+
+class ShardPoolBroken(RuntimeError):
+    """The worker processes are gone or never came up; encode in-process instead."""
+
+
+def threads_per_process(processes: int, cores: Optional[int] = None) -> int:
+    """Intra-op threads per worker so that all workers together use each core once."""
+    if INTRA_OP_THREADS:
+        return INTRA_OP_THREADS
+    return max(1, (cores or os.cpu_count() or 1) // max(1, processes))
+
+
+def _picklable(exc: BaseException) -> BaseException:
+    try:
+        pickle.loads(pickle.dumps(exc))
+        return exc
+    except Exception:
+        return RuntimeError(repr(exc))
+
+
+def _worker_main(tag: str, threads: int, decode_workers: int, tasks, results):
+    """Worker process: loads `tag` once, then encodes (job, chunk, paths, batch_size) tasks."""
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    try:
+        from model_registry import load_clip_model, split_tag
+
+        model, preprocess = load_clip_model(*split_tag(tag))
+        engine = build_engine(model.eval(), torch.device("cpu"), threads=threads, model_tag=tag)
+    except Exception as e:
+        results.put((None, None, "failed", repr(e)))
+        return
+    results.put((None, None, "ready", os.getpid()))
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        job, index, paths, batch_size = task
+        try:
+            embs = [
+                engine.encode_image(tensor).float().numpy()
+                for _, tensor in iter_preprocessed_batches(paths, preprocess, batch_size, workers=decode_workers)
+            ]
+            results.put((job, index, "ok", np.concatenate(embs)))
+        except Exception as e:
+            # Decode errors are re-raised in the caller, as in-process encoding would.
+            results.put((job, index, "error", _picklable(e)))
+
+
+class ShardedImageEncoder:
+    """
+    A pool of worker processes that each hold one CLIP model (`tag`) and
+    encode image chunks from a shared task queue, so faster workers take
+    more chunks. `encode()` returns the embeddings in input order.
+
+    Workers start in the background; until all of them have loaded the
+    model, `usable()` is False and callers encode in-process. If a worker
+    dies, pending and later encodes raise ShardPoolBroken.
+    """
+
+    def __init__(self, tag: str, processes: int = EMBED_PROCESSES, threads: Optional[int] = None,
+                 decode_workers: int = SHARD_DECODE_WORKERS, min_images: int = SHARD_MIN_IMAGES):
+        self.tag = tag
+        self.processes = processes
+        self.threads = threads or threads_per_process(processes)
+        self.min_images = min_images
+        self.ready = 0
+        self.broken: Optional[str] = None
+        self.chunks = 0
+        self.images = 0
+        # The model and its engine are built again in each worker; a forked
+        # copy of a process running torch threads can deadlock, so spawn.
+        ctx = mp.get_context("spawn")
+        self._tasks = ctx.Queue()
+        self._results = ctx.Queue()
+        self._jobs: Dict[int, list] = {}
+        self._job_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._procs = [
+            ctx.Process(target=_worker_main, args=(tag, self.threads, decode_workers, self._tasks, self._results),
+                        name=f"embed-shard-{i}[{tag}]", daemon=True)
+            for i in range(processes)
+        ]
+        for p in self._procs:
+            p.start()
+        self._collector = threading.Thread(target=self._collect, name=f"shard-collector[{tag}]", daemon=True)
+        self._collector.start()
+        print(f"[shards] Starting {processes} embedding processes for {tag} ({self.threads} threads each).")
+
+    def usable(self, n_images: int) -> bool:
+        return self.broken is None and self.ready == self.processes and n_images >= self.min_images
+
+    def encode(self, paths: List[str], batch_size: int = 16) -> np.ndarray:
+        """[len(paths), dim] float32 unit-norm embeddings, in input order."""
+        if self.broken is not None:
+            raise ShardPoolBroken(self.broken)
+        # Small enough chunks that every worker gets several, so a slow
+        # chunk (large files, a busy core) does not hold up the rest.
+        size = max(1, min(4 * batch_size, math.ceil(len(paths) / (2 * self.processes))))
+        chunks = [paths[i : i + size] for i in range(0, len(paths), size)]
+        if not chunks:
+            raise ValueError("no paths to encode")
+        fut = Future()
+        start = time.perf_counter()
+        with self._lock:
+            job = next(self._job_ids)
+            # [future, results by chunk index, chunks still outstanding]
+            self._jobs[job] = [fut, [None] * len(chunks), len(chunks)]
+        for index, chunk in enumerate(chunks):
+            self._tasks.put((job, index, chunk, batch_size))
+        try:
+            out = fut.result()
+        finally:
+            with self._lock:
+                self._jobs.pop(job, None)
+        observe_stage("encode_image_sharded", time.perf_counter() - start)
+        with self._lock:
+            self.chunks += len(chunks)
+            self.images += len(paths)
+        return out
+
+    def _collect(self):
+        """Routes worker results to their jobs; fails every job if a worker dies."""
+        while not self._closed:
+            try:
+                job, index, kind, value = self._results.get(timeout=1.0)
+            except queue.Empty:
+                dead = [p.name for p in self._procs if not p.is_alive()]
+                if dead and not self._closed:
+                    self._fail(f"embedding process exited: {', '.join(dead)}")
+                    return
+                continue
+            except (EOFError, OSError):
+                return
+            if kind == "ready":
+                self.ready += 1
+                if self.ready == self.processes:
+                    print(f"[shards] {self.processes} embedding processes ready for {self.tag}.")
+                continue
+            if kind == "failed":
+                self._fail(f"embedding process could not load {self.tag}: {value}")
+                return
+            with self._lock:
+                entry = self._jobs.get(job)
+                if entry is None or entry[0].done():
+                    continue  # job already failed on another chunk
+                if kind == "error":
+                    entry[0].set_exception(value)
+                    continue
+                entry[1][index] = value
+                entry[2] -= 1
+                if entry[2] == 0:
+                    entry[0].set_result(np.concatenate(entry[1]))
+
+    def _fail(self, reason: str):
+        print(f"[shards] WARNING: {reason}; encoding in-process from now on.")
+        self.close(reason)
+
+    def stats(self) -> dict:
+        return {
+            "processes": self.processes,
+            "threadsPerProcess": self.threads,
+            "ready": self.ready,
+            "broken": self.broken,
+            "chunks": self.chunks,
+            "images": self.images,
+        }
+
+    def close(self, reason: str = "closed"):
+        """Stops the workers; encodes still waiting raise ShardPoolBroken."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self.broken = self.broken or reason
+            for fut, _, _ in self._jobs.values():
+                if not fut.done():
+                    fut.set_exception(ShardPoolBroken(self.broken))
+        for _ in self._procs:
+            self._tasks.put(None)
+        for p in self._procs:
+            p.join(timeout=2)
+            if p.is_alive():
+                p.terminate()
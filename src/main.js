@@ -28,6 +28,48 @@ app.on('ready', createWindow);
 app.on('window-all-closed', () => { if (process.platform !== 'darwin') app.quit(); });
 app.on('activate', () => { if (mainWindow === null) createWindow(); });
 
+// ---------------- Background indexing ----------------
+
+const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+
+// Resolves once GET /ready answers 200 (models loaded), false after `tries` polls.
+async function waitForReady(tries = 120, intervalMs = 1000) {
+  for (let i = 0; i < tries; i++) {
+    try {
+      const res = await fetch('http://127.0.0.1:8000/ready');
+      if (res.ok) return true;
+    } catch (_) { /* server not listening yet */ }
+    await sleep(intervalMs);
+  }
+  return false;
+}
+
+// POST /index for `folderPath`. While the server is unreachable or still
+// starting (503), waits for /ready and tries again; other errors are logged.
+async function startIndexing(folderPath, imagePaths, attempts = 3) {
+  for (let attempt = 1; attempt <= attempts; attempt++) {
+    let res;
+    try {
+      res = await fetch('http://127.0.0.1:8000/index', {
+        method: 'POST',
+        headers: { 'Content-Type':'application/json' },
+        body: JSON.stringify({ folderPath, imagePaths })
+      });
+    } catch (err) {
+      console.warn(`[main] Background indexing not started (attempt ${attempt}):`, err.message);
+    }
+    if (res && res.ok) return true;
+    if (res && res.status !== 503) {
+      console.warn(`[main] Background indexing refused (${res.status}):`, await res.text());
+      return false;
+    }
+    if (res) console.warn(`[main] Server not ready for indexing (attempt ${attempt}): ${await res.text()}`);
+    if (attempt < attempts && !(await waitForReady())) break;
+  }
+  console.warn(`[main] Gave up starting background indexing for ${folderPath}.`);
+  return false;
+}
+
 // ---------------- IPC ----------------
 
 ipcMain.handle('sort-with-gemini', async (_, { imagePaths, prompt }) => {
@@ -60,10 +102,17 @@ ipcMain.handle('open-folder', async () => {
     const e = path.extname(f).toLowerCase();
     return ['.png','.jpg','.jpeg','.bmp','.gif','.webp'].includes(e);
   });
+  const imagePaths = files.map(f=> path.join(folderPath,f));
+
+  // Start embedding the folder in the background so the first sort is fast;
+  // the server then watches it and re-embeds only files that change.
+  // Not awaited: sorting still works if indexing never starts.
+  startIndexing(folderPath, imagePaths);
+
   return {
     canceled:false,
     folderPath,
-    imagePaths: files.map(f=> path.join(folderPath,f))
+    imagePaths
   };
 });
 
@@ -83,8 +132,8 @@ ipcMain.handle('sort-by-prompt', async (event, { folderPath, imagePaths, prompt
     // 1) Build the payload
     const payload = { folderPath, imagePaths, prompt };
 
-    // 2) POST to our local FastAPI server
-    const response = await fetch("http://127.0.0.1:8000/sort-by-clip", {
+    // 2) POST to the streaming variant of our local FastAPI server's sort
+    const response = await fetch("http://127.0.0.1:8000/sort-by-clip/stream", {
       method: "POST",
       headers: { "Content-Type": "application/json" },
       body: JSON.stringify(payload),
@@ -95,9 +144,27 @@ ipcMain.handle('sort-by-prompt', async (event, { folderPath, imagePaths, prompt
       throw new Error(`Server error ${response.status}: ${text}`);
     }
 
-    const json = await response.json();
-    // The server returns { sortedPaths: [ … ] }
-    return json.sortedPaths;
+    // 3) The server sends one JSON event per line; forward progress and
+    //    provisional rankings to the renderer, return the final order.
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffered = '';
+    for (;;) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffered += decoder.decode(value, { stream: true });
+      let nl;
+      while ((nl = buffered.indexOf('\n')) >= 0) {
+        const line = buffered.slice(0, nl).trim();
+        buffered = buffered.slice(nl + 1);
+        if (!line) continue;
+        const ev = JSON.parse(line);
+        if (ev.type === 'result') return ev.sortedPaths;
+        if (ev.type === 'error') throw new Error(`Server error: ${ev.detail}`);
+        event.sender.send('sort-progress', ev);
+      }
+    }
+    throw new Error('Sort stream ended without a result');
   } catch (err) {
     console.error("[main] Error calling sort API:", err);
     throw err;
@@ -105,41 +172,18 @@ ipcMain.handle('sort-by-prompt', async (event, { folderPath, imagePaths, prompt
 });
 
 ipcMain.handle('apply-renames', async (event, { folderPath, sortedPaths }) => {
-  /**
-   * (Leave your existing rename logic here—unchanged.)
-   */
+  // The server plans the whole batch (prefix width fits the file count,
+  // swaps go through temp names), journals it and renames in one pass;
+  // POST /rename/undo restores the previous names.
   try {
-    const MAX_NAME_LEN = 100;
-    for (let i = 0; i < sortedPaths.length; i++) {
-      const oldFullPath = sortedPaths[i];
-      const dir = path.dirname(oldFullPath);
-      let base = path.basename(oldFullPath);
-      const prefixMatch = /^(\d+)_/.exec(base);
-      if (prefixMatch) {
-        base = base.substring(prefixMatch[0].length);
-      }
-      const ext = path.extname(base);
-      const nameOnly = base.slice(0, -ext.length);
-      let truncatedName = nameOnly;
-      if (nameOnly.length > MAX_NAME_LEN) {
-        truncatedName = nameOnly.slice(0, MAX_NAME_LEN);
-      }
-      const prefix = String(i + 1).padStart(2, '0');
-      const newBase = `${prefix}_${truncatedName}${ext}`;
-      const newFullPath = path.join(dir, newBase);
-
-      if (oldFullPath !== newFullPath) {
-        if (fs.existsSync(newFullPath)) {
-          sortedPaths[i] = newFullPath;
-        } else {
-          fs.renameSync(oldFullPath, newFullPath);
-          sortedPaths[i] = newFullPath;
-        }
-      } else {
-        sortedPaths[i] = newFullPath;
-      }
-    }
-    return true;
+    const res = await fetch('http://127.0.0.1:8000/rename', {
+      method: 'POST',
+      headers: { 'Content-Type':'application/json' },
+      body: JSON.stringify({ sortedPaths })
+    });
+    if (!res.ok) throw new Error(`Server error ${res.status}: ${await res.text()}`);
+    const { renamedPaths } = await res.json();
+    return renamedPaths;
   } catch (err) {
     console.error('[main] Error during file renaming:', err);
     throw err;
@@ -3,6 +3,11 @@ const { contextBridge, ipcRenderer } = require('electron');
 contextBridge.exposeInMainWorld('electronAPI', {
   openFolder: () => ipcRenderer.invoke('open-folder'),
   sortByPrompt: (args) => ipcRenderer.invoke('sort-by-prompt', args),
+  onSortProgress: (cb) => {
+    const listener = (_, ev) => cb(ev);
+    ipcRenderer.on('sort-progress', listener);
+    return () => ipcRenderer.removeListener('sort-progress', listener);
+  },
   applyRenames: (args) => ipcRenderer.invoke('apply-renames', args),
     conceptSort: args => ipcRenderer.invoke('concept-sort', args),
       openInExplorer:  p    => ipcRenderer.invoke('open-in-explorer', p),
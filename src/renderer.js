@@ -201,35 +201,11 @@ function normalizeSlashes(str) {
     let finalPaths = sortedPaths;
 
     if (doRename) {
-      // Apply the renames via your main process
-      await window.electronAPI.applyRenames({
+      // Apply the renames via your main process; it returns the new paths
+      finalPaths = await window.electronAPI.applyRenames({
         folderPath: currentFolder,
         sortedPaths
       });
-
-      // Build the newly renamed absolute paths
-      const MAX_NAME_LEN = 100;
-      finalPaths = sortedPaths.map((oldPath, index) => {
-        // normalize slashes & strip old numeric prefix
-        const normalized = oldPath.replace(/\//g, '\\').replace(/\\\\+/g, '\\');
-        const lastSlash = normalized.lastIndexOf('\\');
-        const dir = normalized.slice(0, lastSlash + 1);
-        let filename = normalized.slice(lastSlash + 1).replace(/^\d+_/, '');
-
-        // split name & ext
-        const dotIdx = filename.lastIndexOf('.');
-        let nameOnly = dotIdx >= 0 ? filename.slice(0, dotIdx) : filename;
-        const ext = dotIdx >= 0 ? filename.slice(dotIdx) : '';
-
-        // truncate if too long
-        if (nameOnly.length > MAX_NAME_LEN) {
-          nameOnly = nameOnly.slice(0, MAX_NAME_LEN);
-        }
-
-        // zero-padded prefix + "_" + name + ext
-        const prefix = String(index + 1).padStart(2, '0');
-        return `${dir}${prefix}_${nameOnly}${ext}`;
-      });
     }
 
     // 4) Update and re-render
@@ -260,12 +236,22 @@ btnSortPrompt.addEventListener('click', async () => {
   btnSortPrompt.innerText = 'Sorting…';
   btnSortPrompt.disabled = true;
 
+  // Show progress and the provisional best matches while the server works.
+  const stopProgress = window.electronAPI.onSortProgress((ev) => {
+    if (ev.type === 'progress') {
+      btnSortPrompt.innerText = `Sorting… ${ev.done}/${ev.total}`;
+    } else if (ev.type === 'partial') {
+      renderThumbnails(ev.topPaths);
+    }
+  });
+
   try {
     const sortedPaths = await window.electronAPI.sortByPrompt({
       folderPath: currentFolder,
       imagePaths: currentImagePaths,
       prompt: promptText,
     });
+    stopProgress();
 
     // If Python returned something unexpected, bail out
     if (!Array.isArray(sortedPaths)) {
@@ -275,55 +261,11 @@ btnSortPrompt.addEventListener('click', async () => {
     // Ask the user: do you want to rename the actual files on disk?
   const doRename = confirm('Sort complete. Rename files on disk?');
   if (doRename) {
-    // 1) Ask main to rename on disk
-    await window.electronAPI.applyRenames({
+    // 1) Ask main to rename on disk; it returns the new absolute paths in order
+    const renamedPaths = await window.electronAPI.applyRenames({
       folderPath: currentFolder,
       sortedPaths, // absolute paths in old order
     });
-
-    // 2) Build the new absolute paths (stripping old numeric prefixes, applying new ones)
-const MAX_NAME_LEN = 100; // maximum length for the “name only” portion
-
-const renamedPaths = sortedPaths.map((oldPath, index) => {
-  // 1) Normalize any forward‐slashes to backslashes
-const normalized1 = oldPath.includes('/')
-  ? oldPath.replace(/\//g, '\\')
-  //? oldPath.replace(/\//g, '\\')
-  : oldPath;
-
-  const normalized = normalized1.replace(/\\\\\\\\/g, '\\');
-
-  // 2) Find the last backslash
-  const lastSlash = normalized.lastIndexOf('\\');
-  const dir = normalized.slice(0, lastSlash + 1);       // e.g. "C:\Users\DLF\Pictures\…\hoToCo\"
-  let filename = normalized.slice(lastSlash + 1);        // e.g. "05_VeryLongName…jpg"
-
-  // 3) Strip any existing "NN_" prefix
-  filename = filename.replace(/^\d+_/, '');             // e.g. "VeryLongName…jpg"
-
-  // 4) Split off extension
-  const dotIndex = filename.lastIndexOf('.');
-  let nameOnly, ext;
-  if (dotIndex >= 0) {
-    nameOnly = filename.slice(0, dotIndex);              // e.g. "VeryLongName…"
-    ext = filename.slice(dotIndex);                       // e.g. ".jpg"
-  } else {
-    nameOnly = filename;                                  // no extension
-    ext = '';
-  }
-
-  // 5) Truncate nameOnly if it exceeds MAX_NAME_LEN
-  if (nameOnly.length > MAX_NAME_LEN) {
-    nameOnly = nameOnly.slice(0, MAX_NAME_LEN);
-  }
-
-  // 6) Build the new filename: zero-padded index + "_" + truncated nameOnly + ext
-  const prefix = String(index + 1).padStart(2, '0');      // "01", "02", ...
-  const newName = `${prefix}_${nameOnly}${ext}`;          // e.g. "03_VeryLongName…jpg"
-
-  // 7) Reassemble: directory + new filename
-  return dir + newName;
-});
     currentImagePaths = renamedPaths;
   } else {
     currentImagePaths = sortedPaths;
@@ -340,6 +282,7 @@ catch (err) {
     console.error('Error during sort:', err);
     alert('An error occurred while sorting or renaming. Check the console for details.');
   } finally {
+    stopProgress();
     btnSortPrompt.innerText = 'Sort by Prompt…';
     btnSortPrompt.disabled = false;
   }
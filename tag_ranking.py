@@ -0,0 +1,204 @@
+# tag_ranking.py
+
+import difflib
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# Tokens kept free in every prompt on top of the instructions and items,
+# since the model's own tokenization of its answer never matches exactly.
+TOKEN_MARGIN = 64
+# Tags from the first chunk that are re-ranked inside every later chunk so
+# the chunks' orders can be placed on one scale.
+ANCHOR_COUNT = 8
+# How close a misspelled tag in the answer must be to an input tag.
+FUZZY_CUTOFF = 0.8
+
+PROMPT_TEMPLATE = """
+You are a sorting expert.
+Sort the following items based on the dimension of {dimension}.
+List them from {start} to {end}.
+Respond ONLY with the sorted, comma-separated list.
+Items: {items}
+"""
+
+
+class ContextTooSmall(ValueError):
+    """The model's context window cannot hold even one chunk plus the anchors."""
+
+
+class RankStats:
+    """LLM usage for one concept sort."""
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latency = 0.0
+        self.unique_tags = 0
+        self.chunks = 0
+        self.fuzzy_matched = 0
+        self.reconciled = 0
+        self.missing = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "promptTokens": self.prompt_tokens,
+            "completionTokens": self.completion_tokens,
+            "latencyMs": round(1000 * self.latency, 1),
+            "uniqueTags": self.unique_tags,
+            "chunks": self.chunks,
+            "fuzzyMatched": self.fuzzy_matched,
+            "reconciled": self.reconciled,
+            "missing": self.missing,
+        }
+
+
+class TagRanker:
+    """
+    Orders tags along a dimension with a llama.cpp model.
+
+    Tags that fit in one prompt are ranked in a single call. Larger sets are
+    split into chunks sized to the context window; the first chunk's order
+    becomes the reference scale, and every later chunk is ranked together
+    with ANCHOR_COUNT tags sampled from it, so each tag can be placed on the
+    reference scale by interpolating between the anchors around it.
+
+    Misspelled tags in an answer are matched back to the closest input tag;
+    dropped tags are re-ranked against the anchors in one more call, and any
+    still missing go last, so every input tag appears exactly once.
+    """
+
+    def __init__(self, llm, dimension: str, start: str, end: str):
+        self.llm = llm
+        self.dimension = dimension
+        self.start = start
+        self.end = end
+        self.stats = RankStats()
+        self.n_ctx = llm.n_ctx()
+        self._overhead = self._count(self._prompt([]))
+
+    def _prompt(self, items: List[str]) -> str:
+        return PROMPT_TEMPLATE.format(
+            dimension=self.dimension, start=self.start, end=self.end, items=", ".join(items)
+        )
+
+    def _count(self, text: str) -> int:
+        return len(self.llm.tokenize(text.encode("utf-8"), add_bos=True))
+
+    def _cost(self, item: str) -> int:
+        # The item appears once in the prompt and once in the answer, plus separators.
+        return 2 * (self._count(item) + 1)
+
+    def rank(self, tags: List[str]) -> List[str]:
+        unique = list(dict.fromkeys(tags))
+        self.stats.unique_tags = len(unique)
+        if len(unique) <= 1:
+            return unique
+        budget = self.n_ctx - self._overhead - TOKEN_MARGIN
+        chunks = self._chunks(unique, budget)
+        self.stats.chunks = len(chunks)
+        reference, dropped = self._rank_once(chunks[0])
+        if len(chunks) == 1 and not dropped:
+            return reference
+        if len(reference) < 2:
+            # Nothing usable to anchor on; keep the input order.
+            self.stats.missing += len(dropped)
+            return reference + [t for t in unique if t not in reference]
+
+        # Positions on [0, 1] along the reference order.
+        keys = {t: i / (len(reference) - 1) for i, t in enumerate(reference)}
+        picks = np.linspace(0, len(reference) - 1, min(ANCHOR_COUNT, len(reference))).round().astype(int)
+        anchors = [reference[i] for i in dict.fromkeys(picks.tolist())]
+        leftover = list(dropped)
+        for chunk in chunks[1:]:
+            leftover += self._place(chunk, anchors, keys)
+        if leftover:
+            # Tags the model dropped get one more pass, ranked against the anchors.
+            retried = []
+            for chunk in self._chunks(leftover, budget):
+                retried += self._place(chunk, anchors, keys)
+            self.stats.reconciled += len(leftover) - len(retried)
+            self.stats.missing += len(retried)
+            for t in retried:
+                keys[t] = 1.0  # still unplaced: last
+        return sorted(unique, key=lambda t: keys[t])
+
+    def _place(self, chunk: List[str], anchors: List[str], keys: Dict[str, float]) -> List[str]:
+        """
+        Ranks `chunk` together with the anchors and interpolates each tag's key
+        from the anchors around it. Returns the tags the model left out.
+        """
+        order, dropped = self._rank_once(chunk + anchors)
+        pos = [i for i, t in enumerate(order) if t in anchors]
+        if not pos:
+            return [t for t in chunk if t not in keys]
+        # Keep the anchors' reference keys monotonic in case the model
+        # ordered them differently this time.
+        xp = np.array(pos, dtype=float)
+        fp = np.maximum.accumulate([keys[order[i]] for i in pos])
+        for i, t in enumerate(order):
+            if t not in anchors:
+                keys[t] = float(np.interp(i, xp, fp))
+        return [t for t in dropped if t not in anchors]
+
+    def _chunks(self, tags: List[str], budget: int) -> List[List[str]]:
+        # Later chunks also carry the anchors, so reserve room for them.
+        costs = [self._cost(t) for t in tags]
+        if sum(costs) <= budget:
+            return [tags]
+        budget -= sum(sorted(costs)[-ANCHOR_COUNT:])
+        if budget <= max(costs):
+            raise ContextTooSmall(f"n_ctx={self.n_ctx} is too small to rank these tags in chunks.")
+        chunks, cur, used = [], [], 0
+        for tag, cost in zip(tags, costs):
+            if cur and used + cost > budget:
+                chunks.append(cur)
+                cur, used = [], 0
+            cur.append(tag)
+            used += cost
+        chunks.append(cur)
+        return chunks
+
+    def _rank_once(self, tags: List[str]) -> Tuple[List[str], List[str]]:
+        """One LLM call. Returns (tags in the model's order, tags it left out)."""
+        # Commas separate items in both prompt and answer, so keep them out of the items.
+        shown = {}
+        for t in tags:
+            s = " ".join(t.replace(",", " ").split()) or t
+            shown[s if s not in shown else t] = t
+        prompt = self._prompt(list(shown))
+        max_tokens = sum(self._count(s) + 1 for s in shown) + TOKEN_MARGIN
+        started = time.perf_counter()
+        resp = self.llm(prompt=prompt, max_tokens=max_tokens, stop=["\n\n"], temperature=0.0)
+        self.stats.latency += time.perf_counter() - started
+        self.stats.calls += 1
+        usage = resp.get("usage") or {}
+        self.stats.prompt_tokens += usage.get("prompt_tokens", 0)
+        self.stats.completion_tokens += usage.get("completion_tokens", 0)
+        answer = [a.strip() for a in resp["choices"][0]["text"].replace("\n", ",").split(",")]
+        return self._reconcile([a for a in answer if a], shown)
+
+    def _reconcile(self, answer: List[str], shown: Dict[str, str]) -> Tuple[List[str], List[str]]:
+        """Maps the model's answer back onto the input tags, exactly or by close match."""
+        lower = {s.lower(): s for s in shown}
+        out, seen = [], set()
+        for a in answer:
+            s = lower.get(a.lower())
+            if s is None:
+                close = difflib.get_close_matches(a.lower(), list(lower), n=1, cutoff=FUZZY_CUTOFF)
+                s = lower[close[0]] if close else None
+                if s is not None and shown[s] not in seen:
+                    self.stats.fuzzy_matched += 1
+            if s is not None and shown[s] not in seen:
+                seen.add(shown[s])
+                out.append(shown[s])
+        return out, [t for t in shown.values() if t not in seen]
+
+
+def rank_tags(llm, tags: List[str], dimension: str, start: str, end: str):
+    """Returns (unique tags in order, RankStats)."""
+    ranker = TagRanker(llm, dimension, start, end)
+    return ranker.rank(tags), ranker.stats
@@ -1,36 +1,121 @@
 #!/usr/bin/env python3
+import json
 import os
-import re
 import sys
+import urllib.error
+import urllib.request
 
-def strip_numeric_prefix(folder):
+from ann_index import IVFIndex
+from embedding_store import DEFAULT_CACHE_DIR, EmbeddingStore, HashStore
+from rename_engine import RenameConflict, RenameEngine, strip_order_prefix
+
+# The unified server keys cached vectors, hashes and ANN rows by path. While
+# it runs, undo goes through it and other renames are reported to it; when
+# it is down, the cache files are updated here.
+SERVER_URL = os.environ.get("SORTER_SERVER_URL", "http://127.0.0.1:8000")
+
+USAGE = f"""Usage: {sys.argv[0]} /path/to/image/folder | --last | --journal ID
+
+  FOLDER        strip the NN_ order prefix from every file in FOLDER
+  --last        undo the most recent rename
+  --journal ID  undo the rename recorded in journal ID
+
+Cached embeddings, hashes and ANN rows follow the files: through the server
+at $SORTER_SERVER_URL ({SERVER_URL}) if it is running, else in the cache
+directory directly."""
+
+def _request(route, payload=None, timeout=10):
+    data = None if payload is None else json.dumps(payload).encode()
+    req = urllib.request.Request(SERVER_URL + route, data=data, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        return json.load(resp)
+
+def server_running():
+    try:
+        _request("/rename/journals", timeout=1)
+        return True
+    except (OSError, ValueError):
+        # Nothing listening, or another app (e.g. embed_sorter_server) on the port.
+        return False
+
+def move_cached_paths(moves):
+    """Moves cached vectors, hashes and ANN rows from old to new paths while the server is down."""
+    for store in (EmbeddingStore, HashStore):
+        if os.path.exists(os.path.join(DEFAULT_CACHE_DIR, store.default_name)):
+            store().rename_many(moves)
+    ann_root = os.path.join(DEFAULT_CACHE_DIR, "ann")
+    for name in sorted(os.listdir(ann_root)) if os.path.isdir(ann_root) else []:
+        meta_path = os.path.join(ann_root, name, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                dim = json.load(f)["dim"]
+            IVFIndex(os.path.join(ann_root, name), dim).rename(moves)
+
+def report_moves(moves):
+    """Has the running server move its cached vectors, hashes and ANN rows."""
+    _request("/rename/moved", {"moves": [list(m) for m in moves]})
+
+def make_engine():
+    return RenameEngine(on_renamed=report_moves if server_running() else move_cached_paths)
+
+def undo(journal_id=None):
+    if not server_running():
+        journal = make_engine().undo(journal_id)
+        print(f"Restored {len(journal.moves)} names (journal {journal.undoes}).")
+        return
+    try:
+        resp = _request("/rename/undo", {"journalId": journal_id}, timeout=600)
+    except urllib.error.HTTPError as e:
+        detail = json.load(e).get("detail", str(e))
+        if e.code == 404:
+            raise KeyError(detail)
+        print(f"Nothing renamed: {detail}")
+        sys.exit(1)
+    print(f"Restored {resp['renamed']} names through the server (journal {resp['journalId']}).")
+
+def strip_numeric_prefix(folder, engine=None):
     """
     Rename all files in `folder` by removing a leading NN_ prefix if present.
-    E.g. '03_myimage.png' → 'myimage.png'.
+    E.g. '03_myimage.png' → 'myimage.png'. Runs as one journaled batch, so
+    `--last` can put the prefixes back.
     """
-    prefix_re = re.compile(r'^(\d+_)')
-    for name in os.listdir(folder):
+    engine = engine or make_engine()
+    moves, targets = [], set()
+    names = sorted(os.listdir(folder))
+    for name in names:
         old = os.path.join(folder, name)
-        if not os.path.isfile(old):
-            continue
-
-        m = prefix_re.match(name)
-        if not m:
+        new_name = strip_order_prefix(name)
+        if new_name == name or not os.path.isfile(old):
             continue  # no numeric prefix
 
-        new_name = name[m.end():]
-        new = os.path.join(folder, new_name)
-
-        # Avoid clobbering an existing file
-        if os.path.exists(new):
+        # Avoid clobbering an existing file (or another stripped one)
+        if new_name in targets or (new_name in names and strip_order_prefix(new_name) == new_name):
             print(f"Skipping {name}: target {new_name} already exists")
             continue
+        targets.add(new_name)
+        moves.append((os.path.abspath(old), os.path.abspath(os.path.join(folder, new_name))))
 
-        print(f"Renaming: {name} → {new_name}")
-        os.rename(old, new)
+    if not moves:
+        print("Nothing to rename.")
+        return
+    journal = engine.apply(moves)
+    print(f"Renamed {len(moves)} files (journal {journal.id}).")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print(f"Usage: {sys.argv[0]} /path/to/image/folder")
+    args = sys.argv[1:]
+    try:
+        if args and args[0] == "--last":
+            undo()
+        elif len(args) == 2 and args[0] == "--journal":
+            undo(args[1])
+        elif len(args) == 1 and not args[0].startswith("-"):
+            strip_numeric_prefix(args[0])
+        else:
+            print(USAGE)
+            sys.exit(1)
+    except KeyError:
+        print("Nothing to undo.")
+        sys.exit(1)
+    except (RenameConflict, FileNotFoundError) as e:
+        print(f"Nothing renamed: {e}")
         sys.exit(1)
-    strip_numeric_prefix(sys.argv[1])
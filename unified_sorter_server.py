@@ -1,13 +1,35 @@
 # unified_sorter_server.py
 
 import os
+import asyncio
+import json
+import threading
+import time
+
+# Cold-start clock: everything from here on (heavy imports included) counts.
+PROCESS_START = time.perf_counter()
+
+import numpy as np
 import torch
-import open_clip
-import google.generativeai as genai
 import PIL.Image
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
+
+from ann_index import DEFAULT_NPROBE, IVFIndex
+from clip_engines import ENGINES
+from dedupe import duplicate_groups, file_digests, file_hashes, image_dhash, split_exact_copies
+from embedding_store import DEFAULT_CACHE_DIR, EmbeddingStore, HashStore, TextEmbeddingCache, file_fingerprints
+from folder_watcher import FolderChanges, FolderWatcher
+from image_pipeline import PREFETCH_BATCHES, iter_preprocessed_batches, vector_tag
+from indexing import Indexer, list_folder_images
+from inference import InferenceExecutor, InferenceQueueFull
+from metrics import CURRENT_PROFILE, IMAGES, REGISTRY, MetricsMiddleware, profiled, timed
+from model_registry import ModelRegistry, LoadedModel
+from orderings import ORDER_MODES, order_embeddings
+from rename_engine import MAX_NAME_LEN, RenameConflict, RenameEngine
+from sharded_encoder import ShardPoolBroken
 
 # ==============================================================================
 # 1. SETUP & CONFIGURATION
@@ -15,16 +37,8 @@ from typing import List
 
 # Load environment variables from .env file
 
-def load_clip_model():
-    """
-    Loads the specified CLIP variant and its preprocess transforms.
-    Returns (model, preprocess).
-    """
-    model_name, pretrained = "ViT-B-32", "openai"
-    model, _, preprocess = open_clip.create_model_and_transforms(
-        model_name, pretrained=pretrained
-    )
-    return model, preprocess
+# One JSON line per start with the per-stage timings, for tracking cold starts.
+STARTUP_LOG = os.path.join(DEFAULT_CACHE_DIR, "startup.jsonl")
 
 # --- Pydantic Models for API Requests/Responses ---
 
@@ -32,22 +46,164 @@ class GeminiSortRequest(BaseModel):
     imagePaths: List[str]
     prompt: str
 
+class QueryTerm(BaseModel):
+    # Exactly one of `text` (a prompt) or `imagePath` (query by example).
+    text: Optional[str] = None
+    imagePath: Optional[str] = None
+    # Negative weights rank images that match this term lower.
+    weight: float = 1.0
+
 class ClipSortRequest(BaseModel):
     imagePaths: List[str]
-    prompt: str
+    # "A" or "A to B"; may be empty when `queries` is given.
+    prompt: str = ""
+    # Extra weighted text/image terms, scored together with the prompt.
+    queries: List[QueryTerm] = []
+    # "<architecture>/<pretrained>" from SORTER_MODELS; None uses the default model.
+    model: Optional[str] = None
+    # Optional ranking window: only the best `topK`, and/or the page
+    # [offset, offset + limit) of the ranking, are selected and returned.
+    topK: Optional[int] = None
+    offset: int = 0
+    limit: Optional[int] = None
+    returnScores: bool = False
+    # Also report groups of exact copies and near-duplicates among imagePaths.
+    dedupe: bool = False
+
+class ClipStreamRequest(ClipSortRequest):
+    previewK: int = 50
+
+class DuplicateGroup(BaseModel):
+    paths: List[str]
+    # True when every path in the group is a byte-identical copy.
+    exact: bool
 
 class SortResponse(BaseModel):
     sortedPaths: List[str]
+    scores: Optional[List[float]] = None
+    total: Optional[int] = None
+    duplicates: Optional[List[DuplicateGroup]] = None
+
+class SimilaritySortRequest(BaseModel):
+    imagePaths: List[str]
+    # One of orderings.ORDER_MODES: "chain", "cluster", "pca" or "grid".
+    mode: str = "chain"
+    model: Optional[str] = None
+    # cluster: number of groups (default ~sqrt(n/2)); grid: columns (default square).
+    clusters: Optional[int] = None
+    columns: Optional[int] = None
+
+class SimilaritySortResponse(BaseModel):
+    sortedPaths: List[str]
+    mode: str
+    # cluster: group label per sorted path, numbered in order of appearance.
+    clusters: Optional[List[int]] = None
+    # grid: [x, y] in [0, 1] per sorted path, and the grid width used.
+    coords: Optional[List[List[float]]] = None
+    columns: Optional[int] = None
+
+class ConceptSortRequest(BaseModel):
+    imagePaths: List[str]
+    dimension: str
+    orderStart: str
+    orderEnd: str
+    # "embedding": project CLIP embeddings onto the orderStart -> orderEnd axis.
+    # "llm": caption + LLM ordering, forwarded to embed_sorter_server.py.
+    mode: str = "embedding"
+    model: Optional[str] = None
+    # Average several prompt templates per end of the axis instead of one.
+    templates: bool = True
+    returnScores: bool = False
+
+class ConceptSortResponse(BaseModel):
+    sortedPaths: List[str]
+    scores: Optional[List[float]] = None
+    mode: str
+
+class SearchRequest(BaseModel):
+    prompt: str = ""
+    queries: List[QueryTerm] = []
+    topK: int = 50
+    nprobe: Optional[int] = None
+    exact: bool = False
+
+class SearchResponse(BaseModel):
+    paths: List[str]
+    scores: List[float]
+    candidates: int
+    librarySize: int
+    elapsedMs: float
+
+class IndexRequest(BaseModel):
+    folderPath: Optional[str] = None
+    imagePaths: List[str] = []
+    # Keep folderPath watched afterwards, re-embedding only what changes.
+    watch: bool = True
+
+class RenameRequest(BaseModel):
+    # Files in their new order; each gets its position as a zero-padded prefix.
+    sortedPaths: List[str]
+    maxNameLength: int = MAX_NAME_LEN
+    # Plan and check only; nothing is renamed or journaled.
+    dryRun: bool = False
+
+class UndoRenameRequest(BaseModel):
+    # None undoes the latest rename that has not been undone yet.
+    journalId: Optional[str] = None
+
+class RenamedElsewhereRequest(BaseModel):
+    # [old, new] paths of files another process renamed (undo_rename.py).
+    moves: List[List[str]]
+
+class RenameResponse(BaseModel):
+    journalId: str
+    # New path for every entry of sortedPaths, in the same order (rename only).
+    renamedPaths: Optional[List[str]] = None
+    renamed: int
+    steps: int
+    elapsedMs: float
+
+class IndexStatus(BaseModel):
+    jobId: str
+    folderPath: Optional[str] = None
+    status: str
+    total: int
+    done: int
+    cached: int
+    failed: int
+    error: Optional[str] = None
+    elapsedSec: float
 
 # --- Global Placeholders for AI Models ---
 
 GEMINI_MODEL = None
-CLIP_MODEL = None
-PREPROCESSOR = None
+MODELS = None
+# The registry's default model (always resident); set once loaded.
+DEFAULT_CLIP = None
 DEVICE = torch.device("cpu")
+TEXT_CACHE = TextEmbeddingCache()
+EMBEDDING_STORE = None
+HASH_STORE = None
+ANN_INDEX = None
+INDEXER = None
+WATCHER = None
+RENAMER = None
+INFERENCE = InferenceExecutor()
+# Set once background model loading has finished (successfully or not).
+MODELS_READY = threading.Event()
+STARTUP_TIMINGS = {}
 
 # --- Main FastAPI Application ---
-app = FastAPI(title="Unified Image Sorting Service")
+class TimedJSONResponse(JSONResponse):
+    """JSONResponse that records its encoding as the "serialize" stage."""
+
+    def render(self, content) -> bytes:
+        with timed("serialize"):
+            return super().render(content)
+
+app = FastAPI(title="Unified Image Sorting Service", default_response_class=TimedJSONResponse)
+# Request latency histograms, and per-request profiling via X-Sorter-Profile.
+app.add_middleware(MetricsMiddleware)
 
 
 # ==============================================================================
@@ -56,15 +212,17 @@ app = FastAPI(title="Unified Image Sorting Service")
 
 @app.on_event("startup")
 async def startup_event():
-    global GEMINI_MODEL, CLIP_MODEL, PREPROCESSOR, DEVICE
+    global GEMINI_MODEL, DEVICE, EMBEDDING_STORE, HASH_STORE, MODELS, RENAMER
 
     # 1) Pick device
     DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print(f"[server] Using device: {DEVICE}")
 
     # --- Configure Gemini ---
+    # google.generativeai is slow to import, so it is only imported here once enabled.
     #print("[server] Configuring Gemini...")
     try:
+        #import google.generativeai as genai
         #genai.configure(api_key=os.environ["GEMINI_API_KEY"])
         #GEMINI_MODEL = genai.GenerativeModel('gemini-2.0-flash')
         print("[server] Gemini 'gemini-2.0-flash' NOT configured.")
@@ -73,33 +231,196 @@ async def startup_event():
     except Exception as e:
         print(f"[server] WARNING: Gemini init error: {e}")
 
+    # --- Open the persistent embedding cache ---
+    try:
+        EMBEDDING_STORE = EmbeddingStore()
+        print(f"[server] Embedding cache: {EMBEDDING_STORE.db_path}")
+    except Exception as e:
+        EMBEDDING_STORE = None
+        print(f"[server] WARNING: embedding cache disabled: {e}")
+    try:
+        HASH_STORE = HashStore()
+    except Exception as e:
+        HASH_STORE = None
+        print(f"[server] WARNING: file hash cache disabled: {e}")
+
+    # --- Rename engine: roll back batches a crash left half applied ---
+    RENAMER = RenameEngine(on_renamed=move_cached_paths)
+    try:
+        RENAMER.recover()
+    except OSError as e:
+        print(f"[server] WARNING: rename recovery failed: {e}")
+
+    MODELS = ModelRegistry(DEVICE)
+
+    # The server accepts connections right away; GET /ready reports when
+    # the models are usable.
+    STARTUP_TIMINGS["serverUp"] = round(time.perf_counter() - PROCESS_START, 3)
+    threading.Thread(target=load_models, name="model-loader", daemon=True).start()
+
+
+def load_models():
+    """Loads the default CLIP model and everything that depends on it, off the event loop."""
+    global DEFAULT_CLIP, INDEXER, ANN_INDEX, WATCHER
+
+    def mark(stage, since):
+        STARTUP_TIMINGS[stage] = round(time.perf_counter() - since, 3)
+        return time.perf_counter()
+
     # --- Load OpenCLIP ---
-    print("[server] Loading OpenCLIP model...")
+    print(f"[server] Loading OpenCLIP model {MODELS.default}...")
+    # The model stays local until the ANN index, indexer and watcher exist:
+    # endpoints treat a non-None DEFAULT_CLIP as fully set up.
+    clip = None
+    t = time.perf_counter()
     try:
-        model, preprocess = load_clip_model()
-        # Move model to device
-        CLIP_MODEL = model.to(DEVICE).eval()
-        PREPROCESSOR = preprocess
-        print(f"[server] OpenCLIP loaded on {DEVICE}.")
+        import open_clip
+        t = mark("importOpenClip", t)
+        clip = MODELS.preload()
+        t = mark("loadModel", t)
+        print(f"[server] OpenCLIP loaded on {DEVICE} ({clip.engine.name} engine).")
     except Exception as e:
-        CLIP_MODEL = None
         print(f"[server] WARNING: CLIP init error: {e}")
 
+    # --- Library-wide ANN index over every cached embedding ---
+    if clip is not None and EMBEDDING_STORE is not None:
+        try:
+            ann_dir = os.path.join(DEFAULT_CACHE_DIR, "ann", vector_tag(clip.tag).replace("/", "_"))
+            ANN_INDEX = IVFIndex(ann_dir, clip.dim)
+            print(f"[server] ANN index: {len(ANN_INDEX)} vectors in {ann_dir}")
+            if len(ANN_INDEX) == 0 and EMBEDDING_STORE.count(vector_tag(clip.tag)):
+                threading.Thread(target=backfill_ann_index, daemon=True).start()
+        except Exception as e:
+            ANN_INDEX = None
+            print(f"[server] WARNING: ANN index disabled: {e}")
+        t = mark("annIndex", t)
+
+    # --- Background indexer (needs both the model and the cache) ---
+    if clip is not None and EMBEDDING_STORE is not None:
+        # Background batches go through the same inference workers as requests.
+        INDEXER = Indexer(
+            lambda paths, job_size: INFERENCE.call(get_image_embeddings, clip, paths,
+                                                   hash_files=True, job_size=job_size),
+            missing_embeddings,
+        )
+
+    # --- Folder watcher: folders watched before the restart are rescanned ---
+    if INDEXER is not None:
+        try:
+            WATCHER = FolderWatcher(
+                apply_folder_changes,
+                HASH_STORE.recorded_digests if HASH_STORE else None,
+                state_path=WATCH_STATE,
+            )
+            for folder in load_watched_folders():
+                watch_folder(folder)
+        except Exception as e:
+            WATCHER = None
+            print(f"[server] WARNING: folder watcher disabled: {e}")
+
+    DEFAULT_CLIP = clip
+    STARTUP_TIMINGS["ready"] = round(time.perf_counter() - PROCESS_START, 3)
+    MODELS_READY.set()
+    print(f"[server] Ready {STARTUP_TIMINGS['ready']:.2f}s after process start.")
+    try:
+        os.makedirs(os.path.dirname(STARTUP_LOG), exist_ok=True)
+        with open(STARTUP_LOG, "a") as f:
+            f.write(json.dumps({
+                "time": time.time(), "model": MODELS.default,
+                "engine": DEFAULT_CLIP.engine.name if DEFAULT_CLIP else None,
+                "clip": DEFAULT_CLIP is not None, **STARTUP_TIMINGS,
+            }) + "\n")
+    except OSError as e:
+        print(f"[server] WARNING: could not write {STARTUP_LOG}: {e}")
+
+
+def require_clip():
+    if DEFAULT_CLIP is None:
+        if not MODELS_READY.is_set():
+            raise HTTPException(503, "CLIP is still loading; poll GET /ready.")
+        raise HTTPException(503, "CLIP not available.")
+
+
+async def run_inference(fn, *args, **kwargs):
+    """Runs blocking model work on the inference executor, off the event loop."""
+    try:
+        # Under the request's profiler if it sent X-Sorter-Profile.
+        return await INFERENCE.run(profiled(fn, CURRENT_PROFILE.get()), *args, **kwargs)
+    except InferenceQueueFull as e:
+        raise HTTPException(429, f"Server busy: {e}")
+
+
+@app.get("/ready")
+async def ready():
+    """200 once startup has finished loading models, 503 until then."""
+    body = {"ready": MODELS_READY.is_set(), "clip": DEFAULT_CLIP is not None, "timings": STARTUP_TIMINGS}
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
+
+
+@app.get("/health")
+async def health():
+    return {
+        "status": "ok",
+        "clip": DEFAULT_CLIP is not None,
+        "inference": INFERENCE.stats(),
+        "models": MODELS.stats() if MODELS else None,
+        "textCache": TEXT_CACHE.stats(),
+        "annIndex": ANN_INDEX.stats() if ANN_INDEX else None,
+        "watcher": WATCHER.stats() if WATCHER else None,
+    }
+
+
+# --- Scrape-time gauges for /metrics (stage timings and counters live in metrics.py) ---
+def loaded_models() -> dict:
+    stats = MODELS.stats()["loaded"] if MODELS else {}
+    return {tag: MODELS.get(tag) for tag in stats}
+
+def batcher_totals(key: str) -> dict:
+    out = {}
+    for tag, lm in loaded_models().items():
+        if lm is not None:
+            out[(tag, "image")] = lm.image_batcher.stats()[key]
+            out[(tag, "text")] = lm.text_batcher.stats()[key]
+    return out
+
+REGISTRY.gauge("sorter_inference_pending", "Inference jobs admitted and not finished yet.",
+               lambda: INFERENCE.pending)
+REGISTRY.gauge("sorter_inference_max_pending", "Admission limit for inference jobs.",
+               lambda: INFERENCE.max_pending)
+REGISTRY.gauge("sorter_model_memory_bytes", "Parameter and buffer bytes of each resident CLIP model.",
+               lambda: {(tag,): lm.nbytes for tag, lm in loaded_models().items() if lm is not None}, ("model",))
+REGISTRY.gauge("sorter_model_budget_bytes", "Memory budget for resident CLIP models.",
+               lambda: MODELS.budget if MODELS else None)
+REGISTRY.gauge("sorter_model_evictions_total", "Models evicted to stay within the budget.",
+               lambda: MODELS.evictions if MODELS else None, kind="counter")
+REGISTRY.gauge("sorter_batches_total", "Model calls made by the micro-batchers.",
+               lambda: batcher_totals("batches"), ("model", "encoder"), kind="counter")
+REGISTRY.gauge("sorter_batch_items_total", "Images or texts encoded by the micro-batchers.",
+               lambda: batcher_totals("items"), ("model", "encoder"), kind="counter")
+REGISTRY.gauge("sorter_text_cache_hits_total", "Prompt embeddings served from memory.",
+               lambda: TEXT_CACHE.stats()["hits"], kind="counter")
+REGISTRY.gauge("sorter_text_cache_misses_total", "Prompt embeddings that had to be encoded.",
+               lambda: TEXT_CACHE.stats()["misses"], kind="counter")
+REGISTRY.gauge("sorter_ann_vectors", "Vectors in the library search index.",
+               lambda: len(ANN_INDEX) if ANN_INDEX else None)
+REGISTRY.gauge("sorter_index_jobs_active", "Background indexing jobs queued or running.",
+               lambda: len(INDEXER.active_jobs()) if INDEXER else None)
+REGISTRY.gauge("sorter_watch_changes_total", "File changes seen in watched folders.",
+               lambda: {(k,): v for k, v in WATCHER.stats()["changes"].items()} if WATCHER else None,
+               ("change",), kind="counter")
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text format: per-stage and per-route latency histograms, counters and gauges."""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 
 # ==============================================================================
 # 3. GEMINI-BASED SORTING ENDPOINT
 # ==============================================================================
 
-@app.post("/quick-sort", response_model=SortResponse)
-async def sort_by_gemini(req: GeminiSortRequest):
-    if GEMINI_MODEL is None:
-        raise HTTPException(503, "Gemini not available.")
-    if not req.imagePaths:
-        raise HTTPException(400, "No imagePaths provided.")
-    if not req.prompt:
-        raise HTTPException(400, "Empty prompt.")
-
-    num_images = len(req.imagePaths)
+def gemini_sort_paths(image_paths: List[str], prompt: str) -> List[str]:
+    num_images = len(image_paths)
     # Define the function schema
     sort_tool = {
         "function_declarations": [
@@ -125,10 +446,10 @@ async def sort_by_gemini(req: GeminiSortRequest):
         f"You are an image sorting assistant. Sort {num_images} images "
         f"per the user's instruction and call return_sorted_indices(sorted=[...])."
     )
-    user_prompt = f"Please sort these {num_images} images by: '{req.prompt}'."
+    user_prompt = f"Please sort these {num_images} images by: '{prompt}'."
 
     prompt_parts = [system_instruction, user_prompt]
-    for path in req.imagePaths:
+    for path in image_paths:
         try:
             prompt_parts.append(PIL.Image.open(path))
         except Exception as e:
@@ -144,10 +465,24 @@ async def sort_by_gemini(req: GeminiSortRequest):
         idxs = func_call.args.get("sorted", [])
         if len(idxs) != num_images or len(set(idxs)) != num_images:
             raise ValueError("Invalid index list from Gemini.")
-        sorted_paths = [req.imagePaths[i] for i in idxs]
+        sorted_paths = [image_paths[i] for i in idxs]
     except Exception as e:
         raise HTTPException(500, f"Gemini error: {e}")
 
+    return sorted_paths
+
+@app.post("/quick-sort", response_model=SortResponse)
+async def sort_by_gemini(req: GeminiSortRequest):
+    if GEMINI_MODEL is None:
+        raise HTTPException(503, "Gemini not available.")
+    if not req.imagePaths:
+        raise HTTPException(400, "No imagePaths provided.")
+    if not req.prompt:
+        raise HTTPException(400, "Empty prompt.")
+
+    # The Gemini call and image loading block; keep them off the event loop.
+    # This is remote work, so it does not take an inference slot.
+    sorted_paths = await asyncio.to_thread(gemini_sort_paths, req.imagePaths, req.prompt)
     return SortResponse(sortedPaths=sorted_paths)
 
 
@@ -155,71 +490,744 @@ async def sort_by_gemini(req: GeminiSortRequest):
 # 4. CLIP-BASED SORTING ENDPOINT
 # ==============================================================================
 
-# Embedding helpers
-def get_text_embedding(text: str):
-    tokenizer = open_clip.get_tokenizer("ViT-B-32")
-    tokens = tokenizer([text]).to(DEVICE)
-    with torch.no_grad():
-        emb = CLIP_MODEL.encode_text(tokens)
-    emb = emb / emb.norm(dim=-1, keepdim=True)
-    return emb
+# Embedding helpers. `clip` is the LoadedModel a request resolved to; every
+# cache (text LRU, embedding store) is keyed by its tag.
+def get_text_embeddings(clip: LoadedModel, texts: List[str]):
+    """Stacked [len(texts), dim] DEVICE tensor; uncached texts are encoded in one batch."""
+    embs = {t: TEXT_CACHE.get(clip.tag, t) for t in dict.fromkeys(texts)}
+    missing = [t for t, e in embs.items() if e is None]
+    if missing:
+        fresh = clip.text_batcher(clip.tokenizer(missing))
+        for i, t in enumerate(missing):
+            embs[t] = fresh[i : i + 1].clone()
+            TEXT_CACHE.put(clip.tag, t, embs[t])
+    return torch.cat([embs[t].to(DEVICE) for t in texts])
 
-def get_image_embeddings(paths: List[str], batch_size: int = 16):
+def encode_images(clip: LoadedModel, paths: List[str], batch_size: int = 16, on_decoded=None,
+                  job_size: int = 0):
+    """
+    Runs the CLIP image encoder over `paths`; returns a normalized DEVICE
+    tensor. `on_decoded` is passed to iter_preprocessed_batches (not called
+    for images the worker processes decode). `job_size` is the size of the
+    whole encode `paths` is a chunk of, when larger.
+    """
+    if clip.shards is not None and clip.shards.usable(max(len(paths), job_size)):
+        # Large CPU encodes go to the worker processes, in input order;
+        # every chunk of one does, so streamed and indexed encodes use them too.
+        try:
+            return torch.from_numpy(clip.shards.encode(paths, batch_size)).to(DEVICE)
+        except ShardPoolBroken as e:
+            print(f"[server] WARNING: sharded encode failed ({e}); encoding in-process.")
     all_embs = []
-    all_paths = []
-    for i in range(0, len(paths), batch_size):
-        batch = paths[i : i + batch_size]
-        imgs = []
-        for p in batch:
-            img = PIL.Image.open(p).convert("RGB")
-            imgs.append(PREPROCESSOR(img).unsqueeze(0))
-            all_paths.append(p)
-        tensor = torch.cat(imgs, dim=0).to(DEVICE)
-        with torch.no_grad():
-            emb = CLIP_MODEL.encode_image(tensor)
-        emb = emb / emb.norm(dim=-1, keepdim=True)
-        all_embs.append(emb)
+    in_flight = []
+    # Decoding/preprocessing of the next batches overlaps with encoding this
+    # one, and a few batches stay queued so the batcher can merge them.
+    for _, tensor in iter_preprocessed_batches(paths, clip.preprocess, batch_size, on_decoded=on_decoded):
+        in_flight.append(clip.image_batcher.submit(tensor))
+        if len(in_flight) > PREFETCH_BATCHES:
+            all_embs.append(in_flight.pop(0).result())
+    all_embs.extend(f.result() for f in in_flight)
     if not all_embs:
+        return torch.empty((0, clip.dim), device=DEVICE)
+    return torch.cat(all_embs, dim=0)
+
+# Digest every file before encoding so byte-identical copies are encoded
+# once. Costs a full read of each new file, so it is off by default; it
+# always happens with hash_files (background indexing, dedupe requests),
+# which read the bytes anyway.
+DEDUPE_COPIES = os.environ.get("SORTER_DEDUPE_COPIES", "0") != "0"
+
+def iter_image_embeddings(clip: LoadedModel, paths: List[str], batch_size: int = 16,
+                          chunk_size: Optional[int] = None, hash_files: bool = False, job_size: int = 0):
+    """
+    Yields (paths, embeddings) groups that cover each unique path once:
+    first everything already in the persistent cache, then freshly encoded
+    chunks of `chunk_size`, each written to the cache before it is yielded.
+    With `hash_files`, encoded files are also recorded in HASH_STORE, their
+    perceptual hashes taken from the encoder's own decode. `job_size` is the
+    size of a larger job `paths` belong to (see encode_images).
+    """
+    unique = list(dict.fromkeys(paths))
+    with timed("cache_read"):
+        cached = EMBEDDING_STORE.get_many(unique, vector_tag(clip.tag)) if EMBEDDING_STORE else {}
+    IMAGES.inc(len(cached), "cached")
+    if cached:
+        add_to_ann_index(clip, list(cached), list(cached.values()), only_new=True)
+        yield list(cached), torch.from_numpy(np.stack(list(cached.values()))).to(DEVICE)
+
+    missing = [p for p in unique if p not in cached]
+    if not missing:
+        return
+    hash_files = hash_files and HASH_STORE is not None
+    # Stamped before the files are read, so an edit mid-encode is a miss next time.
+    fingerprints = file_fingerprints(missing)
+    copies, digests = {}, {}
+    if (DEDUPE_COPIES or hash_files) and len(missing) > 1:
+        # Byte-identical copies share one encode.
+        with timed("hash"):
+            digests = file_digests(missing, HASH_STORE)
+            missing, copies = split_exact_copies(missing, digests)
+    step = chunk_size or len(missing)
+    job_size = max(job_size, len(missing))
+    for i in range(0, len(missing), step):
+        part = missing[i : i + step]
+        dhashes = {}
+        fresh = encode_images(clip, part, batch_size,
+                              (lambda p, img: dhashes.__setitem__(p, image_dhash(img))) if hash_files else None,
+                              job_size)
+        IMAGES.inc(len(part), "encoded")
+        if copies:
+            rows = [j for j, p in enumerate(part) for _ in range(1 + len(copies.get(p, ())))]
+            IMAGES.inc(len(rows) - len(part), "copy")
+            for p in part:
+                dhashes.update({q: dhashes[p] for q in copies.get(p, ()) if p in dhashes})
+            part = [q for p in part for q in [p, *copies.get(p, ())]]
+            fresh = fresh[rows]
+        fresh_np = fresh.float().cpu().numpy()
+        if EMBEDDING_STORE is not None:
+            with timed("cache_write"):
+                EMBEDDING_STORE.put_many(list(zip(part, fresh_np)), vector_tag(clip.tag), fingerprints)
+        if hash_files:
+            with timed("hash"):
+                known = {p: (digests.get(p), dhashes.get(p)) for p in part}
+                file_hashes(part, HASH_STORE, known=known, fingerprints=fingerprints)
+        add_to_ann_index(clip, part, fresh_np)
+        yield part, fresh
+
+def get_image_embeddings(clip: LoadedModel, paths: List[str], batch_size: int = 16, hash_files: bool = False,
+                         job_size: int = 0):
+    """
+    Returns (paths, embeddings) in input order. Vectors already in the
+    persistent cache are reused; only new or modified files are encoded
+    (and, with `hash_files`, hashed; see iter_image_embeddings for both flags).
+    """
+    if not paths:
         # Return an empty tensor on DEVICE
-        return [], torch.empty((0, CLIP_MODEL.visual.output_dim), device=DEVICE)
-    return all_paths, torch.cat(all_embs, dim=0)  # DEVICE tensor
+        return [], torch.empty((0, clip.dim), device=DEVICE)
+
+    found, chunks = [], []
+    for part, embs in iter_image_embeddings(clip, paths, batch_size, hash_files=hash_files, job_size=job_size):
+        found.extend(part)
+        chunks.append(embs)
+    embs = torch.cat(chunks, dim=0)
+    if found != list(paths):
+        row = {p: i for i, p in enumerate(found)}
+        embs = embs[[row[p] for p in paths]]
+    return list(paths), embs  # DEVICE tensor
+
+def add_to_ann_index(clip: LoadedModel, paths: List[str], vectors, only_new: bool = False):
+    """Adds vectors to the library index under their absolute paths (default model only)."""
+    if ANN_INDEX is None or not paths or clip.tag != MODELS.default:
+        return
+    abs_paths = [os.path.abspath(p) for p in paths]
+    if only_new:
+        missing = set(ANN_INDEX.missing(abs_paths))
+        if not missing:
+            return
+        keep = [i for i, p in enumerate(abs_paths) if p in missing]
+        abs_paths = [abs_paths[i] for i in keep]
+        vectors = [vectors[i] for i in keep]
+    ANN_INDEX.add(abs_paths, np.stack(vectors))
+
+def backfill_ann_index():
+    """Loads every vector already in the embedding cache into a fresh ANN index."""
+    added = 0
+    for paths, vectors in EMBEDDING_STORE.iter_model(vector_tag(MODELS.default)):
+        ANN_INDEX.add(paths, vectors)
+        added += len(paths)
+    print(f"[server] ANN index backfilled with {added} cached vectors.")
+
+def missing_embeddings(paths: List[str]) -> List[str]:
+    """Returns the paths that have no up-to-date default-model vector in the cache."""
+    cached = EMBEDDING_STORE.get_many(paths, vector_tag(MODELS.default)) if EMBEDDING_STORE else {}
+    return [p for p in paths if p not in cached]
+
+def prompt_query(clip: LoadedModel, prompt: str, queries: List[QueryTerm] = ()):
+    """
+    Stacks the prompt ("A", or "A to B" as A minus B) and the weighted
+    text/image terms into (vectors, weights): a [m, dim] DEVICE matrix and
+    its [m] weights. Image terms use (and fill) the embedding cache.
+    """
+    texts, text_weights = [], []
+    if prompt:
+        parts = prompt.lower().split(" to ")
+        if len(parts) == 2:
+            texts += parts
+            text_weights += [1.0, -1.0]
+        else:
+            texts.append(prompt)
+            text_weights.append(1.0)
+    for q in queries:
+        if q.text:
+            texts.append(q.text)
+            text_weights.append(q.weight)
+    rows = [get_text_embeddings(clip, texts)] if texts else []
+    image_terms = [q for q in queries if q.imagePath]
+    if image_terms:
+        rows.append(get_image_embeddings(clip, [q.imagePath for q in image_terms])[1].to(DEVICE))
+    weights = text_weights + [q.weight for q in image_terms]
+    vectors = torch.cat([r.float() for r in rows])
+    return vectors, torch.tensor(weights, dtype=vectors.dtype, device=vectors.device)
+
+def query_vector(vectors, weights):
+    """sum_i w_i (img . q_i) == img . (sum_i w_i q_i), so a whole query folds into one vector."""
+    return weights @ vectors
+
+def score_embeddings(img_embs, vectors, weights):
+    """Weighted sum of each image's similarity to every query vector; higher is a better match."""
+    with torch.no_grad():
+        query = query_vector(vectors, weights)
+        return img_embs @ query.to(img_embs.dtype)
+
+def find_duplicates(paths: List[str], img_embs) -> List[dict]:
+    """Groups of exact copies and near-duplicates among `paths` (embeddings row-aligned)."""
+    first = {}
+    for i, p in enumerate(paths):
+        first.setdefault(p, i)
+    unique = list(first)
+    embs = img_embs[list(first.values())].float().cpu().numpy()
+    groups = duplicate_groups(unique, file_hashes(unique, HASH_STORE), embs)
+    return [{"paths": [unique[i] for i in members], "exact": exact} for members, exact in groups]
+
+def rank_indices(scores, top_k: Optional[int] = None, offset: int = 0, limit: Optional[int] = None):
+    """
+    Returns (indices, values) of ranks [offset, end) of `scores`, best first,
+    where end is capped by top_k and offset + limit. Uses torch.topk when only
+    a prefix of the ranking is needed, so the cost follows the page size
+    rather than the number of images. Ties are always broken by input
+    position, so every page is a slice of the same ranking.
+    """
+    n = scores.shape[0]
+    end = n
+    if top_k is not None:
+        end = min(end, top_k)
+    if limit is not None:
+        end = min(end, offset + limit)
+    if end <= offset:
+        return scores.new_empty(0, dtype=torch.long), scores.new_empty(0)
+    if end < n:
+        # topk only finds the cutoff score (its order among ties is
+        # arbitrary); everything at or above it is then ordered exactly as
+        # the full stable sort would.
+        cutoff = torch.topk(scores, end).values[-1]
+        candidates = torch.nonzero(scores >= cutoff).squeeze(1)
+        order = torch.argsort(scores[candidates], descending=True, stable=True)
+        idx = candidates[order][:end]
+        values = scores[idx]
+    else:
+        idx = torch.argsort(scores, descending=True, stable=True)
+        values = scores[idx]
+    return idx[offset:end], values[offset:end]
 
-@app.post("/sort-by-clip", response_model=SortResponse)
+def clip_sort_paths(image_paths: List[str], prompt: str, top_k: Optional[int] = None,
+                    offset: int = 0, limit: Optional[int] = None, model: Optional[str] = None,
+                    dedupe: bool = False, queries: List[QueryTerm] = ()):
+    """
+    Blocking core of /sort-by-clip. Returns (paths, scores, total,
+    duplicates): the requested window of `image_paths` best match first,
+    their scores, how many images were ranked, and (with `dedupe`) the
+    duplicate groups among all of them.
+    """
+    with MODELS.use(model) as clip:
+        with timed("query"):
+            vectors, weights = prompt_query(clip, prompt, queries)
+        with timed("embed"):
+            abs_paths, img_embs = get_image_embeddings(clip, image_paths, hash_files=dedupe)
+    if img_embs.nelement() == 0:
+        return [], [], 0, [] if dedupe else None
+
+    with timed("score", DEVICE):
+        scores = score_embeddings(img_embs, vectors, weights)
+    with timed("rank", DEVICE):
+        idx, values = rank_indices(scores, top_k, offset, limit)
+    duplicates = None
+    if dedupe:
+        with timed("dedupe"):
+            duplicates = find_duplicates(abs_paths, img_embs)
+    return [abs_paths[i] for i in idx.tolist()], values.tolist(), len(abs_paths), duplicates
+
+def validate_query(req):
+    """400 unless the request has a prompt or well-formed query terms."""
+    if not req.prompt and not req.queries:
+        raise HTTPException(400, "Empty prompt.")
+    for q in req.queries:
+        if bool(q.text) == bool(q.imagePath):
+            raise HTTPException(400, "Each query needs exactly one of text or imagePath.")
+        if q.imagePath and not os.path.isfile(q.imagePath):
+            raise HTTPException(400, f"Query image not found: {q.imagePath}")
+
+def validate_ranking_window(req: ClipSortRequest):
+    try:
+        MODELS.resolve(req.model)
+    except KeyError:
+        raise HTTPException(400, f"Unknown model {req.model!r}; available: {', '.join(MODELS.available)}.")
+    if req.topK is not None and req.topK < 0:
+        raise HTTPException(400, "topK must be >= 0.")
+    if req.offset < 0:
+        raise HTTPException(400, "offset must be >= 0.")
+    if req.limit is not None and req.limit < 0:
+        raise HTTPException(400, "limit must be >= 0.")
+
+# Images encoded between two streamed progress/partial events.
+STREAM_CHUNK = 64
+
+def clip_sort_stream(image_paths: List[str], prompt: str, preview_k: int, emit,
+                     top_k: Optional[int] = None, offset: int = 0, limit: Optional[int] = None,
+                     return_scores: bool = False, model: Optional[str] = None, dedupe: bool = False,
+                     queries: List[QueryTerm] = ()):
+    """
+    Blocking core of /sort-by-clip/stream. Calls `emit(event)` with
+    "progress" and provisional "partial" top-K events as groups of images
+    are scored (cached ones first), then one "result" with the final
+    ranking window (the full order by default, plus duplicate groups with
+    `dedupe`).
+    Always finishes with a "result" or "error" event.
+    """
+    try:
+        total = len(set(image_paths))
+        scored, score_chunks, emb_chunks = [], [], []
+        with MODELS.use(model) as clip:
+            vectors, weights = prompt_query(clip, prompt, queries)
+            for part, embs in iter_image_embeddings(clip, image_paths, chunk_size=STREAM_CHUNK, hash_files=dedupe):
+                scored.extend(part)
+                score_chunks.append(score_embeddings(embs, vectors, weights))
+                if dedupe:
+                    emb_chunks.append(embs)
+                scores = torch.cat(score_chunks)
+                emit({"type": "progress", "done": len(scored), "total": total})
+                top = torch.topk(scores, min(preview_k, len(scored))).indices.tolist()
+                emit({"type": "partial", "scored": len(scored), "topPaths": [scored[i] for i in top]})
+
+        if not scored:
+            emit({"type": "result", "sortedPaths": [], "total": 0, **({"duplicates": []} if dedupe else {})})
+            return
+        # Rank the original list (duplicates included) by its paths' scores.
+        row = {p: i for i, p in enumerate(scored)}
+        scores = torch.cat(score_chunks)[[row[p] for p in image_paths]]
+        idx, values = rank_indices(scores, top_k, offset, limit)
+        result = {
+            "type": "result",
+            "sortedPaths": [image_paths[i] for i in idx.tolist()],
+            "total": len(image_paths),
+        }
+        if return_scores:
+            result["scores"] = values.tolist()
+        if dedupe:
+            result["duplicates"] = find_duplicates(scored, torch.cat(emb_chunks))
+        emit(result)
+    except Exception as e:
+        emit({"type": "error", "detail": str(e)})
+
+@app.post("/sort-by-clip", response_model=SortResponse, response_model_exclude_none=True)
 async def sort_by_clip(req: ClipSortRequest):
-    if CLIP_MODEL is None:
-        raise HTTPException(503, "CLIP not available.")
+    require_clip()
     if not req.imagePaths:
         raise HTTPException(400, "No imagePaths provided.")
-    if not req.prompt:
-        raise HTTPException(400, "Empty prompt.")
+    validate_query(req)
 
-    parts = req.prompt.lower().split(" to ")
-    if len(parts) == 2:
-        emb_a = get_text_embedding(parts[0]).to(DEVICE)
-        emb_b = get_text_embedding(parts[1]).to(DEVICE)
-    else:
-        emb_a = get_text_embedding(req.prompt).to(DEVICE)
-        emb_b = None
+    validate_ranking_window(req)
+
+    sorted_paths, scores, total, duplicates = await run_inference(
+        clip_sort_paths, req.imagePaths, req.prompt, req.topK, req.offset, req.limit, req.model,
+        req.dedupe, req.queries,
+    )
+    return SortResponse(
+        sortedPaths=sorted_paths,
+        scores=scores if req.returnScores else None,
+        total=total,
+        duplicates=duplicates,
+    )
+
+@app.post("/sort-by-clip/stream")
+async def sort_by_clip_stream(req: ClipStreamRequest):
+    """
+    Like /sort-by-clip, but streams NDJSON events so the client can render
+    while images are still being embedded:
+      {"type": "progress", "done", "total"}
+      {"type": "partial", "scored", "topPaths"}   provisional top previewK
+      {"type": "result", "sortedPaths", "total"}  final ranking window (+ "duplicates")
+      {"type": "error", "detail"}
+    """
+    require_clip()
+    if not req.imagePaths:
+        raise HTTPException(400, "No imagePaths provided.")
+    validate_query(req)
+    validate_ranking_window(req)
 
-    abs_paths, img_embs = get_image_embeddings(req.imagePaths)
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def emit(event):
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    try:
+        INFERENCE.submit(
+            profiled(clip_sort_stream, CURRENT_PROFILE.get()), req.imagePaths, req.prompt, max(1, req.previewK), emit,
+            req.topK, req.offset, req.limit, req.returnScores, req.model, req.dedupe, req.queries,
+        )
+    except InferenceQueueFull as e:
+        raise HTTPException(429, f"Server busy: {e}")
+
+    async def ndjson():
+        while True:
+            event = await events.get()
+            yield json.dumps(event) + "\n"
+            if event["type"] in ("result", "error"):
+                break
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+def similarity_sort_paths(image_paths: List[str], mode: str, model: Optional[str] = None,
+                          clusters: Optional[int] = None, columns: Optional[int] = None) -> dict:
+    """Blocking core of /sort-by-similarity: orders the images by their embeddings alone."""
+    with MODELS.use(model) as clip:
+        abs_paths, img_embs = get_image_embeddings(clip, image_paths)
+    result = order_embeddings(img_embs.float().cpu().numpy(), mode, clusters, columns)
+    result["sortedPaths"] = [abs_paths[i] for i in result.pop("order").tolist()]
+    return result
+
+@app.post("/sort-by-similarity", response_model=SimilaritySortResponse, response_model_exclude_none=True)
+async def sort_by_similarity(req: SimilaritySortRequest):
+    """
+    Prompt-free orderings over the images' CLIP embeddings: a nearest-
+    neighbour "visual flow" chain, similarity clusters, or a 1D/2D
+    principal-component layout (see orderings.py).
+    """
+    require_clip()
+    if not req.imagePaths:
+        raise HTTPException(400, "No imagePaths provided.")
+    if req.mode not in ORDER_MODES:
+        raise HTTPException(400, f"Unknown mode {req.mode!r}; use one of {', '.join(ORDER_MODES)}.")
+    if (req.clusters is not None and req.clusters < 1) or (req.columns is not None and req.columns < 1):
+        raise HTTPException(400, "clusters and columns must be >= 1.")
+    try:
+        MODELS.resolve(req.model)
+    except KeyError:
+        raise HTTPException(400, f"Unknown model {req.model!r}; available: {', '.join(MODELS.available)}.")
+
+    result = await run_inference(
+        similarity_sort_paths, req.imagePaths, req.mode, req.model, req.clusters, req.columns
+    )
+    return SimilaritySortResponse(
+        sortedPaths=result["sortedPaths"],
+        mode=req.mode,
+        clusters=result["labels"].tolist() if "labels" in result else None,
+        coords=result["coords"].astype(float).round(4).tolist() if "coords" in result else None,
+        columns=result.get("columns"),
+    )
+
+
+# ==============================================================================
+# 5. CONCEPT SORT (EMBEDDING AXIS OR LLM)
+# ==============================================================================
+
+# Each end of a concept axis is the mean of these prompts, which is steadier
+# than any single phrasing.
+CONCEPT_TEMPLATES = [
+    "{value}",
+    "a photo of {value}",
+    "a photo that is {value}",
+    "an image with {value} {dimension}",
+    "{dimension}: {value}",
+]
+# Where mode="llm" requests go: a running embed_sorter_server.py, e.g. http://127.0.0.1:8001.
+LLM_SORTER_URL = os.environ.get("SORTER_LLM_SORTER_URL")
+# Seconds to wait for it to connect and for each read; captioning a large
+# uncached folder on the other side can take minutes.
+LLM_SORTER_TIMEOUT = float(os.environ.get("SORTER_LLM_SORTER_TIMEOUT", 600))
+
+def concept_anchor(clip: LoadedModel, value: str, dimension: str, templates: bool):
+    """Normalized text embedding for one end of the axis, optionally template-averaged."""
+    texts = [t.format(value=value, dimension=dimension) for t in CONCEPT_TEMPLATES] if templates else [value]
+    emb = get_text_embeddings(clip, texts).mean(dim=0, keepdim=True)
+    return emb / emb.norm(dim=-1, keepdim=True)
+
+def concept_sort_paths(image_paths: List[str], dimension: str, start: str, end: str,
+                       model: Optional[str] = None, templates: bool = True):
+    """
+    Blocking core of /concept-sort in embedding mode. Orders `image_paths`
+    from `start` to `end` by projecting their (cached) CLIP embeddings onto
+    the axis end - start. Returns (paths, projections).
+    """
+    with MODELS.use(model) as clip:
+        emb_start = concept_anchor(clip, start, dimension, templates)
+        emb_end = concept_anchor(clip, end, dimension, templates)
+        abs_paths, img_embs = get_image_embeddings(clip, image_paths)
     if img_embs.nelement() == 0:
-        return SortResponse(sortedPaths=[])
+        return [], []
+    # Ascending projection runs from the start of the axis to its end.
+    axis = torch.cat([emb_end, emb_start])
+    scores = score_embeddings(img_embs, axis, torch.tensor([1.0, -1.0], dtype=axis.dtype, device=axis.device))
+    idx = torch.argsort(scores, stable=True)
+    return [abs_paths[i] for i in idx.tolist()], scores[idx].tolist()
 
-    with torch.no_grad():
-        if emb_b is None:
-            scores = (img_embs @ emb_a.t()).squeeze(1)
-        else:
-            scores = (img_embs @ emb_a.t()).squeeze(1) - (img_embs @ emb_b.t()).squeeze(1)
+def forward_llm_concept_sort(req: ConceptSortRequest) -> List[str]:
+    import urllib.error
+    import urllib.request
 
-    pairs = sorted(zip(abs_paths, scores.tolist()), key=lambda x: x[1], reverse=True)
-    sorted_paths = [p for p,_ in pairs]
-    return SortResponse(sortedPaths=sorted_paths)
+    body = json.dumps({
+        "imagePaths": req.imagePaths, "dimension": req.dimension,
+        "orderStart": req.orderStart, "orderEnd": req.orderEnd,
+    }).encode()
+    http_req = urllib.request.Request(
+        f"{LLM_SORTER_URL.rstrip('/')}/concept-sort", data=body,
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(http_req, timeout=LLM_SORTER_TIMEOUT) as resp:
+            return json.load(resp)["sortedPaths"]
+    except urllib.error.HTTPError as e:
+        raise HTTPException(e.code, f"LLM concept sort failed: {e.read().decode(errors='replace')}")
+    except OSError as e:
+        # Connect timeouts arrive wrapped in URLError, read timeouts bare.
+        if isinstance(e, TimeoutError) or isinstance(getattr(e, "reason", None), TimeoutError):
+            raise HTTPException(504, f"LLM concept sort at {LLM_SORTER_URL} timed out after {LLM_SORTER_TIMEOUT:g} s.")
+        raise HTTPException(502, f"LLM concept sort unreachable at {LLM_SORTER_URL}: {e}")
+
+@app.post("/concept-sort", response_model=ConceptSortResponse, response_model_exclude_none=True)
+async def concept_sort(req: ConceptSortRequest):
+    if not req.imagePaths:
+        raise HTTPException(400, "No imagePaths provided.")
+    if not req.orderStart or not req.orderEnd:
+        raise HTTPException(400, "orderStart and orderEnd are required.")
+
+    if req.mode == "llm":
+        if not LLM_SORTER_URL:
+            raise HTTPException(400, "mode 'llm' needs SORTER_LLM_SORTER_URL pointing at embed_sorter_server.py.")
+        sorted_paths = await asyncio.to_thread(forward_llm_concept_sort, req)
+        return ConceptSortResponse(sortedPaths=sorted_paths, mode=req.mode)
+    if req.mode != "embedding":
+        raise HTTPException(400, f"Unknown mode {req.mode!r}; use 'embedding' or 'llm'.")
+
+    require_clip()
+    try:
+        MODELS.resolve(req.model)
+    except KeyError:
+        raise HTTPException(400, f"Unknown model {req.model!r}; available: {', '.join(MODELS.available)}.")
+    sorted_paths, scores = await run_inference(
+        concept_sort_paths, req.imagePaths, req.dimension, req.orderStart, req.orderEnd,
+        req.model, req.templates,
+    )
+    return ConceptSortResponse(
+        sortedPaths=sorted_paths,
+        scores=scores if req.returnScores else None,
+        mode=req.mode,
+    )
+
+
+# ==============================================================================
+# 6. FOLDER INDEXING (BACKGROUND PRE-EMBEDDING)
+# ==============================================================================
+
+@app.post("/index", response_model=IndexStatus)
+async def start_index(req: IndexRequest):
+    """
+    Starts embedding a folder in the background so later sorts only have to
+    wait for whatever is not cached yet. Poll GET /index/{jobId} for progress.
+    """
+    require_clip()
+    if INDEXER is None:
+        raise HTTPException(503, "Indexing not available.")
+    paths = req.imagePaths
+    if not paths:
+        if not req.folderPath:
+            raise HTTPException(400, "Provide folderPath or imagePaths.")
+        try:
+            paths = await asyncio.to_thread(list_folder_images, req.folderPath)
+        except OSError as e:
+            raise HTTPException(400, f"Cannot list {req.folderPath}: {e}")
+    job = INDEXER.submit(paths, req.folderPath)
+    if req.folderPath and req.watch and WATCHER is not None:
+        # Reads the folder's cache rows; large libraries take a while.
+        await asyncio.to_thread(watch_folder, req.folderPath)
+    return IndexStatus(**job.to_dict())
+
+@app.get("/index/{job_id}", response_model=IndexStatus)
+async def index_status(job_id: str):
+    job = INDEXER.get(job_id) if INDEXER else None
+    if job is None:
+        raise HTTPException(404, f"Unknown index job {job_id}.")
+    return IndexStatus(**job.to_dict())
+
+@app.delete("/index/{job_id}", response_model=IndexStatus)
+async def cancel_index(job_id: str):
+    job = INDEXER.get(job_id) if INDEXER else None
+    if job is None:
+        raise HTTPException(404, f"Unknown index job {job_id}.")
+    INDEXER.cancel(job_id)
+    return IndexStatus(**job.to_dict())
+
+# Folders to watch again after a restart.
+WATCH_STATE = os.path.join(DEFAULT_CACHE_DIR, "watched.json")
+
+def load_watched_folders() -> List[str]:
+    try:
+        with open(WATCH_STATE) as f:
+            return [p for p in json.load(f) if os.path.isdir(p)]
+    except (OSError, ValueError):
+        return []
+
+def watch_folder(folder: str):
+    # The cache's record of the folder is the baseline, so files changed,
+    # moved or deleted while nobody was watching show up in the first scan.
+    WATCHER.watch(folder, EMBEDDING_STORE.folder_snapshot(folder, vector_tag(MODELS.default)))
+
+def move_cached_paths(pairs):
+    """Moves cached vectors and hashes from old to new paths after files were renamed."""
+    if not pairs or EMBEDDING_STORE is None:
+        return
+    EMBEDDING_STORE.rename_many(pairs)
+    if HASH_STORE is not None:
+        HASH_STORE.rename_many(pairs)
+    if ANN_INDEX is not None and MODELS is not None:
+        ANN_INDEX.remove([old for old, _ in pairs])
+        moved = EMBEDDING_STORE.get_many([new for _, new in pairs], vector_tag(MODELS.default))
+        if moved:
+            ANN_INDEX.add(list(moved), np.stack(list(moved.values())))
+
+def apply_folder_changes(changes: FolderChanges):
+    """
+    Keeps the caches in step with the watched folders: renamed files keep
+    their vectors under the new path, removed and edited files lose theirs,
+    and new and edited files are queued for embedding.
+    """
+    move_cached_paths(changes.renamed)
+    stale = changes.removed + changes.modified
+    if stale:
+        EMBEDDING_STORE.delete(stale)
+        if HASH_STORE is not None:
+            HASH_STORE.delete(stale)
+        if ANN_INDEX is not None:
+            ANN_INDEX.remove(stale)
+    todo = changes.added + changes.modified
+    if todo:
+        INDEXER.submit(todo, skip_queued=True)
+
+@app.get("/watch")
+async def watch_status():
+    if WATCHER is None:
+        raise HTTPException(503, "Folder watching not available.")
+    return WATCHER.stats()
+
+@app.delete("/watch")
+async def unwatch(folderPath: str):
+    if WATCHER is None:
+        raise HTTPException(503, "Folder watching not available.")
+    if not WATCHER.unwatch(folderPath):
+        raise HTTPException(404, f"Not watching {folderPath}.")
+    return WATCHER.stats()
+
+
+# ==============================================================================
+# 7. FILE RENAMES (JOURNALED, UNDOABLE)
+# ==============================================================================
+
+def rename_response(journal, start, renamed_paths=None):
+    return RenameResponse(
+        journalId=journal.id,
+        renamedPaths=renamed_paths,
+        renamed=len(journal.moves),
+        steps=len(journal.steps),
+        elapsedMs=round(1000 * (time.perf_counter() - start), 3),
+    )
+
+@app.post("/rename", response_model=RenameResponse, response_model_exclude_none=True)
+async def rename_files(req: RenameRequest):
+    """
+    Renames files to match a sorted order ("0001_name.jpg" ...) as one
+    journaled batch: every name is planned and checked before the first
+    rename, and a failure rolls the batch back. Undo with POST /rename/undo.
+    """
+    if not req.sortedPaths:
+        raise HTTPException(400, "sortedPaths must not be empty.")
+    if req.maxNameLength <= 0:
+        raise HTTPException(400, "maxNameLength must be > 0.")
+    start = time.perf_counter()
+    try:
+        journal, renamed_paths = await asyncio.to_thread(
+            RENAMER.rename_sorted, req.sortedPaths, req.maxNameLength, req.dryRun
+        )
+    except RenameConflict as e:
+        raise HTTPException(409, str(e))
+    if not req.dryRun:
+        print(f"[server] Renamed {len(journal.moves)} of {len(req.sortedPaths)} files "
+              f"in {len(journal.steps)} steps (journal {journal.id}).")
+    return rename_response(journal, start, renamed_paths)
+
+@app.post("/rename/undo", response_model=RenameResponse, response_model_exclude_none=True)
+async def undo_rename(req: UndoRenameRequest):
+    """Restores the names from before a rename by replaying its journal backwards."""
+    start = time.perf_counter()
+    try:
+        journal = await asyncio.to_thread(RENAMER.undo, req.journalId)
+    except (KeyError, FileNotFoundError):
+        raise HTTPException(404, f"No rename to undo{f' with journal {req.journalId}' if req.journalId else ''}.")
+    except RenameConflict as e:
+        raise HTTPException(409, str(e))
+    return rename_response(journal, start)
+
+@app.post("/rename/moved")
+async def renamed_elsewhere(req: RenamedElsewhereRequest):
+    """Moves cached vectors, hashes and index rows along with files renamed outside the server."""
+    moves = [(os.path.abspath(old), os.path.abspath(new)) for old, new in req.moves]
+    await asyncio.to_thread(move_cached_paths, moves)
+    return {"moved": len(moves)}
+
+@app.get("/rename/journals")
+async def rename_journals():
+    return await asyncio.to_thread(RENAMER.journals)
+
+
+# ==============================================================================
+# 8. LIBRARY SEARCH (ANN INDEX)
+# ==============================================================================
+
+def search_library(prompt: str, top_k: int, nprobe: int, exact: bool, queries: List[QueryTerm] = ()):
+    # Weighted terms fold into a single query vector, so the ANN search is unchanged.
+    query = query_vector(*prompt_query(DEFAULT_CLIP, prompt, queries))
+    start = time.perf_counter()
+    paths, scores, candidates = ANN_INDEX.search(query.float().cpu().numpy(), top_k, nprobe, exact)
+    elapsed = 1000 * (time.perf_counter() - start)
+    return SearchResponse(
+        paths=paths,
+        scores=scores.tolist(),
+        candidates=candidates,
+        librarySize=len(ANN_INDEX),
+        elapsedMs=round(elapsed, 3),
+    )
+
+@app.post("/search", response_model=SearchResponse)
+async def search(req: SearchRequest):
+    """Finds the best matches for a prompt (and/or weighted query terms) across every image indexed so far."""
+    require_clip()
+    if ANN_INDEX is None:
+        raise HTTPException(503, "Library search not available.")
+    validate_query(req)
+    if req.topK <= 0:
+        raise HTTPException(400, "topK must be > 0.")
+    return await run_inference(
+        search_library, req.prompt, req.topK, req.nprobe or DEFAULT_NPROBE, req.exact, req.queries
+    )
 
 
 # ==============================================================================
-# 5. RUN THE SERVER
+# 9. RUN THE SERVER
 # ==============================================================================
 
 if __name__ == "__main__":
+    import argparse
     import uvicorn
+
+    parser = argparse.ArgumentParser(description="Unified Image Sorting Service")
+    parser.add_argument("--engine", choices=ENGINES, help="CLIP inference engine (SORTER_ENGINE)")
+    parser.add_argument("--quantize", action="store_true", help="dynamic int8 quantization (SORTER_QUANTIZE)")
+    parser.add_argument("--threads", type=int, help="intra-op threads (SORTER_INTRA_OP_THREADS)")
+    args = parser.parse_args()
+    # The server runs in a reloader subprocess, so hand the flags over via the environment.
+    if args.engine:
+        os.environ["SORTER_ENGINE"] = args.engine
+    if args.quantize:
+        os.environ["SORTER_QUANTIZE"] = "1"
+    if args.threads:
+        os.environ["SORTER_INTRA_OP_THREADS"] = str(args.threads)
     uvicorn.run("unified_sorter_server:app", host="127.0.0.1", port=8000, reload=True)